@@ -0,0 +1,237 @@
+from __future__ import annotations
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import yaml
+
+from src.bench.generator import ChatGenerator
+from src.core.bundle import RulesBundle, load_bundle
+from src.core.config import Config
+from src.core.dispatch import ChatDispatcher, ThreadedEngine
+from src.core.engine import RulesEngine
+from src.core.history import StepHistory
+from src.core.ltlf import LTLfMonitor
+from src.core.persistence import SQLiteBackend, WriteBehind
+
+# Воспроизводимые проверки движка (порядок и состояние при параллельной
+# обработке, пределы по памяти и стоимости); падают с AssertionError.
+#   python -m src.bench.checks
+
+
+def check_dispatch_cancel(seed: int = 0, chats: int = 8, calls: int = 400, workers: int = 4) -> str:
+    """Порядок вызовов внутри чата при случайных отменах ожидающих и запущенных вызовов."""
+    rnd = random.Random(seed)
+    lock = threading.Lock()
+    log: List[Tuple[str, str, int]] = []
+    pool = ThreadPoolExecutor(workers)
+
+    def work(chat_id: str, seq: int, pause: float) -> int:
+        with lock:
+            log.append(('start', chat_id, seq))
+        time.sleep(pause)
+        with lock:
+            log.append(('end', chat_id, seq))
+        return seq
+
+    async def main() -> int:
+        d = ChatDispatcher(work, lambda _: pool, log_every=0)
+        tasks = []
+        for seq in range(calls):
+            chat_id = f'c{rnd.randrange(chats)}'
+            tasks.append(asyncio.ensure_future(d.submit(chat_id, seq, rnd.uniform(0, 0.004))))
+            if rnd.random() < 0.3:
+                await asyncio.sleep(rnd.uniform(0, 0.002))
+            if rnd.random() < 0.25:
+                rnd.choice(tasks).cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # отменённые, но уже запущенные вызовы дорабатывают в пуле
+        while d._tails:
+            await asyncio.sleep(0.01)
+        return sum(t.cancelled() for t in tasks)
+
+    cancelled = asyncio.run(main())
+    pool.shutdown()
+    running: Dict[str, Optional[int]] = {}
+    last: Dict[str, int] = {}
+    for kind, chat_id, seq in log:
+        if kind == 'start':
+            assert running.get(chat_id) is None, f'{chat_id}: вызов {seq} начат во время {running[chat_id]}'
+            assert seq > last.get(chat_id, -1), f'{chat_id}: вызов {seq} после {last[chat_id]}'
+            running[chat_id] = last[chat_id] = seq
+        else:
+            running[chat_id] = None
+    return f'dispatch: {calls} вызовов, отменено {cancelled}, выполнено {len(log) // 2} — порядок соблюдён'
+
+
+def _canon(snap: Dict[str, Any]) -> Dict[str, Any]:
+    # мониторы LTLf сравниваются по остаточной формуле, а не по объекту
+    return dict(snap, ltlf=[x.__getstate__() if isinstance(x, LTLfMonitor) else x for x in snap['ltlf']])
+
+
+def _final(engine: RulesEngine, chats: List[str]) -> Dict[str, Dict[str, Any]]:
+    out = {}
+    for cid in chats:
+        # вытесненный чат подгружается из SQLite и снимается сразу, пока он живой
+        engine.get_chat(cid)
+        out[cid] = _canon(engine.export_chat(cid))
+    return out
+
+
+def check_engine_stress(seed: int = 0, chats: int = 300, messages: int = 20000, workers: int = 8,
+                        config: str = 'config/rules.yaml') -> str:
+    """Параллельная обработка против последовательного прогона.
+
+    Два способа: ThreadedEngine через ChatDispatcher (порядок внутри чата
+    держит диспетчер) и RulesEngine из workers потоков, каждый со своей
+    частью чатов. Без вытеснения и с вытеснением по LRU/TTL в SQLite снимок
+    export_chat каждого чата должен совпасть с последовательным.
+    """
+    bundle = load_bundle(config)
+    msgs = list(ChatGenerator(bundle.cfg, seed=seed).stream(chats, messages))
+    ids = sorted({cid for cid, _ in msgs})
+    seq = RulesEngine(bundle)
+    for cid, text in msgs:
+        seq.process_message(cid, text, hints=False)
+    want = _final(seq, ids)
+
+    async def feed(backend: ThreadedEngine) -> None:
+        d = ChatDispatcher(lambda cid, text: backend.engine.process_message(cid, text, hints=False),
+                           backend.executor_for, log_every=0)
+        await asyncio.gather(*(d.submit(cid, text) for cid, text in msgs))
+
+    def dispatched(engine: RulesEngine) -> None:
+        backend = ThreadedEngine(engine, workers)
+        asyncio.run(feed(backend))
+        backend.pool.shutdown()
+
+    def threads(engine: RulesEngine) -> None:
+        part_of = {cid: i % workers for i, cid in enumerate(ids)}
+        parts = [[m for m in msgs if part_of[m[0]] == k] for k in range(workers)]
+        run = lambda part: [engine.process_message(cid, text, hints=False) for cid, text in part]
+        pool = [threading.Thread(target=run, args=(part,)) for part in parts]
+        for th in pool:
+            th.start()
+        for th in pool:
+            th.join()
+
+    lines = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for drive in (dispatched, threads):
+            for evict in (False, True):
+                kwargs = {}
+                if evict:
+                    db = os.path.join(tmp, f'{drive.__name__}.db')
+                    kwargs = dict(max_chats=max(2, chats // 20), idle_ttl=0.05,
+                                  persistence=WriteBehind(SQLiteBackend(db), flush_every=64))
+                engine = RulesEngine(bundle, **kwargs)
+                drive(engine)
+                got = _final(engine, ids)
+                st = engine.stats()
+                engine.close()
+                name = f'{drive.__name__}{", LRU/TTL + SQLite" if evict else ""}'
+                bad = [cid for cid in ids if got[cid] != want[cid]]
+                assert not bad, f'{name}: снимки расходятся в {len(bad)} чатах, например {bad[0]}'
+                lines.append(f'{name}: вытеснено {st["evictions"]}, подгружено {st["reloads"]}')
+    return (f'engine: {messages} сообщений, {len(ids)} чатов, {workers} потоков — снимки совпали '
+            f'({"; ".join(lines)})')
+
+
+def check_wide_dfa(seed: int = 0, classes: int = 20, messages: int = 5000,
+                   config: str = 'config/rules.yaml') -> str:
+    """Конфиг с classes классами событий: таблица переходов ленивая и совпадает с DFAEngine.step."""
+    with open(config, 'r', encoding='utf-8') as f:
+        raw = yaml.safe_load(f)
+    states = raw['dfa']['states']
+    extra = [f'WIDE{i}' for i in range(classes)]
+    raw['triggers'] += [{'name': e, 'description': e, 'pattern': rf'\bслово{i}\b', 'flags': [],
+                         'event': e, 'weight': 1}
+                        for i, e in enumerate(extra)]
+    raw['dfa']['priority'][0] += extra
+    # у каждого события свой переход — и свой класс
+    raw['dfa']['transitions'] = [{'from': states[i % len(states)], 'when_any_of': [e],
+                                  'to': states[(i + 1) % len(states)]}
+                                 for i, e in enumerate(extra)] + raw['dfa']['transitions']
+    t0 = time.perf_counter()
+    bundle = RulesBundle(Config.from_dict(raw))
+    load = time.perf_counter() - t0
+    table = bundle.table
+    assert table.num_classes >= classes, table.num_classes
+    assert isinstance(table.table, dict), type(table.table)
+    rnd = random.Random(seed)
+    events = list(bundle.event_bits)
+    sid, count = table.state_id[bundle.cfg.dfa_start], 0
+    for _ in range(messages):
+        evs = set(rnd.sample(events, rnd.randrange(4)))
+        emask = 0
+        for e in evs:
+            emask |= bundle.event_bits[e]
+        want = bundle.dfa.step(table.states[sid], evs)
+        nsid, count = table.step(sid, count, emask)
+        # остывание может увести дальше DFA только без событий
+        assert evs == set() or table.states[nsid] == want, (table.states[sid], evs)
+        sid = nsid
+    assert len(table.table) <= messages
+    return (f'wide_dfa: {table.num_classes} классов событий, сборка {1000 * load:.0f} мс, '
+            f'заполнено {len(table.table)} переходов из {len(table.states) * table.width << table.num_classes}')
+
+
+def check_edit_cost(seed: int = 0, sizes: Tuple[int, ...] = (100, 1000, 5000), every: int = 16,
+                    config: str = 'config/rules.yaml') -> str:
+    """Сколько шагов трогает правка при растущей длине чата: не больше пары интервалов точек."""
+    bundle = load_bundle(config)
+    gen = ChatGenerator(bundle.cfg, seed=seed)
+    touched = []
+    append, splice = StepHistory.append, StepHistory.splice
+    count = [0]
+
+    # шаг «тронут», если его перепрогнали или записали в историю чата
+    def counted_append(self, mask: int, sid: int) -> None:
+        count[0] += 1
+        append(self, mask, sid)
+
+    def counted_splice(self, tail: int, old: int, steps: List[Tuple[int, int]]) -> None:
+        count[0] += len(steps)
+        splice(self, tail, old, steps)
+
+    for size in sizes:
+        engine = RulesEngine(bundle, edit_window=max(sizes), checkpoint_every=every)
+        for mid in range(size):
+            engine.process_message('c', gen.message()[1], hints=False, msg_id=mid)
+        StepHistory.append, StepHistory.splice = counted_append, counted_splice
+        try:
+            r1 = engine.edit_message('c', size - every - 3, gen.message()[1])
+            r2 = engine.delete_messages('c', [size - 2 * every - 5])
+        finally:
+            StepHistory.append, StepHistory.splice = append, splice
+        steps = count[0] + (r1 or {}).get('replayed', 0) + (r2 or {}).get('replayed', 0)
+        count[0] = 0
+        assert steps <= 8 * every, f'{size} сообщений: правка и удаление тронули {steps} шагов'
+        touched.append(steps)
+    return 'edit_cost: шагов на правку и удаление — ' + ', '.join(f'{n} сообщ.: {t}' for n, t in zip(sizes, touched))
+
+
+CHECKS = {'dispatch': check_dispatch_cancel, 'engine': check_engine_stress, 'wide_dfa': check_wide_dfa,
+          'edit_cost': check_edit_cost}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Воспроизводимые проверки движка")
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--only', default=None, help='Только эти проверки через запятую: ' + ','.join(CHECKS))
+    args = ap.parse_args(argv)
+    names = args.only.split(',') if args.only else list(CHECKS)
+    for name in names:
+        print(CHECKS[name](seed=args.seed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
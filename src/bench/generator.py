@@ -0,0 +1,177 @@
+from __future__ import annotations
+import random
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from src.core.config import Config
+from src.core.triggers import TriggerMatcher
+
+try:
+    from re import _parser as sre_parse, _constants as sre_c
+except ImportError:  # Python < 3.11
+    import sre_parse, sre_constants as sre_c
+
+# Нейтральные реплики и вводные слова; те, в которых найдётся какой-нибудь
+# триггер, при сборке генератора отбрасываются.
+NEUTRAL = [
+    "завтра созвон в десять",
+    "отправил файл на почту",
+    "посмотри отчёт, там новые цифры",
+    "во сколько встречаемся",
+    "я на месте через полчаса",
+    "в пятницу будет релиз",
+    "нужно обновить таблицу до вечера",
+    "клиент просил перенести звонок",
+    "скинь ссылку на документ",
+    "задача в трекере уже есть",
+    "сегодня работаю из дома",
+    "проверю после обеда",
+    "бюджет согласуем на следующей неделе",
+    "в чате уже обсуждали этот вопрос",
+    "поставил встречу в календарь",
+    "поезд задерживается на двадцать минут",
+]
+
+_FILLER = ["слушай", "короче", "в общем", "так", "смотри", "ну", "вот"]
+
+# доли реплик по умолчанию; ключи — группы из labels в rules.yaml
+DEFAULT_MIX = {'NEG_STRONG': 0.1, 'NEG_MILD': 0.15, 'POSITIVE': 0.2, 'NEUTRAL': 0.55}
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _sample(items, rnd: random.Random) -> str:
+    out = []
+    for op, av in items:
+        if op is sre_c.LITERAL:
+            out.append(chr(av))
+        elif op is sre_c.NOT_LITERAL:
+            out.append('ж' if chr(av) != 'ж' else 'з')
+        elif op is sre_c.ANY:
+            out.append('а')
+        elif op is sre_c.AT:
+            continue
+        elif op is sre_c.IN:
+            out.append(_sample_in(av, rnd))
+        elif op is sre_c.CATEGORY:
+            out.append(_sample_category(av))
+        elif op is sre_c.BRANCH:
+            out.append(_sample(rnd.choice(av[1]), rnd))
+        elif op is sre_c.SUBPATTERN:
+            out.append(_sample(av[-1], rnd))
+        elif op in (sre_c.MAX_REPEAT, sre_c.MIN_REPEAT):
+            lo, hi, sub = av
+            n = lo + rnd.randint(0, min(hi - lo, 1))
+            out.extend(_sample(sub, rnd) for _ in range(n))
+        else:
+            raise _Unsupported(op)
+    return ''.join(out)
+
+
+def _sample_in(av, rnd: random.Random) -> str:
+    if av and av[0][0] is sre_c.NEGATE:
+        return 'ж'
+    op, a = rnd.choice(av)
+    if op is sre_c.LITERAL:
+        return chr(a)
+    if op is sre_c.RANGE:
+        return chr(rnd.randint(a[0], a[1]))
+    if op is sre_c.CATEGORY:
+        return _sample_category(a)
+    raise _Unsupported(op)
+
+
+def _sample_category(cat) -> str:
+    if cat is sre_c.CATEGORY_SPACE:
+        return ' '
+    if cat is sre_c.CATEGORY_DIGIT:
+        return '1'
+    if cat is sre_c.CATEGORY_WORD:
+        return 'а'
+    if cat in (sre_c.CATEGORY_NOT_WORD, sre_c.CATEGORY_NOT_DIGIT):
+        return ' '
+    raise _Unsupported(cat)
+
+
+def phrases_for(pat: re.Pattern, rnd: random.Random, count: int = 64, tries: int = 400) -> List[str]:
+    """До count разных строк, на которых шаблон срабатывает (проверяется search)."""
+    tree = sre_parse.parse(pat.pattern, pat.flags)
+    found = set()
+    for _ in range(tries):
+        if len(found) >= count:
+            break
+        try:
+            s = _sample(list(tree), rnd)
+        except _Unsupported:
+            break
+        s = ' '.join(s.split())
+        if s and pat.search(f" {s} "):
+            found.add(s)
+    return sorted(found)
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """'NEG_STRONG=0.2,NEUTRAL=0.8' -> доли; незаданные группы — 0."""
+    mix = {}
+    for part in spec.split(','):
+        if part.strip():
+            k, v = part.split('=')
+            mix[k.strip().upper()] = float(v)
+    return mix
+
+
+class ChatGenerator:
+    """Синтетические реплики из словаря триггеров конфига.
+
+    Для каждого события шаблон триггера разворачивается в набор подходящих
+    фраз; реплика группы (NEG_STRONG, NEG_MILD, POSITIVE из labels или
+    NEUTRAL) — нейтральная фраза с вставленной фразой одного из событий
+    группы. Детерминирован при заданном seed.
+    """
+
+    def __init__(self, cfg: Config, mix: Optional[Dict[str, float]] = None, seed: int = 0):
+        self.rnd = random.Random(seed)
+        matcher = TriggerMatcher(cfg)
+        self.neutral = [s for s in NEUTRAL if not matcher.extract(s)]
+        self.fillers = [s for s in _FILLER if not matcher.extract(f"{s}, {self.neutral[0]}")]
+        by_event: Dict[str, List[str]] = {}
+        for tr, pat in matcher.compiled:
+            by_event.setdefault(tr.event, []).extend(phrases_for(pat, self.rnd))
+        self.groups: Dict[str, List[str]] = {}
+        for label, events in cfg.labels.items():
+            phrases = [p for e in events for p in by_event.get(e, [])]
+            if phrases:
+                self.groups[label] = phrases
+        mix = mix or DEFAULT_MIX
+        self.kinds: List[str] = []
+        self.weights: List[float] = []
+        for kind, w in mix.items():
+            if w <= 0:
+                continue
+            if kind != 'NEUTRAL' and kind not in self.groups:
+                raise ValueError(f"Нет фраз для группы {kind}; есть: {sorted(self.groups)}")
+            self.kinds.append(kind)
+            self.weights.append(w)
+        if not self.kinds:
+            raise ValueError("Пустая смесь реплик")
+
+    def message(self) -> Tuple[str, str]:
+        """(группа, текст) очередной реплики."""
+        kind = self.rnd.choices(self.kinds, self.weights)[0]
+        base = self.rnd.choice(self.neutral)
+        if kind == 'NEUTRAL':
+            if self.fillers and self.rnd.random() < 0.3:
+                base = f"{self.rnd.choice(self.fillers)}, {base}"
+            return kind, base
+        phrase = self.rnd.choice(self.groups[kind])
+        return kind, f"{phrase}, {base}" if self.rnd.random() < 0.5 else f"{base}, {phrase}"
+
+    def messages(self, n: int) -> List[str]:
+        return [self.message()[1] for _ in range(n)]
+
+    def stream(self, chats: int, n: int) -> Iterator[Tuple[str, str]]:
+        """n реплик (chat_id, текст), разбросанных по chats чатам."""
+        for _ in range(n):
+            yield f"chat{self.rnd.randrange(chats)}", self.message()[1]
@@ -0,0 +1,223 @@
+from __future__ import annotations
+import argparse
+import json
+import platform
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from src.bench.generator import ChatGenerator, DEFAULT_MIX, parse_mix
+from src.core.bundle import load_bundle
+from src.core.engine import RulesEngine
+from src.core import ltlf
+from src.core.ltlf import build_trace_from_steps, eval_formula
+
+HISTORY_SIZES = [10, 100, 1000, 10000, 100000]
+CHAT_COUNTS = [1, 10, 100, 1000, 10000, 100000]
+
+
+def _best(fn: Callable[[], int], repeat: int) -> float:
+    """Лучшее из repeat время вызова fn (секунды)."""
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _row(name: str, params: Dict[str, Any], ops: int, seconds: float) -> Dict[str, Any]:
+    return {'name': name, 'params': params, 'ops': ops, 'seconds': round(seconds, 6),
+            'us_per_op': round(1e6 * seconds / ops, 3) if ops else None}
+
+
+def bench_micro(bundle, gen: ChatGenerator, n: int, repeat: int) -> List[Dict[str, Any]]:
+    texts = gen.messages(n)
+    matcher, dfa, table = bundle.triggers, bundle.dfa, bundle.table
+    events = [matcher.extract(t) for t in texts]
+    emasks = []
+    for ev in events:
+        m = 0
+        for e in ev:
+            m |= bundle.event_bits.get(e, 0)
+        emasks.append(m)
+
+    def extract():
+        for t in texts:
+            matcher.extract(t)
+
+    def dfa_step():
+        st = dfa.start_state
+        for ev in events:
+            st = dfa.step(st, ev)
+
+    def table_step():
+        sid, cnt = table.state_id[dfa.start_state], 0
+        for m in emasks:
+            sid, cnt = table.step(sid, cnt, m)
+
+    return [_row('TriggerMatcher.extract', {}, n, _best(extract, repeat)),
+            _row('DFAEngine.step', {}, n, _best(dfa_step, repeat)),
+            _row('TransitionTable.step', {}, n, _best(table_step, repeat))]
+
+
+def bench_eval(bundle, gen: ChatGenerator, sizes: List[int], repeat: int,
+               budget: float) -> List[Dict[str, Any]]:
+    """eval_formula по всем правилам на трассах разной длины.
+
+    Трасса — события и состояния, которые движок выдал на синтетическом
+    чате. Размеры, следующие за тем, что не уложился в budget секунд,
+    пропускаются (eval_formula может быть квадратичной по длине). eval_dag —
+    то же по общему графу правил (FormulaDAG.evaluate). Если установлен numpy,
+    рядом замеряется eval_batch — значения во всех позициях.
+    """
+    eng = RulesEngine(bundle)
+    steps = []
+    for t in gen.messages(max(sizes)):
+        res = eng.process_message('bench', t, hints=False)
+        steps.append({'events': res['events'], 'state': res['state']})
+    full = build_trace_from_steps(steps, bundle.cfg.derived_preds)
+    nodes = [node for _, _, node, _ in bundle.ltlf_rules]
+    out = []
+    for size in sorted(sizes):
+        trace = full[:size]
+        if out and out[-1].get('seconds', 0) > budget:
+            out.append({'name': 'eval_formula', 'params': {'history': size}, 'skipped': True})
+            continue
+
+        def run():
+            for node in nodes:
+                eval_formula(node, trace)
+        out.append(_row('eval_formula', {'history': size}, size * len(nodes), _best(run, repeat)))
+    for size in sorted(sizes):
+        trace = full[:size]
+        out.append(_row('eval_dag', {'history': size}, size * len(nodes),
+                        _best(lambda: bundle.dag.evaluate(trace), repeat)))
+    if ltlf.np is not None:
+        for size in sorted(sizes):
+            trace = full[:size]
+            out.append(_row('eval_batch', {'history': size}, size * len(nodes),
+                            _best(lambda: ltlf.eval_batch(nodes, trace), repeat)))
+    return out
+
+
+def bench_history(bundle, gen: ChatGenerator, sizes: List[int], n: int) -> List[Dict[str, Any]]:
+    """process_message в одном чате после size сообщений истории."""
+    eng = RulesEngine(bundle)
+    seen = 0
+    out = []
+    for size in sorted(sizes):
+        for t in gen.messages(size - seen):
+            eng.process_message('bench', t, hints=False)
+        texts = gen.messages(n)
+        t0 = time.perf_counter()
+        for t in texts:
+            eng.process_message('bench', t, hints=False)
+        out.append(_row('RulesEngine.process_message', {'history': size}, n, time.perf_counter() - t0))
+        seen = size + n
+    return out
+
+
+def bench_chats(bundle, gen: ChatGenerator, counts: List[int], n: int) -> List[Dict[str, Any]]:
+    """process_message при counts живых чатах (каждый уже видел сообщение)."""
+    out = []
+    for count in sorted(counts):
+        eng = RulesEngine(bundle)
+        for i, t in enumerate(gen.messages(count)):
+            eng.process_message(f'chat{i}', t, hints=False)
+        stream = list(gen.stream(count, n))
+        t0 = time.perf_counter()
+        for cid, t in stream:
+            eng.process_message(cid, t, hints=False)
+        out.append(_row('RulesEngine.process_message', {'chats': count}, n, time.perf_counter() - t0))
+    return out
+
+
+def _key(row: Dict[str, Any]) -> str:
+    return row['name'] + json.dumps(row['params'], sort_keys=True)
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """Строки отчёта о регрессиях: замеры, ставшие медленнее на threshold и больше."""
+    base = {_key(r): r for r in baseline['results'] if r.get('us_per_op')}
+    bad = []
+    for r in current['results']:
+        b = base.get(_key(r))
+        if not b or not r.get('us_per_op'):
+            continue
+        ratio = r['us_per_op'] / b['us_per_op']
+        mark = 'РЕГРЕССИЯ' if ratio > 1 + threshold else ''
+        line = (f"{r['name']:<30} {json.dumps(r['params']):<22} {b['us_per_op']:>11.2f} "
+                f"{r['us_per_op']:>11.2f} мкс  x{ratio:.2f} {mark}")
+        print(line, file=sys.stderr)
+        if mark:
+            bad.append(line)
+    return bad
+
+
+def _sizes(s: str) -> List[int]:
+    return [int(x) for x in s.split(',') if x.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Замеры скорости движка на синтетических чатах")
+    ap.add_argument('--config', default='config/rules.yaml')
+    ap.add_argument('--out', default='-', help='Куда писать JSON с результатами ("-" — stdout)')
+    ap.add_argument('--mix', default=None,
+                    help='Доли реплик по группам, например NEG_STRONG=0.1,NEG_MILD=0.15,POSITIVE=0.2,NEUTRAL=0.55')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--messages', type=int, default=2000, help='Сколько сообщений в каждом замере')
+    ap.add_argument('--repeat', type=int, default=3, help='Повторов микрозамеров (берётся лучший)')
+    ap.add_argument('--history', type=_sizes, default=HISTORY_SIZES, help='Длины истории через запятую')
+    ap.add_argument('--chats', type=_sizes, default=CHAT_COUNTS, help='Числа чатов через запятую')
+    ap.add_argument('--eval-budget', type=float, default=10.0,
+                    help='После замера eval_formula дольше стольких секунд большие размеры пропускаются')
+    ap.add_argument('--only', default=None, help='Только эти группы: micro,eval,history,chats')
+    ap.add_argument('--compare', default=None, help='Сравнить с сохранённым JSON и найти регрессии')
+    ap.add_argument('--results', default=None, help='Не замерять, а сравнить этот JSON с --compare')
+    ap.add_argument('--threshold', type=float, default=0.25, help='Допустимое замедление (0.25 = 25%%)')
+    args = ap.parse_args(argv)
+
+    if args.results:
+        with open(args.results, encoding='utf-8') as f:
+            current = json.load(f)
+    else:
+        bundle = load_bundle(args.config)
+        mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+        gen = ChatGenerator(bundle.cfg, mix, seed=args.seed)
+        only = set(args.only.split(',')) if args.only else {'micro', 'eval', 'history', 'chats'}
+        results: List[Dict[str, Any]] = []
+        if 'micro' in only:
+            results += bench_micro(bundle, gen, args.messages, args.repeat)
+        if 'eval' in only:
+            results += bench_eval(bundle, gen, args.history, args.repeat, args.eval_budget)
+        if 'history' in only:
+            results += bench_history(bundle, gen, args.history, args.messages)
+        if 'chats' in only:
+            results += bench_chats(bundle, gen, args.chats, args.messages)
+        current = {
+            'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                     'config': args.config, 'rules_digest': bundle.digest, 'mix': mix, 'seed': args.seed,
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results,
+        }
+        text = json.dumps(current, ensure_ascii=False, indent=2)
+        if args.out == '-':
+            print(text)
+        else:
+            with open(args.out, 'w', encoding='utf-8') as f:
+                f.write(text + "\n")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        bad = compare(baseline, current, args.threshold)
+        if bad:
+            print(f"Регрессий: {len(bad)} (порог {args.threshold:.0%})", file=sys.stderr)
+            return 1
+        print("Регрессий нет", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+from __future__ import annotations
+import json
+import sys
+import time
+from collections import deque
+from typing import Any, Dict, IO, Iterator, Optional, Tuple
+
+from src.core.bundle import load_bundle
+from src.core.engine import RulesEngine
+from src.core.metrics import STAGES, Metrics, merge, snapshot_quantile
+from src.core.persistence import SQLiteBackend, WriteBehind
+from src.core.shards import ShardedEngine
+
+Record = Tuple[str, Any, str, Optional[str]]
+
+
+class BatchStats:
+    """Счётчики пакетного прогона: сколько сообщений и где ушло время.
+
+    *_wall — настенное время цикла прогона по фазам; этапы самого движка
+    (STAGES) — из Metrics, для пула сложенные по всем шардам.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.bad = 0
+        self.chats = set()
+        self.started = time.perf_counter()
+        self.read_wall = 0.0    # чтение и разбор JSONL
+        self.engine_wall = 0.0  # вызов движка (для пула — отправка и ожидание ответов)
+        self.write_wall = 0.0   # сериализация и запись результатов
+        self.stages: Optional[Dict[str, Any]] = None  # Metrics.snapshot()
+
+    def summary(self) -> str:
+        total = time.perf_counter() - self.started
+        rate = self.messages / total if total > 0 else 0.0
+        lines = [f"Обработано {self.messages} сообщ. из {len(self.chats)} чатов за {total:.2f} с "
+                 f"({rate:.0f} сообщ./с)"]
+        if self.bad:
+            lines.append(f"Пропущено некорректных строк: {self.bad}")
+        lines.append("Фазы цикла (настенное время):")
+        for name in ('read_wall', 'engine_wall', 'write_wall'):
+            t = getattr(self, name)
+            per = 1e6 * t / self.messages if self.messages else 0.0
+            lines.append(f"  {name:<12}{t:8.2f} с  {per:8.1f} мкс/сообщ.  {100 * t / total if total else 0:5.1f}%")
+        if self.stages and self.stages['stages']:
+            lines.append("Этапы движка (сумма по шардам, p99 — верхняя граница корзины):")
+            for name in STAGES:
+                h = self.stages['stages'].get(name)
+                if not h:
+                    continue
+                per = 1e6 * h['sum'] / h['count']
+                p99 = 1e6 * snapshot_quantile(self.stages, name, 0.99)
+                lines.append(f"  {name:<12}{h['sum']:8.2f} с  {per:8.1f} мкс/сообщ.  p99 ≤ {p99:g} мкс")
+        return "\n".join(lines)
+
+
+def parse_record(line: str) -> Record:
+    """Разбирает строку JSONL {chat_id, ts, text[, user]}.
+
+    Ошибки формата — ValueError, KeyError или TypeError.
+    """
+    rec = json.loads(line)
+    text = rec['text']
+    if not isinstance(text, str):
+        raise ValueError("text не строка")
+    return str(rec['chat_id']), rec.get('ts'), text, rec.get('user')
+
+
+def iter_records(f: IO[str], stats: BatchStats) -> Iterator[Record]:
+    """Лениво читает JSONL; битые строки пропускает."""
+    t0 = time.perf_counter()
+    for n, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = parse_record(line)
+        except (ValueError, KeyError, TypeError) as e:
+            stats.bad += 1
+            print(f"строка {n}: {e!r}", file=sys.stderr)
+            continue
+        stats.read_wall += time.perf_counter() - t0
+        yield item
+        t0 = time.perf_counter()
+    stats.read_wall += time.perf_counter() - t0
+
+
+def _result(rec: Record, res: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'chat_id': rec[0],
+        'ts': rec[1],
+        'state': res['state'],
+        'risk': res['risk'],
+        'events': res['events'],
+        'violations': [r['id'] for r in res['ltlf'] if not r['ok']],
+    }
+
+
+def _emit(out: IO[str], rec: Record, res: Dict[str, Any], stats: BatchStats) -> None:
+    t0 = time.perf_counter()
+    out.write(json.dumps(_result(rec, res), ensure_ascii=False))
+    out.write("\n")
+    stats.messages += 1
+    stats.chats.add(rec[0])
+    stats.write_wall += time.perf_counter() - t0
+
+
+def run_batch(cfg_path: str, inp: IO[str], out: IO[str], workers: int = 1,
+              max_chats: Optional[int] = None, state_db: Optional[str] = None) -> BatchStats:
+    """Прогоняет JSONL через движок и пишет результаты в том же порядке.
+
+    workers > 1 — чаты раскладываются по процессам ShardedEngine (по
+    crc32(chat_id)), так что сообщения одного чата идут по порядку, а разные
+    чаты считаются параллельно. Подсказки в пакетном режиме не считаются.
+    """
+    stats = BatchStats()
+    bundle = load_bundle(cfg_path)
+    # разбивка по триггерам и правилам в сводке не нужна — detail_every большой
+    engine_kwargs = {'max_chats': max_chats, 'metrics': Metrics(detail_every=1 << 30)}
+
+    if workers <= 1:
+        persistence = WriteBehind(SQLiteBackend(state_db)) if state_db else None
+        engine = RulesEngine(bundle, persistence=persistence, **engine_kwargs)
+        try:
+            for rec in iter_records(inp, stats):
+                t0 = time.perf_counter()
+                res = engine.process_message(rec[0], rec[2], user=rec[3], hints=False)
+                stats.engine_wall += time.perf_counter() - t0
+                _emit(out, rec, res, stats)
+            stats.stages = engine.metrics_snapshot()
+        finally:
+            engine.close()
+        return stats
+
+    pool = ShardedEngine(cfg_path, workers, engine_kwargs, state_db, bundle=bundle)
+    pending: deque = deque()
+    try:
+        for rec in iter_records(inp, stats):
+            t0 = time.perf_counter()
+            pending.append((rec, pool.submit(rec[0], rec[2], rec[3], hints=False)))
+            stats.engine_wall += time.perf_counter() - t0
+            # пишем готовые ответы, не нарушая порядок входа; сколько их
+            # накапливается, ограничивает backpressure шардов
+            while pending and pending[0][1].done():
+                r, fut = pending.popleft()
+                _emit(out, r, fut.result(), stats)
+        while pending:
+            r, fut = pending.popleft()
+            t0 = time.perf_counter()
+            res = fut.result()
+            stats.engine_wall += time.perf_counter() - t0
+            _emit(out, r, res, stats)
+        stats.stages = merge(pool.call_all('metrics_snapshot'))
+    finally:
+        pool.shutdown()
+    return stats
@@ -0,0 +1,169 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, IO, Optional, Set
+
+from src.cli.batch import parse_record
+from src.core.bundle import load_bundle
+from src.core.engine import RulesEngine
+from src.core.persistence import SQLiteBackend, WriteBehind
+
+log = logging.getLogger(__name__)
+
+
+class Checkpoint:
+    """Позиция в файле (offset и inode); пишется атомарно (tmp + rename).
+
+    Состояние чатов здесь не хранится: оно живёт в SQLite движка
+    (WriteBehind), и перед записью позиции движок сбрасывает туда только
+    изменённые чаты и ждёт, пока они лягут на диск. В снимке чата есть
+    позиция его последнего сообщения (source_pos), поэтому после перезапуска
+    строки, уже учтённые в сохранённом состоянии, пропускаются, а остальные
+    обрабатываются повторно — события о нарушениях доставляются «хотя бы
+    один раз».
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.offset = 0
+        self.inode: Optional[int] = None
+
+    def load(self) -> bool:
+        if not self.path or not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.offset = data['offset']
+        self.inode = data['inode']
+        return True
+
+    def save(self, engine: RulesEngine) -> bool:
+        if not self.path:
+            return False
+        engine.flush()
+        if engine.persistence is not None and not engine.persistence.sync():
+            log.warning("Состояние чатов не записано — позиция %d не сохранена", self.offset)
+            return False
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'offset': self.offset, 'inode': self.inode}, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return True
+
+
+def run_follow(cfg_path: str, path: str, out: IO[str], checkpoint: Optional[str] = None,
+               poll: float = 0.05, every: int = 1000, interval: float = 5.0,
+               stop: Optional[threading.Event] = None, max_chats: Optional[int] = None,
+               idle_ttl: Optional[float] = None, state_db: Optional[str] = None) -> int:
+    """Следит за растущим JSONL-файлом и обрабатывает только новые строки.
+
+    Для каждого правила LTLf, которое в чате перешло из «выполнено» в
+    «нарушено», в out пишется событие {"event": "violation", ...}. Контрольная
+    точка сохраняется каждые every сообщений или interval секунд и при
+    остановке. Усечение или подмена файла (ротация) — чтение с начала нового
+    файла; состояние чатов при этом сохраняется.
+
+    В памяти держится не больше max_chats чатов, молчащие дольше idle_ttl
+    секунд вытесняются в state_db. Без state_db, но с контрольной точкой
+    чаты хранятся рядом с ней, в <checkpoint>.db. Вытеснение без state_db
+    и контрольной точки — ValueError: вытесненные чаты было бы негде хранить.
+    """
+    stop = stop or threading.Event()
+    if state_db is None and checkpoint:
+        state_db = checkpoint + '.db'
+    if state_db is None and (max_chats is not None or idle_ttl is not None):
+        raise ValueError("Для --max-chats и --idle-ttl нужен --state-db или --checkpoint: "
+                         "иначе вытесненные чаты теряются")
+    persistence = WriteBehind(SQLiteBackend(state_db)) if state_db else None
+    engine = RulesEngine(load_bundle(cfg_path), max_chats=max_chats, idle_ttl=idle_ttl,
+                         persistence=persistence)
+    cp = Checkpoint(checkpoint)
+    if cp.load():
+        log.info("Продолжаю с позиции %d", cp.offset)
+
+    processed = 0
+    since_cp = 0
+    last_cp = time.monotonic()
+    f = None
+    try:
+        while not stop.is_set():
+            if f is None:
+                try:
+                    f = open(path, 'rb')
+                except FileNotFoundError:
+                    stop.wait(poll)
+                    continue
+                inode = os.fstat(f.fileno()).st_ino
+                if cp.inode != inode or os.fstat(f.fileno()).st_size < cp.offset:
+                    if cp.inode is not None:
+                        log.info("Файл %s сменился, читаю с начала", path)
+                    cp.inode, cp.offset = inode, 0
+                f.seek(cp.offset)
+
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                # конец файла или недописанная строка: ждём продолжения
+                f.seek(cp.offset)
+                if since_cp and time.monotonic() - last_cp >= interval:
+                    cp.save(engine)
+                    since_cp, last_cp = 0, time.monotonic()
+                try:
+                    st = os.stat(path)
+                    rotated = st.st_ino != cp.inode or st.st_size < cp.offset
+                except FileNotFoundError:
+                    rotated = False
+                if rotated:
+                    f.close()
+                    f = None
+                    continue
+                stop.wait(poll)
+                continue
+
+            cp.offset += len(line)
+            text = line.decode('utf-8', errors='replace').strip()
+            if text:
+                try:
+                    chat_id, ts, msg, user = parse_record(text)
+                except (ValueError, KeyError, TypeError) as e:
+                    log.warning("Пропускаю строку на позиции %d: %r", cp.offset - len(line), e)
+                else:
+                    pos = (cp.inode, cp.offset)
+                    last, was = engine.position(chat_id)
+                    # после перезапуска: строка уже учтена в сохранённом состоянии чата
+                    if last is None or last[0] != pos[0] or last[1] < pos[1]:
+                        res = engine.process_message(chat_id, msg, user=user, hints=False, source_pos=pos)
+                        _emit_violations(out, cp, chat_id, ts, was, res)
+                        processed += 1
+                        since_cp += 1
+            if since_cp >= every or (since_cp and time.monotonic() - last_cp >= interval):
+                cp.save(engine)
+                since_cp, last_cp = 0, time.monotonic()
+    finally:
+        if f is not None:
+            f.close()
+        cp.save(engine)
+        engine.close()
+    return processed
+
+
+def _emit_violations(out: IO[str], cp: Checkpoint, chat_id: str, ts: Any, was: Set[str],
+                     res: Dict[str, Any]) -> None:
+    new = {r['id'] for r in res['ltlf'] if not r['ok']} - was
+    if not new:
+        return
+    for r in res['ltlf']:
+        if r['id'] in new:
+            out.write(json.dumps({'event': 'violation', 'chat_id': chat_id, 'ts': ts, 'rule': r['id'],
+                                  'description': r['description'], 'state': res['state'],
+                                  'risk': res['risk'], 'offset': cp.offset}, ensure_ascii=False))
+            out.write("\n")
+    out.flush()
@@ -1,6 +1,8 @@
 from __future__ import annotations
-import argparse, sys
-from src.core.config import Config
+import argparse, logging, signal, sys, threading
+from src.cli.batch import run_batch
+from src.cli.follow import run_follow
+from src.core.bundle import load_bundle
 from src.core.engine import RulesEngine
 from src.core.hints import pick_hints
 
@@ -8,10 +10,27 @@ from src.core.hints import pick_hints
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument('--config', required=True)
-    ap.add_argument('--transcript', required=True, help='Путь к текстовому файлу, по строке на сообщение')
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument('--transcript', help='Путь к текстовому файлу, по строке на сообщение')
+    src.add_argument('--input', help='Пакетный режим: JSONL {chat_id, ts, text} ("-" — stdin)')
+    src.add_argument('--follow', help='Следить за растущим JSONL-файлом и выводить новые нарушения')
+    ap.add_argument('--output', default='-', help='Куда писать JSONL с результатами ("-" — stdout)')
+    ap.add_argument('--workers', type=int, default=1, help='Число процессов для пакетного режима')
+    ap.add_argument('--max-chats', type=int, default=None, help='Сколько чатов держать в памяти')
+    ap.add_argument('--state-db', default=None, help='SQLite для вытесненных чатов')
+    ap.add_argument('--idle-ttl', type=float, default=None,
+                    help='Вытеснять из памяти чаты, молчащие дольше стольких секунд (--follow)')
+    ap.add_argument('--checkpoint', default=None, help='Файл контрольной точки для --follow')
+    ap.add_argument('--poll', type=float, default=0.05, help='Пауза опроса файла в --follow, с')
     args = ap.parse_args()
-    cfg = Config.from_yaml(args.config)
-    eng = RulesEngine(cfg)
+    evicts = args.max_chats is not None or args.idle_ttl is not None
+    if args.follow and evicts and not (args.state_db or args.checkpoint):
+        ap.error('--max-chats и --idle-ttl в --follow требуют --state-db или --checkpoint')
+    if args.input:
+        return batch_main(args)
+    if args.follow:
+        return follow_main(args)
+    eng = RulesEngine(load_bundle(args.config))
 
     with open(args.transcript, 'r', encoding='utf-8') as f:
         lines = [ln.strip() for ln in f if ln.strip()]
@@ -30,5 +49,34 @@ def main():
         print()
 
 
+def batch_main(args):
+    inp = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        stats = run_batch(args.config, inp, out, workers=args.workers,
+                          max_chats=args.max_chats, state_db=args.state_db)
+    finally:
+        if inp is not sys.stdin:
+            inp.close()
+        if out is not sys.stdout:
+            out.close()
+    print(stats.summary(), file=sys.stderr)
+
+
+def follow_main(args):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    out = sys.stdout if args.output == '-' else open(args.output, 'a', encoding='utf-8')
+    try:
+        run_follow(args.config, args.follow, out, checkpoint=args.checkpoint, poll=args.poll, stop=stop,
+                   max_chats=args.max_chats, idle_ttl=args.idle_ttl, state_db=args.state_db)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,312 @@
+from __future__ import annotations
+import argparse
+import json
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, IO, List, Optional, Tuple
+
+from src.cli.batch import BatchStats, iter_records
+from src.core.archive import TraceArchive, write_archive
+from src.core.bundle import RulesBundle, load_bundle
+from src.core.ltlf import LTLfMonitor, MaskPreds
+from src.core.risk import RiskMeter
+
+# сколько примеров chat_id показывать на правило в каждом направлении
+SAMPLES = 5
+
+
+def pack(cfg_path: str, inp: IO[str], path: str, stats: BatchStats) -> Tuple[int, int]:
+    """Извлекает события сообщений JSONL по правилам cfg_path и пишет архив трасс.
+
+    Сообщения группируются по чатам в порядке входа; состояние DFA — с учётом
+    остывания, как в движке.
+    """
+    b = load_bundle(cfg_path)
+    # биты событий в бандле идут первыми в ltlf_preds, так что маска пишется как есть
+    events = list(b.event_bits)
+    chats: Dict[str, List[Any]] = {}
+    start = b.table.state_id[b.cfg.dfa_start]
+    for rec in iter_records(inp, stats):
+        t0 = time.perf_counter()
+        ch = chats.get(rec[0])
+        if ch is None:
+            ch = chats[rec[0]] = [array('Q'), bytearray(), start, 0]
+        found = b.triggers.analyze(rec[2]).events
+        emask = 0
+        for e in found:
+            emask |= b.event_bits.get(e, 0)
+        ch[2], ch[3] = b.table.step(ch[2], ch[3], emask)
+        ch[0].append(emask)
+        ch[1].append(ch[2])
+        stats.engine += time.perf_counter() - t0
+        stats.messages += 1
+        stats.chats.add(rec[0])
+    t0 = time.perf_counter()
+    res = write_archive(path, events, list(b.table.states), ((cid, ch[0], ch[1]) for cid, ch in chats.items()))
+    stats.write += time.perf_counter() - t0
+    return res
+
+
+def _to_bundle(emask: int, events: List[str], b: RulesBundle) -> int:
+    out = 0
+    while emask:
+        low = emask & -emask
+        out |= b.event_bits.get(events[low.bit_length() - 1], 0)
+        emask ^= low
+    return out
+
+
+class _Replayer:
+    """Прогон чатов архива по одному бандлу: DFA с остыванием, риск, правила LTLf."""
+
+    def __init__(self, b: RulesBundle, arch: TraceArchive):
+        self.b = b
+        self.events = arch.events
+        # номер состояния архива -> номер в бандле (-1 — такого состояния нет)
+        self.sid_map = [b.table.state_id.get(s, -1) for s in arch.states]
+        self.masks: Dict[int, Tuple[int, set]] = {}
+
+    def _mask(self, emask: int) -> Tuple[int, set]:
+        r = self.masks.get(emask)
+        if r is None:
+            bm = _to_bundle(emask, self.events, self.b)
+            r = self.masks[emask] = (bm, {e for e, bit in self.b.event_bits.items() if bm & bit})
+        return r
+
+    def run(self, emasks: memoryview, sids: memoryview) -> Tuple[List[int], List[bool], int, int, int]:
+        """Возвращает (шагов с нарушением по правилам, нарушено ли правило в конце чата,
+        сумма риска, максимум, шагов с другим состоянием)."""
+        b = self.b
+        table = b.table
+        sid, count = table.state_id[b.cfg.dfa_start], 0
+        meter = RiskMeter(b.cfg, b.triggers)
+        rules = [(dfa, dfa.start if dfa is not None else LTLfMonitor(node)) for _, _, node, dfa in b.ltlf_rules]
+        states = [st for _, st in rules]
+        viol = [0] * len(rules)
+        final = [False] * len(rules)
+        risk_sum = risk_max = moved = 0
+        for emask, ref in zip(emasks, sids):
+            bm, names = self._mask(emask)
+            sid, count = table.step(sid, count, bm)
+            if self.sid_map[ref] != sid:
+                moved += 1
+            risk = meter.update(table.states[sid], names)
+            risk_sum += risk
+            if risk > risk_max:
+                risk_max = risk
+            pmask = b.pred_mask(bm, sid)
+            for k, (dfa, _) in enumerate(rules):
+                if dfa is not None:
+                    q = states[k] = dfa.table[states[k]][pmask & dfa.mask]
+                    ok = dfa.accepting[q]
+                else:
+                    ok = states[k].step(MaskPreds(pmask, b.pred_bits))
+                if not ok:
+                    viol[k] += 1
+                final[k] = not ok
+        return viol, final, risk_sum, risk_max, moved
+
+
+# состояние процесса пула: архив и бандлы открываются один раз на процесс
+_worker: Dict[str, Any] = {}
+
+
+def _init(path: str, base_path: str, cand_path: str) -> None:
+    arch = TraceArchive(path)
+    _worker['arch'] = arch
+    _worker['runs'] = [_Replayer(load_bundle(p), arch) for p in (base_path, cand_path)]
+
+
+def _totals(b: RulesBundle) -> Dict[str, Any]:
+    n = len(b.ltlf_rules)
+    return {'steps': 0, 'risk_sum': 0, 'risk_max': 0, 'state_diff': 0,
+            'viol_steps': [0] * n, 'viol_chats': [0] * n}
+
+
+def _scan(lo: int, hi: int) -> Dict[str, Any]:
+    """Чаты архива [lo, hi) по текущему и новому конфигу."""
+    arch = _worker['arch']
+    base, cand = _worker['runs']
+    pairs = _pairs(base.b, cand.b)
+    out = {'base': _totals(base.b), 'cand': _totals(cand.b),
+           'added': [[0, []] for _ in pairs], 'cleared': [[0, []] for _ in pairs]}
+    for i in range(lo, hi):
+        chat_id, emasks, sids = arch.chat(i)
+        flagged = []
+        for name, run in (('base', base), ('cand', cand)):
+            t = out[name]
+            viol, final, risk_sum, risk_max, moved = run.run(emasks, sids)
+            t['steps'] += len(emasks)
+            t['risk_sum'] += risk_sum
+            t['risk_max'] = max(t['risk_max'], risk_max)
+            t['state_diff'] += moved
+            for k, v in enumerate(viol):
+                t['viol_steps'][k] += v
+                t['viol_chats'][k] += final[k]
+            flagged.append(final)
+        for j, (_, bi, ci) in enumerate(pairs):
+            was, now = flagged[0][bi], flagged[1][ci]
+            if was != now:
+                d = out['added' if now else 'cleared'][j]
+                d[0] += 1
+                if len(d[1]) < SAMPLES:
+                    d[1].append(chat_id)
+        emasks.release()
+        sids.release()
+    return out
+
+
+def _pairs(base: RulesBundle, cand: RulesBundle) -> List[Tuple[str, int, int]]:
+    # правила сравниваются по id
+    where = {rid: i for i, (rid, _, _, _) in enumerate(base.ltlf_rules)}
+    return [(rid, where[rid], i) for i, (rid, _, _, _) in enumerate(cand.ltlf_rules) if rid in where]
+
+
+def _merge(acc: Dict[str, Any], part: Dict[str, Any]) -> None:
+    for name in ('base', 'cand'):
+        a, p = acc[name], part[name]
+        for key in ('steps', 'risk_sum', 'state_diff'):
+            a[key] += p[key]
+        a['risk_max'] = max(a['risk_max'], p['risk_max'])
+        for key in ('viol_steps', 'viol_chats'):
+            a[key] = [x + y for x, y in zip(a[key], p[key])]
+    for key in ('added', 'cleared'):
+        for a, p in zip(acc[key], part[key]):
+            a[0] += p[0]
+            a[1].extend(p[1][:SAMPLES - len(a[1])])
+
+
+def _ranges(arch: TraceArchive, parts: int) -> List[Tuple[int, int]]:
+    # границы по числу шагов, а не чатов: длинные чаты не собираются в одну задачу
+    per = max(1, arch.steps // max(1, parts))
+    out, lo = [], 0
+    for i in range(1, len(arch) + 1):
+        if arch.offsets[i] - arch.offsets[lo] >= per or i == len(arch):
+            out.append((lo, i))
+            lo = i
+    return out
+
+
+def replay(path: str, cand_path: str, base_path: str, workers: int = 1) -> Dict[str, Any]:
+    """Прогоняет архив по текущему (base_path) и новому (cand_path) конфигу.
+
+    События берутся из архива как есть: правка триггеров в новом конфиге
+    потребует заново собрать архив (pack) с ним. Чаты делятся на диапазоны
+    по числу шагов и считаются в пуле из workers процессов.
+    """
+    t0 = time.perf_counter()
+    base, cand = load_bundle(base_path), load_bundle(cand_path)
+    arch = TraceArchive(path)
+    try:
+        ranges = _ranges(arch, 8 * workers if workers > 1 else 1)
+        chats = len(arch)
+    finally:
+        arch.close()
+    pairs = _pairs(base, cand)
+    acc = {'base': _totals(base), 'cand': _totals(cand),
+           'added': [[0, []] for _ in pairs], 'cleared': [[0, []] for _ in pairs]}
+    if workers <= 1:
+        _init(path, base_path, cand_path)
+        try:
+            for lo, hi in ranges:
+                _merge(acc, _scan(lo, hi))
+        finally:
+            _worker.pop('arch').close()
+            _worker.clear()
+    else:
+        with ProcessPoolExecutor(workers, initializer=_init, initargs=(path, base_path, cand_path)) as pool:
+            for part in pool.map(_scan, *zip(*ranges)) if ranges else ():
+                _merge(acc, part)
+    return _report(acc, base, cand, pairs, chats, time.perf_counter() - t0)
+
+
+def _report(acc: Dict[str, Any], base: RulesBundle, cand: RulesBundle, pairs: List[Tuple[str, int, int]],
+            chats: int, elapsed: float) -> Dict[str, Any]:
+    def side(t: Dict[str, Any], b: RulesBundle) -> Dict[str, Any]:
+        steps = t['steps'] or 1
+        return {
+            'risk_mean': t['risk_sum'] / steps,
+            'risk_max': t['risk_max'],
+            'state_diff': t['state_diff'],
+            'rules': {rid: {'viol_steps': vs, 'viol_chats': vc, 'step_rate': vs / steps, 'chat_rate': vc / (chats or 1)}
+                      for (rid, _, _, _), vs, vc in zip(b.ltlf_rules, t['viol_steps'], t['viol_chats'])},
+        }
+    ids_base = [r[0] for r in base.ltlf_rules]
+    ids_cand = [r[0] for r in cand.ltlf_rules]
+    return {
+        'chats': chats,
+        'steps': acc['cand']['steps'],
+        'seconds': elapsed,
+        'base': side(acc['base'], base),
+        'cand': side(acc['cand'], cand),
+        'diff': {rid: {'added': a[0], 'cleared': c[0], 'added_sample': a[1], 'cleared_sample': c[1]}
+                 for (rid, _, _), a, c in zip(pairs, acc['added'], acc['cleared'])},
+        'only_base': [r for r in ids_base if r not in ids_cand],
+        'only_cand': [r for r in ids_cand if r not in ids_base],
+    }
+
+
+def format_report(rep: Dict[str, Any]) -> str:
+    steps = rep['steps'] or 1
+    base, cand = rep['base'], rep['cand']
+    w = max([len('правило')] + [len(rid) for rid in rep['diff']]) + 2
+    lines = [f"Архив: {rep['chats']} чатов, {rep['steps']} сообщ., прогон {rep['seconds']:.2f} с",
+             f"Риск: среднее {base['risk_mean']:.1f} -> {cand['risk_mean']:.1f}, "
+             f"максимум {base['risk_max']} -> {cand['risk_max']}",
+             f"Состояние DFA не как в архиве: {base['state_diff']} -> {cand['state_diff']} шагов "
+             f"({100 * cand['state_diff'] / steps:.1f}%)",
+             "",
+             f"{'правило':<{w}}{'шаги с нарушением, %':>24}{'чаты, нарушено в конце':>26}{'+чатов':>8}{'-чатов':>8}"]
+    for rid, d in rep['diff'].items():
+        b, c = base['rules'][rid], cand['rules'][rid]
+        lines.append(f"{rid:<{w}}{100 * b['step_rate']:>11.2f} -> {100 * c['step_rate']:<9.2f}"
+                     f"{b['viol_chats']:>14} -> {c['viol_chats']:<8}{d['added']:>8}{d['cleared']:>8}")
+        if d['added_sample']:
+            lines.append(f"    новые: {', '.join(d['added_sample'])}")
+        if d['cleared_sample']:
+            lines.append(f"    ушли:  {', '.join(d['cleared_sample'])}")
+    for key, title, side in (('only_cand', 'Только в новом конфиге', cand), ('only_base', 'Убраны из конфига', base)):
+        for rid in rep[key]:
+            r = side['rules'][rid]
+            lines.append(f"{title}: {rid} — нарушено в конце {r['viol_chats']} чатов, {100 * r['step_rate']:.2f}% шагов")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description='Архив трасс и проверка нового rules.yaml на нём')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('pack', help='Собрать архив трасс из JSONL {chat_id, ts, text}')
+    p.add_argument('--config', required=True, help='Конфиг, по которому извлекаются события')
+    p.add_argument('--input', required=True, help='JSONL с сообщениями ("-" — stdin)')
+    p.add_argument('--archive', required=True, help='Куда записать архив')
+    r = sub.add_parser('replay', help='Прогнать архив по новому конфигу и сравнить с текущим')
+    r.add_argument('--archive', required=True)
+    r.add_argument('--config', required=True, help='Новый rules.yaml')
+    r.add_argument('--baseline', default='config/rules.yaml', help='Текущий rules.yaml')
+    r.add_argument('--workers', type=int, default=1, help='Число процессов')
+    r.add_argument('--json', default=None, help='Записать отчёт в JSON')
+    args = ap.parse_args(argv)
+
+    if args.cmd == 'pack':
+        stats = BatchStats()
+        inp = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+        try:
+            chats, steps = pack(args.config, inp, args.archive, stats)
+        finally:
+            if inp is not sys.stdin:
+                inp.close()
+        print(stats.summary(), file=sys.stderr)
+        print(f"Архив {args.archive}: {chats} чатов, {steps} шагов", file=sys.stderr)
+        return
+
+    rep = replay(args.archive, args.config, args.baseline, workers=args.workers)
+    print(format_report(rep))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(rep, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+from __future__ import annotations
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from typing import Iterable, List, Tuple
+
+# Формат архива трасс (все числа — в порядке байтов из заголовка):
+#   b'DRTRACE1', длина заголовка (uint64), заголовок JSON с выравниванием до 8 байт
+#   emasks  uint64[steps]    — маски событий, бит i — events[i] из заголовка
+#   offsets uint64[chats+1]  — начало шагов каждого чата в emasks/sids
+#   sids    uint8[steps]     — номер состояния DFA после шага, states[...] из заголовка
+_MAGIC = b'DRTRACE1'
+
+
+def _pad(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def write_archive(path: str, events: List[str], states: List[str],
+                  chats: Iterable[Tuple[str, array, bytes]]) -> Tuple[int, int]:
+    """Пишет архив атомарно (через временный файл); возвращает (чатов, шагов).
+
+    chats — (chat_id, маски событий array('Q'), номера состояний) по чатам.
+    """
+    ids: List[str] = []
+    offsets = array('Q', [0])
+    emasks = array('Q')
+    sids = bytearray()
+    for chat_id, masks, states_of in chats:
+        ids.append(chat_id)
+        emasks.extend(masks)
+        sids.extend(states_of)
+        offsets.append(len(emasks))
+    header = json.dumps({'events': events, 'states': states, 'chats': ids, 'steps': len(emasks),
+                         'byteorder': sys.byteorder}, ensure_ascii=False).encode('utf-8')
+    header += b' ' * (_pad(len(header)) - len(header))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(emasks.tobytes())
+            f.write(offsets.tobytes())
+            f.write(sids)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(ids), len(emasks)
+
+
+class TraceArchive:
+    """Архив трасс, открытый через mmap.
+
+    Столбцы — memoryview поверх отображённого файла, chat(i) отдаёт срезы
+    без копирования, так что каждый процесс пула открывает архив сам и
+    читает только нужные ему чаты.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = self._buf = memoryview(self._map)
+        if bytes(buf[:8]) != _MAGIC:
+            raise ValueError(f'{path}: не архив трасс')
+        hlen, = struct.unpack_from('<Q', buf, 8)
+        meta = json.loads(bytes(buf[16:16 + hlen]).decode('utf-8'))
+        if meta['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path}: архив записан с порядком байтов {meta["byteorder"]}')
+        self.events: List[str] = meta['events']
+        self.states: List[str] = meta['states']
+        self.chat_ids: List[str] = meta['chats']
+        self.steps: int = meta['steps']
+        pos = 16 + hlen
+        self.emasks = buf[pos:pos + 8 * self.steps].cast('Q')
+        pos += 8 * self.steps
+        self.offsets = buf[pos:pos + 8 * (len(self.chat_ids) + 1)].cast('Q')
+        pos += 8 * (len(self.chat_ids) + 1)
+        self.sids = buf[pos:pos + self.steps]
+
+    def __len__(self) -> int:
+        return len(self.chat_ids)
+
+    def chat(self, i: int) -> Tuple[str, memoryview, memoryview]:
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return self.chat_ids[i], self.emasks[lo:hi], self.sids[lo:hi]
+
+    def close(self) -> None:
+        for mv in (self.emasks, self.offsets, self.sids, self._buf):
+            mv.release()
+        self._map.close()
@@ -0,0 +1,195 @@
+from __future__ import annotations
+import hashlib
+import logging
+import os
+import pickle
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import yaml
+
+from .config import Config
+from .triggers import TriggerMatcher
+from .dfa import DFAEngine, TransitionTable
+from .history import StepHistory
+from .ltlf import FormulaDAG, parse_formula, temporal_depth
+
+log = logging.getLogger(__name__)
+
+# модули, от которых зависит содержимое бандла: их правка сбрасывает кэш
+_SOURCES = ('config.py', 'triggers.py', 'dfa.py', 'ltlf.py', 'bundle.py')
+
+
+class RulesBundle:
+    """Всё, что движок выводит из конфига и что не зависит от чатов.
+
+    Бандл неизменяем после сборки: горячая перезагрузка подменяет его
+    целиком (RulesEngine.swap_bundle), а не правит по месту.
+    """
+
+    def __init__(self, cfg: Config, digest: str = ''):
+        self.digest = digest
+        self.cfg = cfg
+        self.triggers = TriggerMatcher(cfg)
+        self.dfa = DFAEngine(cfg)
+        # формулы правил — корни общего графа: одинаковые подформулы не дублируются
+        self.dag = FormulaDAG()
+        self.ltlf_rules = [(r['id'], r['description'], self.dag.add(parse_formula(r['formula'])), dfa)
+                           for r, dfa in zip(cfg.ltlf_rules, cfg.ltlf_automata)]
+        self.rules_signature = [(r['id'], r['formula']) for r in cfg.ltlf_rules]
+        self.pred_bits = {p: 1 << i for i, p in enumerate(cfg.ltlf_preds)}
+        self.event_bits = {e: self.pred_bits[e] for e in cfg.event_names()}
+        self.table = TransitionTable(self.dfa, cfg, self.event_bits)
+        self.state_bits = [self.pred_bits.get(f'S_{st}', 0) for st in self.table.states]
+        self.derived = cfg.derived_masks
+        self._derived_cache: Dict[int, int] = {}
+        # замер выигрыша от общего графа (см. measure_sharing); None — не замерялся
+        self.eval_timing: Optional[Dict[str, float]] = None
+        self.history_capacity = cfg.history_max_steps
+        if self.history_capacity == 'auto':
+            self.history_capacity = max((temporal_depth(node) for _, _, node, _ in self.ltlf_rules), default=0) + 1
+
+    def pred_mask(self, emask: int, sid: int) -> int:
+        """Маска предикатов шага: события, состояние и производные предикаты."""
+        return self.derive(emask | self.state_bits[sid])
+
+    def derive(self, m: int) -> int:
+        """Добавляет к маске событий и состояния биты производных предикатов."""
+        if not self.derived:
+            return m
+        r = self._derived_cache.get(m)
+        if r is None:
+            r = m
+            for bit, any_of, cubes in self.derived:
+                if m & any_of or any(m & p == p and not m & q for p, q in cubes):
+                    r |= bit
+            self._derived_cache[m] = r
+        return r
+
+    def __repr__(self) -> str:
+        return f'RulesBundle({self.digest[:12] or "-"}, rules={len(self.ltlf_rules)}, preds={len(self.pred_bits)})'
+
+
+def _code_digest() -> bytes:
+    h = hashlib.sha256(sys.version.encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in _SOURCES:
+        with open(os.path.join(here, name), 'rb') as f:
+            h.update(f.read())
+    return h.digest()
+
+
+def bundle_digest(raw: bytes) -> str:
+    return hashlib.sha256(_code_digest() + raw).hexdigest()
+
+
+def default_cache_dir(path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(path)), '.cache')
+
+
+def load_bundle(path: str, cache_dir: Optional[str] = None) -> RulesBundle:
+    """Собирает бандл для rules.yaml или берёт готовый из кэша.
+
+    Ключ кэша — sha256 от содержимого YAML и исходников компилятора, так что
+    любая правка конфига или кода даёт новую сборку. cache_dir='' — без кэша.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    digest = bundle_digest(raw)
+    if cache_dir is None:
+        cache_dir = default_cache_dir(path)
+    cached = os.path.join(cache_dir, f'rules-{digest[:32]}.bundle') if cache_dir else None
+
+    if cached and os.path.exists(cached):
+        try:
+            with open(cached, 'rb') as f:
+                bundle = pickle.load(f)
+            if isinstance(bundle, RulesBundle) and bundle.digest == digest:
+                _log_sharing(bundle)
+                return bundle
+        except Exception:
+            log.warning("Кэш бандла %s повреждён, собираю заново", cached, exc_info=True)
+
+    t0 = time.perf_counter()
+    bundle = RulesBundle(Config.from_dict(yaml.safe_load(raw.decode('utf-8'))), digest)
+    measure_sharing(bundle)
+    log.info("Правила собраны за %.0f мс: %r", 1000 * (time.perf_counter() - t0), bundle)
+    _log_sharing(bundle)
+    if cached:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            save_bundle(bundle, cached)
+        except OSError:
+            log.warning("Не удалось сохранить кэш бандла в %s", cache_dir, exc_info=True)
+    return bundle
+
+
+def save_bundle(bundle: RulesBundle, path: str) -> None:
+    """Пишет бандл в pickle атомарно (через временный файл рядом)."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(bundle, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def load_saved_bundle(path: str, digest: str) -> RulesBundle:
+    """Читает бандл, сохранённый save_bundle, и проверяет, что это сборка digest.
+
+    Так процесс получает ровно тот бандл, который собрал другой, а не
+    перечитывает rules.yaml, успевший за это время поменяться.
+    """
+    with open(path, 'rb') as f:
+        bundle = pickle.load(f)
+    got = getattr(bundle, 'digest', None) if isinstance(bundle, RulesBundle) else None
+    if got != digest:
+        raise ValueError(f"{path}: бандл {str(got)[:12]} вместо ожидаемого {digest[:12]}")
+    return bundle
+
+
+def measure_sharing(bundle: RulesBundle, steps: int = 256, seed: int = 0) -> Dict[str, float]:
+    """Замеряет оценку правил по отдельности и общим графом на случайной трассе.
+
+    Результат сохраняется в бандле (и в кэше) и пишется в лог при загрузке.
+    """
+    rnd = random.Random(seed)
+    bits = list(bundle.pred_bits.values())
+    trace = StepHistory(None, bundle.pred_bits)
+    for _ in range(steps):
+        trace.append(sum(bit for bit in bits if rnd.random() < 0.1), 0)
+    bundle.eval_timing = bundle.dag.timing(trace)
+    return bundle.eval_timing
+
+
+def _log_sharing(bundle: RulesBundle) -> None:
+    st = bundle.dag.stats()
+    log.info("LTLf: %d правил, %d узлов в деревьях -> %d в общем графе; вычислений узлов на позицию меньше на %.0f%%",
+             st['rules'], st['tree_nodes'], st['dag_nodes'], 100 * st['shared'])
+    t = getattr(bundle, 'eval_timing', None)
+    if t:
+        log.info("LTLf: оценка трассы из %d шагов — по правилам %.2f мс, общим графом %.2f мс (x%.1f)",
+                 t['steps'], t['tree_ms'], t['dag_ms'], t['tree_ms'] / t['dag_ms'] if t['dag_ms'] else 0.0)
+
+
+def remap_masks(masks: List[int], old_preds: List[str], new_bits: Dict[str, int]) -> List[int]:
+    """Переводит маски истории из старой нумерации предикатов в новую по именам."""
+    table = [new_bits.get(p, 0) for p in old_preds]
+    out = []
+    cache: Dict[int, int] = {}
+    for m in masks:
+        r = cache.get(m)
+        if r is None:
+            r, rest = 0, m
+            while rest:
+                low = rest & -rest
+                r |= table[low.bit_length() - 1]
+                rest ^= low
+            cache[m] = r
+        out.append(r)
+    return out
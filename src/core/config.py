@@ -1,7 +1,8 @@
 from __future__ import annotations
 from dataclasses import dataclass, field
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import yaml, re
+from .ltlf import Node, Pred, Bool, Not, And, Or, Implies, parse_formula, compile_dfa, prop_cubes
 
 
 @dataclass
@@ -22,6 +23,12 @@ class DFATransition:
     otherwise: bool = False
 
 
+@dataclass
+class CoolingRule:
+    after: int
+    to: str
+
+
 @dataclass
 class RiskConfig:
     base_by_state: Dict[str, int]
@@ -42,12 +49,99 @@ class Config:
     ltlf_rules: List[Dict[str, Any]]
     hints: Dict[str, Any]
     extraction: Dict[str, Any]
+    dfa_priority: List[List[str]] = field(default_factory=list)
+    cooling: Dict[str, CoolingRule] = field(default_factory=dict)
+    history_max_steps: Any = 1000
+    ltlf_preds: List[str] = field(default_factory=list)
+    ltlf_automata: List[Any] = field(default_factory=list)
+    # производные предикаты (группы labels и ltlf.predicates): имя -> формула
+    # над событиями и S_<состояние>, и она же как (бит, маска «любой из», кубы)
+    derived_preds: Dict[str, Node] = field(default_factory=dict)
+    derived_masks: List[Tuple[int, int, List[Tuple[int, int]]]] = field(default_factory=list)
+
+    def event_names(self) -> List[str]:
+        names: List[str] = []
+        for t in self.triggers:
+            if t.event not in names: names.append(t.event)
+        for t in self.dfa_transitions:
+            for e in t.when_any_of or []:
+                if e not in names: names.append(e)
+        for evs in self.dfa_priority + list(self.labels.values()):
+            for e in evs:
+                if e not in names: names.append(e)
+        return names
+
+    def compile_ltlf(self) -> None:
+        base = self.event_names() + [f'S_{s}' for s in self.dfa_states]
+        self.derived_preds = self._derived_preds(base)
+        self.ltlf_preds = base + list(self.derived_preds)
+        if len(self.ltlf_preds) > 64:
+            raise ValueError('Слишком много предикатов LTLf: история хранит их в 64-битной маске')
+        if len(self.dfa_states) > 256:
+            raise ValueError('Слишком много состояний DFA (максимум 256)')
+        bits = {p: 1 << i for i, p in enumerate(self.ltlf_preds)}
+        self.derived_masks = []
+        for name, node in self.derived_preds.items():
+            # одиночные биты (дизъюнкция событий) сливаются в одну маску
+            cubes = prop_cubes(node, bits)
+            single = [p for p, q in cubes if not q and p and not p & (p - 1)]
+            self.derived_masks.append((bits[name], sum(single),
+                                       [(p, q) for p, q in cubes if q or not p or p & (p - 1)]))
+        self.ltlf_automata = [compile_dfa(parse_formula(r['formula']), bits) for r in self.ltlf_rules]
+
+    def _derived_preds(self, base: List[str]) -> Dict[str, Node]:
+        # группы из labels — дизъюнкция своих событий; ltlf.predicates —
+        # формулы без темпоральных операторов или "state == ИМЯ". Ссылки на
+        # другие производные предикаты раскрываются, так что каждый считается
+        # по одной маске шага
+        defs: Dict[str, Node] = {}
+        for label, events in self.labels.items():
+            node: Node = Bool(False)
+            for e in events:
+                node = Pred(e) if isinstance(node, Bool) else Or(node, Pred(e))
+            defs[label] = node
+        for name, expr in (self.ltlf_predicates or {}).items():
+            m = re.fullmatch(r'\s*state\s*==\s*(\w+)\s*', expr)
+            if m and m.group(1) not in self.dfa_states:
+                raise ValueError(f'Предикат {name}: нет состояния {m.group(1)}')
+            node = Pred(f'S_{m.group(1)}') if m else parse_formula(expr)
+            if name in base and node != Pred(name):
+                raise ValueError(f'Предикат {name} совпадает с событием или состоянием')
+            if name not in base:
+                defs[name] = node
+        for name in defs:
+            if name in base:
+                raise ValueError(f'Группа {name} совпадает с событием или состоянием')
+
+        out: Dict[str, Node] = {}
+
+        def expand(node: Node, stack: Tuple[str, ...]) -> Node:
+            if isinstance(node, Pred) and node.name in defs:
+                if node.name in stack:
+                    raise ValueError(f'Циклическое определение предиката {node.name}')
+                if node.name not in out:
+                    out[node.name] = expand(defs[node.name], stack + (node.name,))
+                return out[node.name]
+            if isinstance(node, (Pred, Bool)):
+                return node
+            if isinstance(node, Not):
+                return Not(expand(node.child, stack))
+            if isinstance(node, (And, Or, Implies)):
+                return type(node)(expand(node.left, stack), expand(node.right, stack))
+            raise ValueError(f'Предикат {stack[-1]}: временные операторы не допускаются')
+
+        for name in defs:
+            expand(Pred(name), ())
+        return {name: out[name] for name in defs}
 
     @staticmethod
     def from_yaml(path: str) -> 'Config':
         with open(path, 'r', encoding='utf-8') as f:
             data = yaml.safe_load(f)
+        return Config.from_dict(data)
 
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> 'Config':
         triggers = [Trigger(**t) for t in data['triggers']]
         trans = []
         for t in data['dfa']['transitions']:
@@ -65,9 +159,13 @@ class Config:
             dfa_states=data['dfa']['states'],
             dfa_start=data['dfa']['start_state'],
             dfa_transitions=trans,
-            ltlf_predicates=data['ltlf']['predicates'],
+            ltlf_predicates=data['ltlf'].get('predicates') or {},
             ltlf_rules=data['ltlf']['rules'],
             hints=data.get('hints', {}),
             extraction=data.get('event_extraction', {}),
+            dfa_priority=data['dfa'].get('priority') or [],
+            cooling={st: CoolingRule(**c) for st, c in (data.get('cooling') or {}).items()},
+            history_max_steps=(data.get('history') or {}).get('max_steps', 1000),
         )
+        cfg.compile_ltlf()
         return cfg
@@ -1,9 +1,11 @@
 from __future__ import annotations
-from typing import Dict
+from typing import Dict, Set
+from .config import Config
 
 
 class CoolingManager:
-    def __init__(self):
+    def __init__(self, cfg: Config):
+        self.rules = cfg.cooling
         self.neutral_counts: Dict[str, int] = {}
 
     def update_count(self, chat_id: str, current_state: str, next_state: str, events: Set[str]) -> str:
@@ -11,20 +13,13 @@ class CoolingManager:
             self.neutral_counts[chat_id] = 0
             return next_state
 
-        if current_state in ["HEATED", "TENSE", "REPAIRED"]:
-            count = self.neutral_counts[chat_id] + 1
+        rule = self.rules.get(current_state)
+        if rule is not None:
+            count = self.neutral_counts.get(chat_id, 0) + 1
             self.neutral_counts[chat_id] = count
 
-            if current_state == "HEATED" and count >= 3:
+            if count >= rule.after:
                 self.neutral_counts[chat_id] = 0
-                return "TENSE"
-
-            elif current_state == "TENSE" and count >= 3:
-                self.neutral_counts[chat_id] = 0
-                return "NEUTRAL"
-
-            elif current_state == "REPAIRED" and count >= 1:
-                self.neutral_counts[chat_id] = 0
-                return "NEUTRAL"
+                return rule.to
 
         return next_state
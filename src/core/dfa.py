@@ -1,6 +1,6 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import List, Optional, Set
+from typing import Dict, List, Optional, Set, Tuple, Union
 from .config import Config, DFATransition
 
 
@@ -15,24 +15,16 @@ class DFAEngine:
         self.states = cfg.dfa_states
         self.start_state = cfg.dfa_start
         self.transitions: List[DFATransition] = cfg.dfa_transitions
+        # без секции priority все события равноправны
+        self.priority: List[Optional[Set[str]]] = [set(level) for level in cfg.dfa_priority] or [None]
 
     def step(self, current: str, events: Set[str]) -> str:
-        high_priority_events = {"INSULT", "THREAT", "ALL_CAPS", "PROVOCATION",
-                                "ACCUSATION", "SARCASTIC", "INTERRUPT", "BLAME_YOU"}
-        low_priority_events = {"APOLOGY", "EMPATHY", "SOFTENER", "THANKS",
-                               "ACKNOWLEDGE", "OFFER_PAUSE"}
-
-        for t in self.transitions:
-            if t.from_state != current:
-                continue
-            if t.when_any_of and any(e in high_priority_events and e in events for e in t.when_any_of):
-                return t.to_state
-
-        for t in self.transitions:
-            if t.from_state != current:
-                continue
-            if t.when_any_of and any(e in low_priority_events and e in events for e in t.when_any_of):
-                return t.to_state
+        for level in self.priority:
+            for t in self.transitions:
+                if t.from_state != current:
+                    continue
+                if t.when_any_of and any(e in events and (level is None or e in level) for e in t.when_any_of):
+                    return t.to_state
 
         for t in self.transitions:
             if t.from_state != current:
@@ -41,3 +33,79 @@ class DFAEngine:
                 return t.to_state
 
         return current
+
+
+class TransitionTable:
+    """Произведение DFA и счётчика остывания в одной таблице.
+
+    События, одинаково влияющие на переходы (один и тот же набор пар
+    «уровень приоритета, переход»), склеиваются в класс; индекс таблицы —
+    (состояние, счётчик остывания, битовая маска классов). До 12 классов
+    таблица — заполненный заранее список; больше — словарь, куда переходы
+    попадают при первом обращении (полное произведение не помещается в память).
+    """
+
+    def __init__(self, dfa: DFAEngine, cfg: Config, event_bits: Dict[str, int]):
+        self.dfa = dfa
+        self.cooling = cfg.cooling
+        self.states: List[str] = list(cfg.dfa_states)
+        self.state_id: Dict[str, int] = {s: i for i, s in enumerate(self.states)}
+        self.max_count = max((c.after for c in self.cooling.values()), default=0)
+
+        signatures: Dict[frozenset, int] = {}
+        self.class_rep: List[str] = []
+        self.class_of: Dict[int, int] = {}
+        for e, bit in event_bits.items():
+            sig = frozenset((li, ti) for li, level in enumerate(dfa.priority)
+                            for ti, t in enumerate(dfa.transitions)
+                            if e in (t.when_any_of or []) and (level is None or e in level))
+            if sig not in signatures:
+                signatures[sig] = len(signatures)
+                self.class_rep.append(e)
+            self.class_of[bit] = 1 << signatures[sig]
+        self.num_classes = len(signatures)
+        self._mask_cache: Dict[int, int] = {0: 0}
+
+        self.width = self.max_count + 1
+        self.table: Union[List[int], Dict[int, int]] = {}
+        if self.num_classes <= 12:
+            size = len(self.states) * self.width << self.num_classes
+            self.table = [0] * size
+            for idx in range(size):
+                self._fill(idx)
+
+    def _fill(self, idx: int) -> int:
+        cmask = idx & ((1 << self.num_classes) - 1)
+        sid, count = divmod(idx >> self.num_classes, self.width)
+        events = {self.class_rep[c] for c in range(self.num_classes) if cmask >> c & 1}
+        current = self.states[sid]
+        nxt = self.dfa.step(current, events)
+        if events:
+            count = 0
+        else:
+            rule = self.cooling.get(current)
+            if rule is not None:
+                count = min(count + 1, self.max_count)
+                if count >= rule.after:
+                    nxt, count = rule.to, 0
+        v = self.table[idx] = self.state_id[nxt] * self.width + count
+        return v
+
+    def class_mask(self, emask: int) -> int:
+        cm = self._mask_cache.get(emask)
+        if cm is None:
+            cm, rest = 0, emask
+            while rest:
+                low = rest & -rest
+                cm |= self.class_of.get(low, 0)
+                rest ^= low
+            self._mask_cache[emask] = cm
+        return cm
+
+    def step(self, sid: int, count: int, emask: int) -> Tuple[int, int]:
+        idx = (sid * self.width + count) << self.num_classes | self.class_mask(emask)
+        try:
+            v = self.table[idx]
+        except KeyError:
+            v = self._fill(idx)
+        return divmod(v, self.width)
@@ -0,0 +1,131 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+
+class ChatDispatcher:
+    """Выносит обработку сообщений с event loop в пул.
+
+    Сообщения одного чата выполняются строго по очереди (каждое ждёт
+    предыдущее), разные чаты — параллельно, насколько позволяет пул.
+    run(chat_id, *args) вызывается в потоке/процессе пула; executor_for(chat_id)
+    выбирает пул для чата. call() ставит в ту же очередь чата другой вызов
+    (например, правку сообщения). Отмена вызова порядок не нарушает:
+    следующий вызов чата стартует только после того, что уже запущено
+    или ожидалось перед отменённым.
+    """
+
+    def __init__(self, run: Callable[..., Any], executor_for: Callable[[str], Executor],
+                 log_every: int = 200):
+        self.run = run
+        self.executor_for = executor_for
+        self.log_every = log_every
+        self._tails: Dict[str, asyncio.Future] = {}
+        self._depth: Dict[str, int] = {}
+        self.in_flight = 0
+        self.done = 0
+        self._wait_sum = 0.0
+        self._wait_max = 0.0
+        self._exec_sum = 0.0
+        self._depth_max = 0
+
+    async def submit(self, chat_id: str, *args: Any) -> Any:
+        return await self.call(self.run, chat_id, *args)
+
+    async def call(self, fn: Callable[..., Any], chat_id: str, *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        prev = self._tails.get(chat_id)
+        mine = loop.create_future()
+        self._tails[chat_id] = mine
+        depth = self._depth[chat_id] = self._depth.get(chat_id, 0) + 1
+        self.in_flight += 1
+        self._depth_max = max(self._depth_max, depth)
+        t0 = time.perf_counter()
+        # то, чего ждём сейчас: при отмене следующий вызов чата
+        # отпускается только после него
+        waiting = prev
+        try:
+            if prev is not None:
+                await asyncio.shield(prev)
+            t1 = time.perf_counter()
+            waiting = loop.run_in_executor(self.executor_for(chat_id), fn, chat_id, *args)
+            res = await asyncio.shield(waiting)
+            self._account(t1 - t0, time.perf_counter() - t1)
+            return res
+        finally:
+            self.in_flight -= 1
+            left = self._depth[chat_id] - 1
+            if left:
+                self._depth[chat_id] = left
+            else:
+                del self._depth[chat_id]
+            if waiting is not None and not waiting.done():
+                waiting.add_done_callback(lambda f: self._release(chat_id, mine, f))
+            else:
+                self._release(chat_id, mine)
+
+    def _release(self, chat_id: str, mine: asyncio.Future,
+                 waited: Optional[asyncio.Future] = None) -> None:
+        # ошибку вызова, который уже некому ждать, забираем, чтобы asyncio не ругался
+        if waited is not None and not waited.cancelled():
+            waited.exception()
+        if self._tails.get(chat_id) is mine:
+            del self._tails[chat_id]
+        mine.set_result(None)
+
+    def _account(self, wait: float, run: float) -> None:
+        self.done += 1
+        self._wait_sum += wait
+        self._wait_max = max(self._wait_max, wait)
+        self._exec_sum += run
+        if self.log_every and self.done % self.log_every == 0:
+            log.info("Очередь движка: в работе %d (чатов %d, макс. глубина %d), "
+                     "ожидание в чате ср. %.1f мс / макс. %.1f мс, пул+обработка ср. %.1f мс",
+                     self.in_flight, len(self._depth), self._depth_max,
+                     1000 * self._wait_sum / self.log_every, 1000 * self._wait_max,
+                     1000 * self._exec_sum / self.log_every)
+            self._wait_sum = self._exec_sum = self._wait_max = 0.0
+            self._depth_max = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {'in_flight': self.in_flight, 'chats_queued': len(self._depth), 'done': self.done}
+
+
+class ThreadedEngine:
+    """Общий потокобезопасный движок для пула потоков.
+
+    Разные чаты обрабатываются параллельно (каждый под своей блокировкой
+    внутри RulesEngine), порядок внутри чата обеспечивает ChatDispatcher.
+    """
+
+    def __init__(self, engine, workers: int):
+        self.engine = engine
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='engine')
+
+    def executor_for(self, chat_id: str) -> Executor:
+        return self.pool
+
+    def run(self, chat_id: str, text: str, user: Optional[str] = None,
+            msg_id: Optional[int] = None) -> Dict[str, Any]:
+        return self.engine.process_message(chat_id, text, user=user, msg_id=msg_id)
+
+    def edit_message(self, chat_id: str, msg_id: int, text: str) -> Optional[Dict[str, Any]]:
+        return self.engine.edit_message(chat_id, msg_id, text)
+
+    def delete_messages(self, chat_id: str, msg_ids: List[int]) -> Optional[Dict[str, Any]]:
+        return self.engine.delete_messages(chat_id, msg_ids)
+
+    def call_all(self, method: str, *args: Any) -> List[Any]:
+        return [getattr(self.engine, method)(*args)]
+
+    def reload(self, path: str) -> str:
+        return self.engine.reload(path)
+
+    def shutdown(self) -> None:
+        self.pool.shutdown()
+        self.engine.close()
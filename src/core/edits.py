@@ -0,0 +1,103 @@
+from __future__ import annotations
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# контрольная точка — состояние чата перед шагом: (номер состояния DFA,
+# счётчик остывания, риск, состояния правил LTLf)
+Checkpoint = Tuple[int, int, int, List[Any]]
+
+
+class EditLog:
+    """Последние шаги чата для правки и удаления сообщений задним числом.
+
+    На сообщение хранится маска событий, состояние DFA после шага, id
+    сообщения в Telegram и отметка, не удалено ли оно; позиция — порядковый
+    номер сообщения в чате. Перед каждым every-м сообщением снимается
+    контрольная точка: правка откатывает чат к ближайшей точке не дальше
+    every шагов назад, а перепрогон останавливается на первой точке после
+    правки, где состояние совпало с сохранённым. Хранится не меньше window
+    сообщений; более старые правки не учитываются. Историю чата журнал не
+    дублирует: правка переписывает в StepHistory только перепрогнанные шаги.
+    """
+
+    __slots__ = ('window', 'every', 'base', 'emasks', 'sids', 'alive', 'ids', 'pos_of', 'checkpoints')
+
+    def __init__(self, window: int, every: int):
+        self.window = window
+        self.every = max(1, every)
+        self.base = 0
+        self.emasks = array('Q')
+        self.sids = bytearray()
+        self.alive = bytearray()
+        self.ids = array('q')
+        self.pos_of: Dict[int, int] = {}
+        self.checkpoints: Dict[int, Checkpoint] = {}
+
+    def __len__(self) -> int:
+        return len(self.emasks)
+
+    @property
+    def end(self) -> int:
+        return self.base + len(self.emasks)
+
+    def due(self) -> bool:
+        """Нужна ли контрольная точка перед следующим сообщением."""
+        return len(self.emasks) % self.every == 0
+
+    def append(self, emask: int, sid: int, msg_id: Optional[int], checkpoint: Optional[Checkpoint]) -> None:
+        if checkpoint is not None:
+            self.checkpoints[self.end] = checkpoint
+        if msg_id is not None:
+            self.pos_of[msg_id] = self.end
+        self.emasks.append(emask)
+        self.sids.append(sid)
+        self.alive.append(1)
+        self.ids.append(msg_id or 0)
+        if len(self.emasks) >= self.window + self.every:
+            self._trim(self.every)
+
+    def _trim(self, n: int) -> None:
+        # старые шаги уходят целым интервалом, чтобы base оставался точкой
+        for i in range(n):
+            mid = self.ids[i]
+            if mid and self.pos_of.get(mid) == self.base + i:
+                del self.pos_of[mid]
+        self.checkpoints.pop(self.base, None)
+        del self.emasks[:n]
+        del self.sids[:n]
+        del self.alive[:n]
+        del self.ids[:n]
+        self.base += n
+
+    def find(self, msg_ids: Iterable[int]) -> List[int]:
+        """Позиции ещё не удалённых сообщений из окна."""
+        out = []
+        for mid in msg_ids:
+            pos = self.pos_of.get(mid)
+            if pos is not None and self.alive[pos - self.base]:
+                out.append(pos)
+        return out
+
+    def checkpoint_before(self, pos: int) -> int:
+        """Позиция ближайшей контрольной точки не позже pos."""
+        return self.base + (pos - self.base) // self.every * self.every
+
+    def dump(self) -> Tuple[Any, ...]:
+        return (self.window, self.every, self.base, self.emasks.tobytes(), bytes(self.sids), bytes(self.alive),
+                self.ids.tobytes(), dict(self.checkpoints))
+
+    @classmethod
+    def load(cls, data: Tuple[Any, ...]) -> 'EditLog':
+        # в старых снимках девятым полем шла копия истории (prefix)
+        window, every, base, emasks, sids, alive, ids, checkpoints = data[:8]
+        log = cls(window, every)
+        log.base = base
+        log.emasks.frombytes(emasks)
+        log.sids.extend(sids)
+        log.alive.extend(alive)
+        log.ids.frombytes(ids)
+        log.checkpoints = checkpoints
+        for i, mid in enumerate(log.ids):
+            if mid and log.alive[i]:
+                log.pos_of[mid] = base + i
+        return log
@@ -1,64 +1,782 @@
 from __future__ import annotations
-from typing import Dict, Any, Set, List, Tuple
-from dataclasses import dataclass, field
+import copy
+import logging
+import queue
+import threading
+import time
+from array import array
+from typing import Dict, Any, Set, List, Tuple, Optional, Callable, Union
 from .config import Config
-from .triggers import TriggerMatcher
-from .dfa import DFAEngine
+from .bundle import RulesBundle, load_bundle, remap_masks
 from .risk import RiskMeter
-from .ltlf import parse_formula, eval_formula, build_trace_from_steps
+from .ltlf import LTLfMonitor, MaskPreds
+from .history import StepHistory
+from .store import ChatStore
+from .persistence import WriteBehind
 from .hints import pick_hints
 from .cooling import CoolingManager
+from .metrics import Metrics, STAGES
+from .edits import EditLog
+
+log = logging.getLogger(__name__)
+
+# порядок severity правил LTLf; без severity правило считается medium
+SEVERITY = {'low': 0, 'medium': 1, 'high': 2}
 
 
-@dataclass
 class ChatState:
-    state: str
-    risk: int = 0
-    history: List[Dict[str, Any]] = field(default_factory=list)
+    __slots__ = ('state', 'risk', 'history', 'ltlf_states', 'lock', 'evicted', 'bundle',
+                 'pending', 'pending_base', 'ltlf_pos', 'owed', 'edits', 'source_pos')
+
+    def __init__(self, state: str, risk: int = 0, history: Optional[StepHistory] = None,
+                 ltlf_states: Optional[List[Any]] = None, bundle: Optional[RulesBundle] = None):
+        self.state = state
+        self.risk = risk
+        self.history = history
+        # по одному значению на правило: номер состояния автомата либо LTLfMonitor,
+        # если правило не удалось скомпилировать в DFA
+        self.ltlf_states = ltlf_states if ltlf_states is not None else []
+        # всё изменяемое состояние чата (включая его счётчик остывания и
+        # RiskMeter) меняется только под этой блокировкой
+        self.lock = threading.Lock()
+        self.evicted = False
+        # бандл правил, в терминах которого записано состояние
+        self.bundle = bundle
+        # отложенный LTLf: маски шагов с номера pending_base, до которых ещё
+        # не дошли все правила; ltlf_pos — докуда дошло каждое правило, owed —
+        # шаги, вердикты которых обещаны через on_verdict. None — правила
+        # на текущем шаге (обычный случай)
+        self.pending: Optional[List[int]] = None
+        self.pending_base = 0
+        self.ltlf_pos: List[int] = []
+        self.owed: List[int] = []
+        # журнал для правки и удаления сообщений; None — правки не учитываются
+        self.edits: Optional[EditLog] = None
+        # позиция последнего сообщения чата во внешнем источнике (для --follow —
+        # (inode, offset) в журнале); хранится в снимке вместе с состоянием
+        self.source_pos: Any = None
 
 
 class RulesEngine:
-    def __init__(self, cfg: Config):
-        self.cfg = cfg
-        self.triggers = TriggerMatcher(cfg)
-        self.dfa = DFAEngine(cfg)
-        self.chats: Dict[str, ChatState] = {}
+    def __init__(self, cfg: Union[Config, RulesBundle], max_chats: Optional[int] = None, idle_ttl: Optional[float] = None,
+                 spill: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+                 load: Optional[Callable[[str], Optional[Dict[str, Any]]]] = None,
+                 persistence: Optional[WriteBehind] = None, metrics: Optional[Metrics] = None,
+                 ltlf_budget: Optional[float] = None, max_backlog: Optional[int] = None,
+                 shed_below: str = 'medium',
+                 on_verdict: Optional[Callable[[str, int, List[Dict[str, Any]]], None]] = None,
+                 edit_window: Optional[int] = None, checkpoint_every: int = 64):
+        self.bundle = cfg if isinstance(cfg, RulesBundle) else RulesBundle(cfg)
+        # номер версии правил; растёт при каждой swap_bundle
+        self.generation = 0
+        # spill получает снимок вытесняемого чата, load возвращает его обратно
+        # при следующем сообщении — вытеснение не обнуляет разговор
+        self.persistence = persistence
+        self.spill = spill or (persistence.put if persistence is not None else None)
+        self.load = load or (persistence.get if persistence is not None else None)
+        self.reloads = 0
+        # чаты, изменённые с последнего сброса в persistence
+        self.dirty: Set[str] = set()
+        self._updates = 0
+        self._last_flush = time.monotonic()
+        self._flush_lock = threading.Lock()
+        # берётся только при промахе: создание и загрузка чата атомарны
+        self._create_lock = threading.RLock()
+        self.chats = ChatStore(max_chats, idle_ttl, on_evict=self._on_evict)
         self.risk_meters: Dict[str, RiskMeter] = {}
-        self.cooling_mgr = CoolingManager()
-        self.ltlf_rules = [(r['id'], r['description'], parse_formula(r['formula'])) for r in cfg.ltlf_rules]
+        self.cooling_mgr = CoolingManager(self.bundle.cfg)
+        # None — без замеров: в process_message остаются только проверки на None
+        self.metrics = metrics
+        # деградация под нагрузкой: если на сообщение до LTLf ушло больше
+        # ltlf_budget секунд или в работе и в очереди больше max_backlog
+        # сообщений, LTLf считается в фоне (вердикт — через on_verdict), а
+        # правила с severity ниже shed_below в это время не считаются вовсе
+        self.ltlf_budget = ltlf_budget
+        self.max_backlog = max_backlog
+        self.shed_rank = SEVERITY[shed_below]
+        self.on_verdict = on_verdict
+        self.max_pending = 4096  # дальше чат догоняет правила синхронно
+        self._shedding = ltlf_budget is not None or max_backlog is not None
+        self._load_lock = threading.Lock()
+        self._inflight = 0
+        self._scheduled: Set[str] = set()
+        self._backlog: 'queue.Queue[Optional[str]]' = queue.Queue()
+        self._drainer: Optional[threading.Thread] = None
+        self._keep: Tuple[Optional[RulesBundle], List[int]] = (None, [])
+        self.deferred = 0
+        self.shed = 0
+        self.late = 0
+        # правки задним числом: сколько последних сообщений чата помнить и
+        # как часто снимать контрольные точки (см. EditLog)
+        self.edit_window = edit_window
+        self.checkpoint_every = checkpoint_every
+        self.edits_applied = 0
+        self.edit_steps = 0
+
+    # всё, что выведено из конфига, живёт в текущем бандле
+    cfg = property(lambda self: self.bundle.cfg)
+    triggers = property(lambda self: self.bundle.triggers)
+    dfa = property(lambda self: self.bundle.dfa)
+    ltlf_rules = property(lambda self: self.bundle.ltlf_rules)
+    rules_signature = property(lambda self: self.bundle.rules_signature)
+    pred_bits = property(lambda self: self.bundle.pred_bits)
+    event_bits = property(lambda self: self.bundle.event_bits)
+    table = property(lambda self: self.bundle.table)
+    state_bits = property(lambda self: self.bundle.state_bits)
+    history_capacity = property(lambda self: self.bundle.history_capacity)
+
+    def swap_bundle(self, bundle: RulesBundle, generation: Optional[int] = None) -> None:
+        """Атомарно подменяет правила. Чаты переводятся на новый бандл лениво,
+        при следующем сообщении; сообщения в обработке дорабатывают на старом.
+        generation — номер версии, если его ведёт вызывающий (ShardedEngine)."""
+        self.cooling_mgr.rules = bundle.cfg.cooling
+        self.bundle = bundle
+        self.generation = self.generation + 1 if generation is None else generation
+
+    def reload(self, path: str, cache_dir: Optional[str] = None) -> str:
+        bundle = load_bundle(path, cache_dir)
+        if bundle.digest != self.bundle.digest:
+            self.swap_bundle(bundle)
+        return bundle.digest
+
+    def _new_chat(self, b: RulesBundle) -> ChatState:
+        cs = ChatState(state=b.cfg.dfa_start, risk=0,
+                       history=StepHistory(b.history_capacity, b.pred_bits),
+                       ltlf_states=self._start_states(b), bundle=b)
+        cs.edits = self._new_edits()
+        return cs
+
+    def _new_edits(self) -> Optional[EditLog]:
+        return EditLog(self.edit_window, self.checkpoint_every) if self.edit_window else None
+
+    @staticmethod
+    def _start_states(b: RulesBundle) -> List[Any]:
+        return [dfa.start if dfa is not None else LTLfMonitor(node) for _, _, node, dfa in b.ltlf_rules]
 
     def get_chat(self, chat_id: str) -> ChatState:
         cs = self.chats.get(chat_id)
+        if cs is not None:
+            return cs
+        with self._create_lock:
+            cs = self.chats.items.get(chat_id)
+            if cs is not None:
+                return cs
+            snap = self.load(chat_id) if self.load is not None else None
+            if snap is not None:
+                self.reloads += 1
+                return self._import_chat(chat_id, snap)
+            b = self.bundle
+            cs = self._new_chat(b)
+            self.risk_meters[chat_id] = RiskMeter(b.cfg, b.triggers)
+            self.chats.put(chat_id, cs)
+        return cs
+
+    def _snapshot(self, chat_id: str, cs: ChatState) -> Dict[str, Any]:
+        # в снимок правила попадают на текущем шаге; обещанные вердикты
+        # отдаются здесь же, под блокировкой чата
+        if cs.pending is not None:
+            self._deliver(chat_id, self._settle(cs, True))
+        b = cs.bundle
+        return {
+            'state': cs.state,
+            'risk': cs.risk,
+            'cooling': self.cooling_mgr.neutral_counts.get(chat_id, 0),
+            'rules': b.rules_signature,
+            'preds': b.cfg.ltlf_preds,
+            'derived': b.cfg.derived_masks,
+            'states': b.table.states,
+            # мониторы копируются: снимок может сериализоваться в другом потоке
+            'ltlf': [copy.copy(x) if isinstance(x, LTLfMonitor) else x for x in cs.ltlf_states],
+            'history': cs.history.dump(),
+            'edits': cs.edits.dump() if cs.edits is not None else None,
+            'source_pos': cs.source_pos,
+        }
+
+    def export_chat(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        cs = self.chats.items.get(chat_id)
         if cs is None:
-            cs = ChatState(state=self.cfg.dfa_start, risk=0, history=[])
-            self.chats[chat_id] = cs
-            self.risk_meters[chat_id] = RiskMeter(self.cfg, self.triggers)
+            return None
+        with cs.lock:
+            return self._snapshot(chat_id, cs)
+
+    def import_chat(self, chat_id: str, snap: Dict[str, Any]) -> ChatState:
+        with self._create_lock:
+            return self._import_chat(chat_id, snap)
+
+    def _import_chat(self, chat_id: str, snap: Dict[str, Any]) -> ChatState:
+        cs = ChatState(state=self.cfg.dfa_start)
+        self._restore(chat_id, cs, snap, self.bundle)
+        self.chats.put(chat_id, cs)
         return cs
 
-    def process_message(self, chat_id: str, text: str) -> Dict[str, Any]:
-        cs = self.get_chat(chat_id)
-        events: Set[str] = self.triggers.extract(text)
-        raw_next_state = self.dfa.step(cs.state, events)
+    def _restore(self, chat_id: str, cs: ChatState, snap: Dict[str, Any], b: RulesBundle) -> None:
+        """Заполняет cs из снимка, переводя его на бандл b.
 
-        final_next_state = self.cooling_mgr.update_count(chat_id, cs.state, raw_next_state, events)
-        risk = self.risk_meters[chat_id].update(final_next_state, events)
+        Если нумерация предикатов или состояний другая, история
+        перекодируется по именам; если поменялись правила, их состояния
+        пересчитываются прогоном сохранённой истории (для длинных чатов —
+        по последним history.max_steps шагам).
+        """
+        cs.bundle = b
+        cs.state = snap['state'] if snap['state'] in b.table.state_id else b.cfg.dfa_start
+        cs.risk = snap['risk']
+        cs.source_pos = snap.get('source_pos')
+        # производные биты сравниваются вместе с определениями
+        same_preds = snap.get('preds') == b.cfg.ltlf_preds and snap.get('derived', []) == b.cfg.derived_masks
+        old_states = snap.get('states', b.table.states)
+        capacity, masks_raw, sids, total = snap['history']
+        if same_preds and old_states == b.table.states and capacity == b.history_capacity:
+            cs.history = StepHistory.load(snap['history'], b.pred_bits)
+        else:
+            masks = array('Q')
+            masks.frombytes(masks_raw)
+            if not same_preds:
+                masks = remap_masks(masks, snap.get('preds') or [], b.pred_bits)
+            start = b.table.state_id[b.cfg.dfa_start]
+            sid_map = [b.table.state_id.get(st, start) for st in old_states]
+            cs.history = StepHistory(b.history_capacity, b.pred_bits)
+            # производные предикаты пересчитываются по событиям и состоянию шага
+            keep = ~sum(bit for bit, _, _ in b.derived)
+            for m, sid in zip(masks, sids):
+                cs.history.append(b.derive(m & keep), sid_map[sid])
+            cs.history.total = max(total, cs.history.total)
+        if same_preds and snap.get('rules') == b.rules_signature:
+            cs.ltlf_states = list(snap['ltlf'])
+        else:
+            cs.ltlf_states = self._replay(cs.history, b)
+        # журнал правок записан в терминах старых правил; при их смене
+        # правки учитываются только для новых сообщений
+        if (self.edit_window and snap.get('edits') and same_preds and old_states == b.table.states
+                and snap.get('rules') == b.rules_signature):
+            cs.edits = EditLog.load(snap['edits'])
+        else:
+            cs.edits = self._new_edits()
+        meter = RiskMeter(b.cfg, b.triggers)
+        meter.value = cs.risk
+        self.risk_meters[chat_id] = meter
+        self.cooling_mgr.neutral_counts[chat_id] = min(snap.get('cooling', 0), b.table.max_count)
 
-        step = {'events': sorted(list(events)), 'state': final_next_state}
-        cs.history.append(step)
-        cs.state = final_next_state
-        cs.risk = risk
+    def _replay(self, history: StepHistory, b: RulesBundle) -> List[Any]:
+        states = self._start_states(b)
+        for i, (_, _, _, dfa) in enumerate(b.ltlf_rules):
+            if dfa is not None:
+                q = dfa.start
+                for m, _ in history:
+                    q = dfa.table[q][m & dfa.mask]
+                states[i] = q
+            else:
+                for m, _ in history:
+                    states[i].step(MaskPreds(m, b.pred_bits))
+        return states
 
-        hints = pick_hints(self.cfg, self.triggers, text, final_next_state, events)
-        trace = build_trace_from_steps(cs.history)
-        ltlf_results = []
-        for rid, desc, node in self.ltlf_rules:
-            ok = eval_formula(node, trace, 0)
-            ltlf_results.append({'id': rid, 'ok': ok, 'description': desc})
+    def _on_evict(self, chat_id: str, cs: ChatState) -> None:
+        # ждём текущую обработку чата; кто возьмёт блокировку после нас,
+        # увидит evicted и перечитает чат
+        with cs.lock:
+            cs.evicted = True
+            self.dirty.discard(chat_id)
+            if self.spill is not None:
+                self.spill(chat_id, self._snapshot(chat_id, cs))
+            self.risk_meters.pop(chat_id, None)
+            self.cooling_mgr.neutral_counts.pop(chat_id, None)
 
-        return {
+    def flush(self) -> int:
+        """Отдаёт снимки изменённых чатов в persistence (без записи на диск)."""
+        self._updates = 0
+        self._last_flush = time.monotonic()
+        if self.persistence is None or not self.dirty:
+            return 0
+        if not self._flush_lock.acquire(blocking=False):
+            return 0  # сбрасывает другой поток
+        try:
+            # сначала снимаем отметки, потом делаем снимки: изменение между
+            # этими шагами снова пометит чат, и он уйдёт в следующий раз
+            ids = list(self.dirty)
+            self.dirty.difference_update(ids)
+            items = []
+            for cid in ids:
+                cs = self.chats.items.get(cid)
+                if cs is None:
+                    continue
+                with cs.lock:
+                    if not cs.evicted:
+                        items.append((cid, self._snapshot(cid, cs)))
+            self.persistence.put_many(items)
+            return len(items)
+        finally:
+            self._flush_lock.release()
+
+    def warm_up(self, limit: Optional[int] = None, accept: Optional[Callable[[str], bool]] = None) -> int:
+        """Загружает последние активные чаты из persistence заранее.
+
+        accept(chat_id) отбирает чаты, если движок обслуживает только часть из них.
+        """
+        if self.persistence is None:
+            return 0
+        if limit is None:
+            limit = self.chats.max_chats
+        n = 0
+        for cid, snap in self.persistence.load_recent(limit, accept):
+            with self._create_lock:
+                if cid not in self.chats:
+                    self._import_chat(cid, snap)
+                    n += 1
+        return n
+
+    def close(self) -> None:
+        if self._drainer is not None:
+            self._backlog.put(None)
+            self._drainer.join()
+            self._drainer = None
+        if self.persistence is not None:
+            self.flush()
+            self.persistence.close()
+
+    def stats(self) -> Dict[str, int]:
+        st = self.chats.stats()
+        st['reloads'] = self.reloads
+        if self._shedding:
+            st['ltlf_deferred'] = self.deferred
+            st['ltlf_shed'] = self.shed
+            st['ltlf_late'] = self.late
+        if self.edit_window:
+            st['edits'] = self.edits_applied
+            st['edit_steps'] = self.edit_steps
+        if self.persistence is not None:
+            st['dirty'] = len(self.dirty)
+            st.update(self.persistence.stats())
+        return st
+
+    # ---------------- Отложенный LTLf ----------------
+
+    def _kept(self, b: RulesBundle) -> List[int]:
+        # правила, которые считаются и под нагрузкой
+        kb, keep = self._keep
+        if kb is not b:
+            keep = [i for i, r in enumerate(b.cfg.ltlf_rules)
+                    if SEVERITY.get(r.get('severity'), 1) >= self.shed_rank]
+            self._keep = (b, keep)
+        return keep
+
+    def _overloaded(self, started: Optional[float]) -> bool:
+        if self.max_backlog is not None and self._inflight + self._backlog.qsize() > self.max_backlog:
+            return True
+        return (started is not None and self.ltlf_budget is not None
+                and time.perf_counter() - started > self.ltlf_budget)
+
+    def _settle(self, cs: ChatState, full: bool) -> List[Tuple[int, List[Dict[str, Any]]]]:
+        """Догоняет правила по отложенным шагам (под cs.lock).
+
+        full=False — только правила, которые не сбрасываются под нагрузкой.
+        Возвращает обещанные вердикты: [(шаг, результаты правил), ...].
+        """
+        pending = cs.pending
+        if pending is None:
+            return []
+        b = cs.bundle
+        base = cs.pending_base
+        end = base + len(pending)
+        owed = set(cs.owed)
+        out: Dict[int, List[Dict[str, Any]]] = {step: [] for step in cs.owed}
+        rules = range(len(b.ltlf_rules)) if full else self._kept(b)
+        for i in rules:
+            rid, desc, _, dfa = b.ltlf_rules[i]
+            st = cs.ltlf_states[i]
+            for step in range(cs.ltlf_pos[i], end):
+                m = pending[step - base]
+                if dfa is not None:
+                    st = dfa.table[st][m & dfa.mask]
+                    ok = dfa.accepting[st]
+                else:
+                    ok = st.step(MaskPreds(m, b.pred_bits))
+                if step in owed:
+                    out[step].append({'id': rid, 'ok': ok, 'description': desc})
+            cs.ltlf_states[i] = st
+            cs.ltlf_pos[i] = end
+        if not full:
+            self.shed += len(owed) * (len(b.ltlf_rules) - len(rules))
+        cs.owed = []
+        low = min(cs.ltlf_pos, default=end)
+        if low == end:
+            cs.pending = None
+        elif low > base:
+            del pending[:low - base]
+            cs.pending_base = low
+        return sorted(out.items())
+
+    def _deliver(self, chat_id: str, late: List[Tuple[int, List[Dict[str, Any]]]]) -> None:
+        if not late:
+            return
+        self.late += len(late)
+        if self.on_verdict is None:
+            return
+        for step, results in late:
+            try:
+                self.on_verdict(chat_id, step, results)
+            except Exception:
+                log.exception("on_verdict упал (чат %s, шаг %d)", chat_id, step)
+
+    def _schedule(self, chat_id: str) -> None:
+        with self._load_lock:
+            if chat_id in self._scheduled:
+                return
+            self._scheduled.add(chat_id)
+            if self._drainer is None:
+                self._drainer = threading.Thread(target=self._drain, name='ltlf-deferred', daemon=True)
+                self._drainer.start()
+        self._backlog.put(chat_id)
+
+    def _drain(self) -> None:
+        while True:
+            chat_id = self._backlog.get()
+            if chat_id is None:
+                return
+            with self._load_lock:
+                self._scheduled.discard(chat_id)
+            cs = self.chats.items.get(chat_id)
+            if cs is None:
+                continue  # вытеснен: вердикты отданы при снимке
+            with cs.lock:
+                if cs.evicted:
+                    continue
+                # пока очередь не пуста, правила ниже shed_below пропускаются;
+                # они догонят чат на следующем сообщении без нагрузки
+                late = self._settle(cs, self._backlog.empty() and not self._overloaded(None))
+            self._deliver(chat_id, late)
+
+    def _step_ltlf_slow(self, chat_id: str, b: RulesBundle, cs: ChatState, pmask: int,
+                        over: bool) -> Tuple[Optional[List[Dict[str, Any]]], List[Tuple[int, List[Dict[str, Any]]]]]:
+        # шаг LTLf при включённой деградации, если чат отстаёт или система
+        # перегружена; None вместо результатов — вердикт придёт позже
+        step = cs.history.total - 1
+        if cs.pending is None:
+            cs.pending = []
+            cs.pending_base = step
+            cs.ltlf_pos = [step] * len(b.ltlf_rules)
+            cs.owed = []
+        cs.pending.append(pmask)
+        if over and len(cs.pending) <= self.max_pending:
+            cs.owed.append(step)
+            self.deferred += 1
+            self._schedule(chat_id)
+            return None, []
+        late = self._settle(cs, True)
+        return self._verdicts(b, cs.ltlf_states), late
+
+    def position(self, chat_id: str) -> Tuple[Any, Set[str]]:
+        """source_pos последнего сообщения чата и id нарушенных сейчас правил LTLf.
+
+        Вытесненный чат подгружается из persistence; у чата без сообщений
+        нарушений нет.
+        """
+        while True:
+            cs = self.get_chat(chat_id)
+            with cs.lock:
+                if cs.evicted:
+                    continue
+                if not cs.history.total:
+                    return cs.source_pos, set()
+                if cs.pending is not None:
+                    self._deliver(chat_id, self._settle(cs, True))
+                return cs.source_pos, {r['id'] for r in self._verdicts(cs.bundle, cs.ltlf_states) if not r['ok']}
+
+    @staticmethod
+    def _verdicts(b: RulesBundle, states: List[Any]) -> List[Dict[str, Any]]:
+        return [{'id': rid, 'ok': dfa.accepting[st] if dfa is not None else st.verdict, 'description': desc}
+                for (rid, desc, _, dfa), st in zip(b.ltlf_rules, states)]
+
+    # ---------------- Правки задним числом ----------------
+
+    def _checkpoint(self, chat_id: str, cs: ChatState, count: int) -> Tuple[Any, ...]:
+        if cs.pending is not None:
+            self._deliver(chat_id, self._settle(cs, True))
+        return (cs.bundle.table.state_id[cs.state], count, cs.risk,
+                [copy.copy(x) if isinstance(x, LTLfMonitor) else x for x in cs.ltlf_states])
+
+    def edit_message(self, chat_id: str, msg_id: int, text: str) -> Optional[Dict[str, Any]]:
+        """Пересчитывает чат так, будто сообщение msg_id с самого начала было text.
+
+        Возвращает текущее состояние чата после пересчёта ('state', 'risk',
+        'ltlf', 'step', 'replayed' — сколько шагов перепрогнано) или None,
+        если сообщения нет в журнале правок.
+        """
+        return self._rewrite(chat_id, [msg_id], text)
+
+    def delete_messages(self, chat_id: str, msg_ids: List[int]) -> Optional[Dict[str, Any]]:
+        """Пересчитывает чат без удалённых сообщений; ответ — как у edit_message."""
+        return self._rewrite(chat_id, msg_ids, None)
+
+    def _rewrite(self, chat_id: str, msg_ids: List[int], text: Optional[str]) -> Optional[Dict[str, Any]]:
+        while True:
+            b = self.bundle
+            cs = self.get_chat(chat_id)
+            with cs.lock:
+                if cs.evicted:
+                    continue
+                if cs.bundle is not b:
+                    if b is not self.bundle:
+                        continue
+                    self._restore(chat_id, cs, self._snapshot(chat_id, cs), b)
+                j = cs.edits
+                positions = j.find(msg_ids) if j is not None else []
+                if not positions:
+                    return None
+                changed = []
+                removed = 0
+                if text is None:
+                    for pos in positions:
+                        j.alive[pos - j.base] = 0
+                        j.pos_of.pop(j.ids[pos - j.base], None)
+                    changed = positions
+                    removed = len(positions)
+                else:
+                    emask = 0
+                    for e in b.triggers.analyze(text).events:
+                        emask |= b.event_bits.get(e, 0)
+                    for pos in positions:
+                        if j.emasks[pos - j.base] != emask:
+                            j.emasks[pos - j.base] = emask
+                            changed.append(pos)
+                replayed = 0
+                if changed:
+                    if cs.pending is not None:
+                        self._deliver(chat_id, self._settle(cs, True))
+                    replayed = self._replay_edits(chat_id, cs, min(changed), max(changed), removed)
+                    self.edits_applied += 1
+                    self.edit_steps += replayed
+                    if self.persistence is not None:
+                        self.dirty.add(chat_id)
+                return {'state': cs.state, 'risk': cs.risk, 'ltlf': self._verdicts(b, cs.ltlf_states),
+                        'step': cs.history.total - 1, 'replayed': replayed}
+
+    def _replay_edits(self, chat_id: str, cs: ChatState, first: int, last: int, removed: int) -> int:
+        """Откат к контрольной точке перед first и перепрогон журнала (под cs.lock).
+
+        На каждой следующей точке после last состояние сравнивается с
+        сохранённым: совпало — дальше всё как было. В истории чата
+        переписываются только перепрогнанные шаги (removed — сколько из них
+        только что удалено). Возвращает число перепрогнанных шагов.
+        """
+        b = cs.bundle
+        j = cs.edits
+        cp = j.checkpoint_before(first)
+        sid, count, risk, ltlf = j.checkpoints[cp]
+        ltlf = [copy.copy(x) if isinstance(x, LTLfMonitor) else x for x in ltlf]
+        meter = RiskMeter(b.cfg, b.triggers)
+        meter.value = risk
+        event_bits = list(b.event_bits.items())
+        n = 0
+        steps: List[Tuple[int, int]] = []
+        converged = False
+        stop = j.end
+        for pos in range(cp, j.end):
+            i = pos - j.base
+            if pos != cp and i % j.every == 0:
+                if pos > last and self._same_checkpoint(j.checkpoints[pos], sid, count, meter.value, ltlf):
+                    converged = True
+                    stop = pos
+                    break
+                j.checkpoints[pos] = (sid, count, meter.value,
+                                      [copy.copy(x) if isinstance(x, LTLfMonitor) else x for x in ltlf])
+            if not j.alive[i]:
+                continue
+            emask = j.emasks[i]
+            sid, count = b.table.step(sid, count, emask)
+            j.sids[i] = sid
+            meter.update(b.table.states[sid], {e for e, bit in event_bits if emask & bit})
+            pmask = b.pred_mask(emask, sid)
+            for k, (_, _, _, dfa) in enumerate(b.ltlf_rules):
+                if dfa is not None:
+                    ltlf[k] = dfa.table[ltlf[k]][pmask & dfa.mask]
+                else:
+                    ltlf[k].step(MaskPreds(pmask, b.pred_bits))
+            steps.append((pmask, sid))
+            n += 1
+        if not converged:
+            cs.state = b.table.states[sid]
+            cs.risk = meter.value
+            cs.ltlf_states = ltlf
+            self.risk_meters[chat_id].value = meter.value
+            self.cooling_mgr.neutral_counts[chat_id] = count
+        tail = j.alive[stop - j.base:].count(1)
+        cs.history.splice(tail, len(steps) + removed, steps)
+        return n
+
+    @staticmethod
+    def _same_checkpoint(old: Tuple[Any, ...], sid: int, count: int, risk: int, ltlf: List[Any]) -> bool:
+        if old[:3] != (sid, count, risk):
+            return False
+        return all(x._res == y._res if isinstance(x, LTLfMonitor) else x == y for x, y in zip(old[3], ltlf))
+
+    def metrics_snapshot(self) -> Optional[Dict[str, Any]]:
+        return self.metrics.snapshot() if self.metrics is not None else None
+
+    def _step_ltlf_timed(self, b: RulesBundle, cs: ChatState, pmask: int,
+                         costs: List[Tuple[str, float]]) -> List[Dict[str, Any]]:
+        # то же, что цикл по правилам в process_message, с замером каждого правила
+        clock = time.perf_counter
+        out = []
+        for i, (rid, desc, _, dfa) in enumerate(b.ltlf_rules):
+            t0 = clock()
+            if dfa is not None:
+                q = dfa.table[cs.ltlf_states[i]][pmask & dfa.mask]
+                cs.ltlf_states[i] = q
+                ok = dfa.accepting[q]
+            else:
+                ok = cs.ltlf_states[i].step(MaskPreds(pmask, b.pred_bits))
+            costs.append((rid, clock() - t0))
+            out.append({'id': rid, 'ok': ok, 'description': desc})
+        return out
+
+    def process_message(self, chat_id: str, text: str, user: Optional[str] = None,
+                        hints: bool = True, msg_id: Optional[int] = None,
+                        source_pos: Any = None) -> Dict[str, Any]:
+        """Шаг чата; msg_id — id сообщения в Telegram для edit_message/delete_messages,
+        source_pos — позиция сообщения во внешнем источнике (см. position)."""
+        if not self._shedding:
+            return self._process_message(chat_id, text, user, hints, msg_id, None, source_pos)
+        with self._load_lock:
+            self._inflight += 1
+        try:
+            return self._process_message(chat_id, text, user, hints, msg_id, time.perf_counter(), source_pos)
+        finally:
+            with self._load_lock:
+                self._inflight -= 1
+
+    def _process_message(self, chat_id: str, text: str, user: Optional[str], hints: bool,
+                         msg_id: Optional[int], started: Optional[float], source_pos: Any) -> Dict[str, Any]:
+        m = self.metrics
+        if m is not None:
+            # замеры этапов копятся локально и уходят в Metrics одним вызовом
+            clock = time.perf_counter
+            t_start = clock()
+            detail = m.detail()
+            st = [0.0] * len(STAGES)
+            tcosts = rcosts = None
+        b = None
+        late = None
+        while True:
+            if b is not self.bundle:
+                # весь шаг считается на одном бандле, даже если его подменят посреди
+                b = self.bundle
+                if m is None:
+                    analysis = b.triggers.analyze(text)
+                else:
+                    t0 = clock()
+                    tcosts = [[0, 0.0] for _ in b.triggers.compiled] if detail else None
+                    analysis = b.triggers.analyze(text, tcosts)
+                    st[0] += clock() - t0
+                events: Set[str] = analysis.events
+                emask = 0
+                for e in events:
+                    emask |= b.event_bits.get(e, 0)
+
+            cs = self.get_chat(chat_id)
+            if m is not None:
+                t0 = clock()
+            with cs.lock:
+                if m is not None:
+                    t1 = clock()
+                    st[1] += t1 - t0
+                if cs.evicted:
+                    continue
+                if cs.bundle is not b:
+                    if b is not self.bundle:
+                        continue  # чат уже на более новых правилах
+                    self._restore(chat_id, cs, self._snapshot(chat_id, cs), b)
+                count = self.cooling_mgr.neutral_counts.get(chat_id, 0)
+                mark = None
+                if cs.edits is not None and cs.edits.due():
+                    mark = self._checkpoint(chat_id, cs, count)
+                sid, count = b.table.step(b.table.state_id[cs.state], count, emask)
+                self.cooling_mgr.neutral_counts[chat_id] = count
+                final_next_state = b.table.states[sid]
+                if m is not None:
+                    t2 = clock()
+                    st[2] += t2 - t1
+                risk = self.risk_meters[chat_id].update(final_next_state, events)
+                if m is not None:
+                    t3 = clock()
+                    st[3] += t3 - t2
+
+                pmask = b.pred_mask(emask, sid)
+                cs.history.append(pmask, sid)
+                cs.state = final_next_state
+                cs.risk = risk
+                if source_pos is not None:
+                    cs.source_pos = source_pos
+                step = cs.history.total - 1
+                if cs.edits is not None:
+                    cs.edits.append(emask, sid, msg_id, mark)
+
+                if m is not None:
+                    t4 = clock()
+                    st[4] += t4 - t3
+                if started is not None:
+                    over = self._overloaded(started)
+                    if over or cs.pending is not None:
+                        ltlf_results, late = self._step_ltlf_slow(chat_id, b, cs, pmask, over)
+                        if m is not None:
+                            st[5] += clock() - t4
+                        break
+                if m is not None:
+                    if detail:
+                        rcosts = []
+                        ltlf_results = self._step_ltlf_timed(b, cs, pmask, rcosts)
+                        st[5] += clock() - t4
+                        break
+                ltlf_results = []
+                for i, (rid, desc, _, dfa) in enumerate(b.ltlf_rules):
+                    if dfa is not None:
+                        q = dfa.table[cs.ltlf_states[i]][pmask & dfa.mask]
+                        cs.ltlf_states[i] = q
+                        ok = dfa.accepting[q]
+                    else:
+                        ok = cs.ltlf_states[i].step(MaskPreds(pmask, b.pred_bits))
+                    ltlf_results.append({'id': rid, 'ok': ok, 'description': desc})
+                if m is not None:
+                    st[5] += clock() - t4
+                break
+
+        if late:
+            self._deliver(chat_id, late)
+        if m is not None:
+            t0 = clock()
+        # hints=False — для пакетной обработки, где подсказки не нужны
+        hint_list = pick_hints(b.cfg, b.triggers, text, final_next_state, events,
+                               user=user, message=text, analysis=analysis) if hints else []
+        if m is not None:
+            t1 = clock()
+            st[6] = t1 - t0
+
+        if self.persistence is not None:
+            self.dirty.add(chat_id)
+            self._updates += 1
+            if (self._updates >= self.persistence.flush_every
+                    or time.monotonic() - self._last_flush >= self.persistence.flush_interval):
+                self.flush()
+
+        if m is not None:
+            t2 = clock()
+            st[7] = t2 - t1
+            st[8] = t2 - t_start
+            trig = None
+            if tcosts is not None:
+                trig = [(tr.event, int(c[0]), tr.event in events, c[1])
+                        for (tr, _), c in zip(b.triggers.compiled, tcosts)]
+            m.record_message(st, trig, rcosts)
+
+        res = {
             'state': final_next_state,
             'risk': risk,
             'events': sorted(list(events)),
             'ltlf': ltlf_results,
-            'hints': hints,
+            'hints': hint_list,
+            'analysis': analysis,
+            'step': step,
         }
+        if ltlf_results is None:
+            # вердикт по правилам придёт через on_verdict с этим же step
+            res['ltlf'] = []
+            res['ltlf_deferred'] = True
+        return res
@@ -2,14 +2,14 @@ from __future__ import annotations
 from typing import List, Dict, Set, Optional
 import random
 import re
-from .triggers import TriggerMatcher
+from .triggers import TriggerMatcher, MessageAnalysis
 
 
 def pick_hints(cfg, trigger_matcher: TriggerMatcher, text: str, state: str, events: Set[str], count: int = 2,
-               user: str = None, message: str = None) -> List[str]:
+               user: str = None, message: str = None, analysis: Optional[MessageAnalysis] = None) -> List[str]:
     res: List[str] = []
 
-    events_matches = trigger_matcher.get_matches(text)
+    events_matches = analysis.matches if analysis is not None else trigger_matcher.get_matches(text)
 
     for event in events:
         event_hints = (cfg.hints.get('on_events') or {}).get(event) or []
@@ -0,0 +1,100 @@
+from __future__ import annotations
+from array import array
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+class StepHistory:
+    """Кольцевой буфер шагов чата.
+
+    На шаг хранится маска предикатов LTLf (uint64, биты из Config.ltlf_preds)
+    и номер состояния DFA (байт). Пока буфер не заполнен, он растёт, потом
+    перезаписывает самые старые шаги. capacity=None — без ограничения.
+    """
+
+    __slots__ = ('capacity', 'pred_bits', 'masks', 'states', 'head', 'total')
+
+    def __init__(self, capacity: Optional[int], pred_bits: Dict[str, int]):
+        self.capacity = capacity
+        self.pred_bits = pred_bits
+        self.masks = array('Q')
+        self.states = bytearray()
+        self.head = 0
+        self.total = 0
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    @property
+    def offset(self) -> int:
+        # абсолютный номер самого старого из сохранённых шагов
+        return self.total - len(self.masks)
+
+    def append(self, mask: int, state_id: int) -> None:
+        if self.capacity is None or len(self.masks) < self.capacity:
+            self.masks.append(mask)
+            self.states.append(state_id)
+        elif self.capacity > 0:
+            self.masks[self.head] = mask
+            self.states[self.head] = state_id
+            self.head = (self.head + 1) % self.capacity
+        self.total += 1
+
+    def _index(self, i: int) -> int:
+        n = len(self.masks)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(i)
+        return (self.head + i) % n if self.head else i
+
+    def mask_at(self, i: int) -> int:
+        return self.masks[self._index(i)]
+
+    def state_at(self, i: int) -> int:
+        return self.states[self._index(i)]
+
+    def holds(self, i: int, pred: str) -> bool:
+        return bool(self.masks[self._index(i)] & self.pred_bits.get(pred, 0))
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        for i in range(len(self.masks)):
+            j = self._index(i)
+            yield self.masks[j], self.states[j]
+
+    def splice(self, tail: int, old: int, steps: List[Tuple[int, int]]) -> None:
+        """Заменяет old шагов, за которыми идут ещё tail последних, на steps.
+
+        Для правки задним числом: переписываются только шаги после
+        контрольной точки. Шаги, уже вытесненные из буфера, не
+        восстанавливаются — после удаления сообщений буфер на время короче.
+        """
+        if self.head:
+            h = self.head
+            self.masks = self.masks[h:] + self.masks[:h]
+            self.states = self.states[h:] + self.states[:h]
+            self.head = 0
+        end = max(len(self.masks) - tail, 0)
+        start = max(end - old, 0)
+        keep = steps[max(0, len(steps) - (end - start)):]
+        self.masks[start:end] = array('Q', [m for m, _ in keep])
+        self.states[start:end] = bytes(sid for _, sid in keep)
+        self.total += len(steps) - old
+
+    def dump(self) -> Tuple[Any, ...]:
+        # шаги в логическом порядке, без ссылки на общую таблицу битов
+        h = self.head
+        masks = self.masks[h:] + self.masks[:h] if h else self.masks
+        states = self.states[h:] + self.states[:h] if h else self.states
+        return self.capacity, masks.tobytes(), bytes(states), self.total
+
+    @classmethod
+    def load(cls, data: Tuple[Any, ...], pred_bits: Dict[str, int]) -> 'StepHistory':
+        capacity, masks, states, total = data
+        h = cls(capacity, pred_bits)
+        h.masks.frombytes(masks)
+        h.states.extend(states)
+        if capacity is not None and len(h.states) > capacity:
+            del h.masks[:len(h.masks) - capacity]
+            del h.states[:len(h.states) - capacity]
+        h.total = total
+        return h
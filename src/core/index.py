@@ -0,0 +1,195 @@
+from __future__ import annotations
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .ltlf import (Node, Pred, Bool, Not, And, Or, Implies, Next, Within, Until, Globally, Finally,
+                   eval_formula, _key)
+
+# отрезки позиций [lo, hi), отсортированные и не пересекающиеся
+Runs = List[Tuple[int, int]]
+
+
+def _union(a: Runs, b: Runs) -> Runs:
+    out: Runs = []
+    for lo, hi in sorted(a + b):
+        if out and lo <= out[-1][1]:
+            if hi > out[-1][1]:
+                out[-1] = (out[-1][0], hi)
+        else:
+            out.append((lo, hi))
+    return out
+
+
+def _intersect(a: Runs, b: Runs) -> Runs:
+    out: Runs = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        lo, hi = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if lo < hi:
+            out.append((lo, hi))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return out
+
+
+def _complement(a: Runs, n: int) -> Runs:
+    out: Runs = []
+    pos = 0
+    for lo, hi in a:
+        if lo > pos:
+            out.append((pos, lo))
+        pos = hi
+    if pos < n:
+        out.append((pos, n))
+    return out
+
+
+def _clip(a: Iterable[Tuple[int, int]], n: int) -> Runs:
+    return _union([(max(lo, 0), min(hi, n)) for lo, hi in a if min(hi, n) > max(lo, 0)], [])
+
+
+class TraceIndex:
+    """Индекс вхождений предикатов трассы для темпоральных запросов.
+
+    Для каждого предиката (события или S_<состояние>) хранятся позиции,
+    где он выполнен, — отсортированными отрезками подряд идущих шагов
+    (starts/ends), так что и редкие события, и длинные состояния занимают
+    мало места. Запрос считается по отрезкам: F, G, Within_k и U — через
+    ближайшее вхождение (bisect), без прохода по всем позициям. Значение
+    в позиции i совпадает с eval_formula(node, trace, i).
+
+    Шаги можно дописывать (append) — индекс растёт вместе с трассой.
+    Отрезки подформул запоминаются по структуре до следующего append, так
+    что общая подформула нескольких правил считается один раз.
+    """
+
+    __slots__ = ('n', 'starts', 'ends', '_memo')
+
+    def __init__(self, trace: Optional[Iterable[Dict[str, bool]]] = None):
+        self.n = 0
+        self.starts: Dict[str, List[int]] = {}
+        self.ends: Dict[str, List[int]] = {}
+        self._memo: Dict[tuple, Runs] = {}
+        if trace is not None:
+            self.extend(trace)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def append(self, step: Dict[str, bool]) -> None:
+        """Дописывает шаг в формате build_trace_from_steps."""
+        pos = self.n
+        if self._memo:
+            self._memo = {}
+        for pred, val in step.items():
+            if not val:
+                continue
+            ends = self.ends.get(pred)
+            if ends is None:
+                self.starts[pred] = [pos]
+                self.ends[pred] = [pos + 1]
+            elif ends[-1] == pos:
+                ends[-1] = pos + 1
+            else:
+                self.starts[pred].append(pos)
+                ends.append(pos + 1)
+        self.n = pos + 1
+
+    def extend(self, trace: Iterable[Dict[str, bool]]) -> None:
+        for step in trace:
+            self.append(step)
+
+    def positions(self, pred: str) -> List[int]:
+        return [p for lo, hi in self.pred_runs(pred) for p in range(lo, hi)]
+
+    def pred_runs(self, pred: str) -> Runs:
+        return list(zip(self.starts.get(pred, ()), self.ends.get(pred, ())))
+
+    def holds(self, pred: str, i: int) -> bool:
+        starts = self.starts.get(pred)
+        if not starts:
+            return False
+        j = bisect_right(starts, i) - 1
+        return j >= 0 and i < self.ends[pred][j]
+
+    def next_occurrence(self, pred: str, i: int) -> Optional[int]:
+        """Первая позиция не раньше i, где выполнен pred, или None."""
+        starts = self.starts.get(pred)
+        if not starts:
+            return None
+        ends = self.ends[pred]
+        j = bisect_right(ends, i)
+        if j == len(ends):
+            return None
+        return max(starts[j], i)
+
+    def runs(self, node: Node, memo: Optional[Dict[tuple, Runs]] = None) -> Runs:
+        """Отрезки позиций трассы, где формула выполнена."""
+        if memo is None:
+            memo = self._memo
+        key = _key(node)
+        out = memo.get(key)
+        if out is not None:
+            return out
+        n = self.n
+        if isinstance(node, Bool):
+            out = [(0, n)] if node.val and n else []
+        elif isinstance(node, Pred):
+            out = self.pred_runs(node.name)
+        elif isinstance(node, Not):
+            out = _complement(self.runs(node.child, memo), n)
+        elif isinstance(node, And):
+            out = _intersect(self.runs(node.left, memo), self.runs(node.right, memo))
+        elif isinstance(node, Or):
+            out = _union(self.runs(node.left, memo), self.runs(node.right, memo))
+        elif isinstance(node, Implies):
+            out = _union(_complement(self.runs(node.left, memo), n), self.runs(node.right, memo))
+        elif isinstance(node, Next):
+            out = _clip(((lo - node.k, hi - node.k) for lo, hi in self.runs(node.child, memo)), n)
+        elif isinstance(node, Within):
+            # φ на отрезке [lo, hi) — Within(φ, k) на [lo - k, hi - 1)
+            out = _clip(((lo - node.k, hi - 1) for lo, hi in self.runs(node.child, memo)), n)
+        elif isinstance(node, Finally):
+            child = self.runs(node.child, memo)
+            out = [(0, child[-1][1])] if child else []
+        elif isinstance(node, Globally):
+            child = self.runs(node.child, memo)
+            out = [(child[-1][0], n)] if child and child[-1][1] == n else []
+        elif isinstance(node, Until):
+            # right на [lo, hi) даёт сам отрезок и хвост отрезка left,
+            # вплотную подходящего к lo
+            left = self.runs(node.left, memo)
+            lstarts = [lo for lo, _ in left]
+            parts = []
+            for lo, hi in self.runs(node.right, memo):
+                parts.append((lo, hi))
+                j = bisect_right(lstarts, lo - 1) - 1
+                if j >= 0 and left[j][1] >= lo:
+                    parts.append((left[j][0], lo))
+            out = _clip(parts, n)
+        else:
+            raise TypeError('Неизвестный узел')
+        memo[key] = out
+        return out
+
+    def eval(self, node: Node, i: int = 0) -> bool:
+        if i >= self.n:
+            # за концом трассы все подформулы видят пустой суффикс
+            return eval_formula(node, [], 0)
+        runs = self.runs(node)
+        j = bisect_right(runs, (i, float('inf'))) - 1
+        return j >= 0 and i < runs[j][1]
+
+    def witnesses(self, node: Node) -> List[int]:
+        """Позиции, где формула нарушена.
+
+        Для G φ — все позиции, где не выполнена φ (например, для
+        G(INSULT → Within_k(APOLOGY, 10)) — оскорбления без извинения);
+        для прочих формул — [0], если формула не выполнена в начале.
+        """
+        if isinstance(node, Globally):
+            bad = _complement(self.runs(node.child), self.n)
+            return [p for lo, hi in bad for p in range(lo, hi)]
+        return [] if self.eval(node, 0) else [0]
@@ -1,6 +1,12 @@
 from __future__ import annotations
+import time
 from dataclasses import dataclass
-from typing import List, Tuple, Optional, Set, Dict, Any
+from typing import List, Tuple, Optional, Set, Dict, Any, FrozenSet, Callable
+
+try:
+    import numpy as np
+except ImportError:  # нужен только для eval_batch
+    np = None
 
 
 # ---------------- Lexer ----------------
@@ -14,6 +20,10 @@ class Token:
         return f"Token({self.typ},{self.val})"
 
 
+# операторы с синтаксисом вызова: Within_k(φ, k), NoNext(φ)
+_CALLS = {'Within_k': 'WITHIN', 'Within': 'WITHIN', 'NoNext': 'NONEXT'}
+
+
 def tokenize(s: str) -> List[Token]:
     import re
     i = 0
@@ -27,10 +37,17 @@ def tokenize(s: str) -> List[Token]:
             toks.append(Token('IMPLIES', '->'));
             i += 2 if s.startswith('->', i) else 1;
             continue
-        if c in '()':
+        if c in '(),':
             toks.append(Token(c, c));
             i += 1;
             continue
+        if c.isdigit():
+            j = i
+            while j < len(s) and s[j].isdigit():
+                j += 1
+            toks.append(Token('NUM', s[i:j]))
+            i = j
+            continue
         if c in '!¬':
             toks.append(Token('NOT', c));
             i += 1;
@@ -43,41 +60,27 @@ def tokenize(s: str) -> List[Token]:
             toks.append(Token('OR', c));
             i += 1;
             continue
-        if c == 'G':
-            toks.append(Token('G', 'G'));
-            i += 1;
-            continue
-        if c == 'F':
-            toks.append(Token('F', 'F'));
-            i += 1;
-            continue
-        if c == 'X':
-            # maybe X^n
-            j = i + 1
-            if j < len(s) and s[j] == '^':
-                k = j + 1
-                num = ''
+
+        # операторы G, F, X, U — только отдельные слова: FOO или UNDO — предикаты
+        m = re.match(r'[A-Za-zА-Яа-яЁё_][A-Za-z0-9А-Яа-яЁё_]*', s[i:])
+        if m:
+            ident = m.group(0)
+            i += len(ident)
+            if ident == 'X' and s.startswith('^', i):
+                # X^n
+                k = i + 1
                 while k < len(s) and s[k].isdigit():
-                    num += s[k];
                     k += 1
-                if not num:
+                if k == i + 1:
                     raise ValueError('После X^ ожидается число')
-                toks.append(Token('XPOW', num))
+                toks.append(Token('XPOW', s[i + 1:k]))
                 i = k
+            elif ident in ('G', 'F', 'X', 'U'):
+                toks.append(Token(ident, ident))
+            elif ident in _CALLS:
+                toks.append(Token(_CALLS[ident], ident))
             else:
-                toks.append(Token('X', 'X'));
-                i += 1
-            continue
-        if s.startswith('U', i):
-            toks.append(Token('U', 'U'));
-            i += 1;
-            continue
-
-        m = re.match(r'[A-Za-zА-Яа-яЁё_][A-Za-z0-9А-Яа-яЁё_]*', s[i:])
-        if m:
-            ident = m.group(0)
-            toks.append(Token('ID', ident))
-            i += len(ident);
+                toks.append(Token('ID', ident))
             continue
 
         raise ValueError(f'Неожиданный символ в формуле: {c!r} at {i}')
@@ -130,6 +133,13 @@ class Until(Node):
     right: Node
 
 
+@dataclass
+class Within(Node):
+    # φ хотя бы на одном из следующих k шагов (X φ ∨ X^2 φ ∨ … ∨ X^k φ)
+    child: Node;
+    k: int
+
+
 @dataclass
 class Globally(Node):
     child: Node
@@ -229,6 +239,22 @@ class Parser:
         if t.typ == 'XPOW':
             k = int(self.eat('XPOW').val or '1')
             return Next(self.parse_unary(), k=k)
+        if t.typ == 'WITHIN':
+            self.eat('WITHIN')
+            self.eat('(')
+            child = self.parse_implication()
+            self.eat(',')
+            k = int(self.eat('NUM').val)
+            self.eat(')')
+            if k < 1:
+                raise ValueError('Within_k: k должно быть не меньше 1')
+            return Within(child, k)
+        if t.typ == 'NONEXT':
+            self.eat('NONEXT')
+            self.eat('(')
+            child = self.parse_implication()
+            self.eat(')')
+            return Not(Next(child, k=1))
         if t.typ == '(':
             self.eat('(')
             node = self.parse_implication()
@@ -242,46 +268,19 @@ class Parser:
         raise ValueError(f'Неожиданный токен: {t}')
 
 
-# ---------------- Macro expansion helpers ----------------
-
-def expand_macros(formula: str) -> str:
-    import re
-
-    def repl_within(match: re.Match) -> str:
-        inner = match.group('phi').strip()
-        k = int(match.group('k'))
-        parts = []
-        for i in range(1, k + 1):
-            if i == 1:
-                parts.append(f"X ({inner})")
-            else:
-                parts.append(f"X^{i} ({inner})")
-        return ' ∨ '.join(parts)
-
-    pattern = re.compile(r"Within_k\( (?P<phi>.+?) , \s*(?P<k>\d+) \)", re.X)
-
-    prev = None
-    while prev != formula:
-        prev = formula
-        formula = re.sub(pattern, repl_within, formula)
-
-    pattern2 = re.compile(r"NoNext\( (?P<phi>.+?) \)", re.X)
-    while True:
-        newf = re.sub(pattern2, lambda m: f"¬X ({m.group('phi')})", formula)
-        if newf == formula: break
-        formula = newf
-    return formula
-
-
 # ---------------- Evaluation ----------------
 
-def eval_formula(node: Node, trace: List[Dict[str, bool]], i: int = 0) -> bool:
+def eval_formula(node: Node, trace, i: int = 0) -> bool:
+    # trace — список словарей из build_trace_from_steps либо StepHistory
+    # (маски предикатов читаются напрямую, без перевода в словари)
     n = len(trace)
+    holds = trace.holds if hasattr(trace, 'pred_bits') else (lambda pos, name: bool(trace[pos].get(name, False)))
+    nearest: Dict[int, Optional[List[int]]] = {}
 
     def ev(nod: Node, pos: int) -> bool:
         if isinstance(nod, Bool): return nod.val
         if isinstance(nod, Pred):
-            return bool(trace[pos].get(nod.name, False)) if 0 <= pos < n else False
+            return holds(pos, nod.name) if 0 <= pos < n else False
         if isinstance(nod, Not):
             return not ev(nod.child, pos)
         if isinstance(nod, And):
@@ -294,6 +293,23 @@ def eval_formula(node: Node, trace: List[Dict[str, bool]], i: int = 0) -> bool:
             nxt = pos + nod.k
             if nxt >= n: return False
             return ev(nod.child, nxt)
+        if isinstance(nod, Within):
+            table = nearest.get(id(nod))
+            if table is None:
+                if id(nod) not in nearest:
+                    # первый запрос — ограниченный просмотр окна; если узел
+                    # спрашивают снова (под G/F/U), строится таблица ближайших
+                    # позиций, где φ выполнена, и дальше ответ за O(1) при любом k
+                    nearest[id(nod)] = None
+                    for j in range(pos + 1, min(pos + nod.k, n - 1) + 1):
+                        if ev(nod.child, j): return True
+                    return False
+                table = [n] * (n + 1)
+                for j in range(n - 1, -1, -1):
+                    table[j] = j if ev(nod.child, j) else table[j + 1]
+                nearest[id(nod)] = table
+            j = table[pos + 1] if pos < n else n
+            return j < n and j <= pos + nod.k
         if isinstance(nod, Finally):
             for j in range(pos, n):
                 if ev(nod.child, j): return True
@@ -315,12 +331,35 @@ def eval_formula(node: Node, trace: List[Dict[str, bool]], i: int = 0) -> bool:
 
 
 def parse_formula(s: str) -> Node:
-    s = expand_macros(s)
     tokens = tokenize(s)
     return Parser(tokens).parse()
 
 
-def build_trace_from_steps(steps: List[Dict[str, Any]]) -> List[Dict[str, bool]]:
+class MaskPreds:
+    # словарный интерфейс (get) над маской предикатов одного шага
+    __slots__ = ('mask', 'bits')
+
+    def __init__(self, mask: int, bits: Dict[str, int]):
+        self.mask = mask
+        self.bits = bits
+
+    def get(self, name: str, default: bool = False) -> bool:
+        b = self.bits.get(name)
+        return bool(self.mask & b) if b else default
+
+
+def temporal_depth(node: Node) -> int:
+    # на сколько шагов вперёд заглядывают ограниченные операторы (X^k)
+    if isinstance(node, (Pred, Bool)): return 0
+    if isinstance(node, (Next, Within)): return node.k + temporal_depth(node.child)
+    if isinstance(node, (Not, Globally, Finally)): return temporal_depth(node.child)
+    return max(temporal_depth(node.left), temporal_depth(node.right))
+
+
+def build_trace_from_steps(steps: List[Dict[str, Any]],
+                           derived: Optional[Dict[str, Node]] = None) -> List[Dict[str, bool]]:
+    # derived — производные предикаты шага (Config.derived_preds): формулы
+    # над событиями и S_<состояние>
     res = []
     for st in steps:
         d: Dict[str, bool] = {}
@@ -331,5 +370,726 @@ def build_trace_from_steps(steps: List[Dict[str, Any]]) -> List[Dict[str, bool]]
         if state:
             d[f'S_{state}'] = True
 
+        for name, node in (derived or {}).items():
+            if eval_formula(node, [d]):
+                d[name] = True
+
         res.append(d)
     return res
+
+
+# ---------------- Shared DAG (hash-consing) ----------------
+#
+# Правила сливаются в один граф: структурно равные подформулы (с точностью до
+# порядка операндов ∧/∨) — один и тот же объект узла. Перед поиском в таблице
+# узел упрощается: ¬¬φ → φ, свёртка констант, φ ∧ φ → φ, φ ∧ ¬φ → false (и
+# двойственно для ∨), X^a X^b φ → X^(a+b) φ, F F φ → F φ, G G φ → G φ.
+# Свёртки сохраняют семантику eval_formula на конечных трассах, поэтому,
+# например, X true и F true не сворачиваются: в конце трассы они ложны.
+
+def tree_size(node: Node) -> int:
+    if isinstance(node, (Pred, Bool)): return 1
+    if isinstance(node, (Not, Next, Within, Globally, Finally)): return 1 + tree_size(node.child)
+    return 1 + tree_size(node.left) + tree_size(node.right)
+
+
+class FormulaDAG:
+    """Формулы правил в одном графе с общими подформулами.
+
+    add() возвращает корень формулы в графе; evaluate() считает все корни в
+    позиции трассы, и каждый узел в каждой позиции вычисляется один раз на
+    все правила.
+    """
+
+    def __init__(self):
+        self.table: Dict[tuple, Node] = {}
+        self.index: Dict[int, int] = {}  # id узла -> номер в таблице
+        self.roots: List[Node] = []
+        self.tree_nodes = 0
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        # после pickle у узлов другие id: номера восстанавливаются по порядку таблицы
+        self.__dict__.update(state)
+        self.index = {id(node): i for i, node in enumerate(self.table.values())}
+
+    def add(self, node: Node) -> Node:
+        self.tree_nodes += tree_size(node)
+        root = self.intern(node)
+        self.roots.append(root)
+        return root
+
+    def _cons(self, key: tuple, make: Callable[[], Node]) -> Node:
+        node = self.table.get(key)
+        if node is None:
+            node = self.table[key] = make()
+            self.index[id(node)] = len(self.index)
+        return node
+
+    def _bool(self, val: bool) -> Node:
+        return self._cons(('B', val), lambda: Bool(val))
+
+    def _not(self, x: Node) -> Node:
+        if isinstance(x, Bool): return self._bool(not x.val)
+        if isinstance(x, Not): return x.child
+        return self._cons(('!', self.index[id(x)]), lambda: Not(x))
+
+    def _junction(self, typ: type, parts: List[Node]) -> Node:
+        unit, zero = typ is And, typ is Or  # нейтральный и поглощающий элементы
+        ops: Dict[int, Node] = {}
+        for x in parts:
+            for y in _flatten(x, typ):
+                if isinstance(y, Bool):
+                    if y.val == zero: return self._bool(zero)
+                    continue
+                ops[self.index[id(y)]] = y
+        for y in ops.values():
+            if isinstance(y, Not) and self.index[id(y.child)] in ops:
+                return self._bool(zero)
+        if not ops:
+            return self._bool(unit)
+        order = sorted(ops)
+        node = ops[order[0]]
+        for j, i in enumerate(order[1:], 2):
+            left, right = node, ops[i]
+            node = self._cons((typ.__name__,) + tuple(order[:j]), lambda: typ(left, right))
+        return node
+
+    def intern(self, node: Node) -> Node:
+        """Упрощённая node в графе: равные подформулы — общий объект."""
+        if isinstance(node, Bool):
+            return self._bool(node.val)
+        if isinstance(node, Pred):
+            return self._cons(('P', node.name), lambda: Pred(node.name))
+        if isinstance(node, Not):
+            return self._not(self.intern(node.child))
+        if isinstance(node, (And, Or)):
+            return self._junction(type(node), [self.intern(node.left), self.intern(node.right)])
+        if isinstance(node, Implies):
+            a, b = self.intern(node.left), self.intern(node.right)
+            if isinstance(a, Bool): return b if a.val else self._bool(True)
+            if isinstance(b, Bool): return self._bool(True) if b.val else self._not(a)
+            if a is b: return self._bool(True)
+            return self._cons(('->', self.index[id(a)], self.index[id(b)]), lambda: Implies(a, b))
+        child = self.intern(node.child) if not isinstance(node, Until) else None
+        if isinstance(node, Next):
+            k = node.k
+            while isinstance(child, Next):
+                k, child = k + child.k, child.child
+            return self._cons(('X', k, self.index[id(child)]), lambda: Next(child, k))
+        if isinstance(node, Within):
+            if isinstance(child, Bool) and not child.val: return child
+            return self._cons(('W', node.k, self.index[id(child)]), lambda: Within(child, node.k))
+        if isinstance(node, (Globally, Finally)):
+            typ = type(node)
+            if isinstance(child, Bool) and child.val == (typ is Globally): return child
+            if isinstance(child, typ): return child
+            return self._cons((typ.__name__, self.index[id(child)]), lambda: typ(child))
+        if isinstance(node, Until):
+            a, b = self.intern(node.left), self.intern(node.right)
+            if isinstance(b, Bool) and not b.val: return b
+            return self._cons(('U', self.index[id(a)], self.index[id(b)]), lambda: Until(a, b))
+        raise TypeError('Неизвестный узел')
+
+    def _parents(self) -> Dict[int, int]:
+        # id узла, достижимого из корней -> число разных родителей
+        parents: Dict[int, int] = {}
+        stack = list({id(r): r for r in self.roots}.values())
+        for r in stack:
+            parents[id(r)] = 0
+        while stack:
+            x = stack.pop()
+            kids = {id(c): c for c in (getattr(x, f, None) for f in ('child', 'left', 'right')) if c is not None}
+            for cid, c in kids.items():
+                if cid not in parents:
+                    parents[cid] = 0
+                    stack.append(c)
+                parents[cid] += 1
+        return parents
+
+    def stats(self) -> Dict[str, Any]:
+        parents = self._parents()
+        dag = len(parents)
+        return {'rules': len(self.roots), 'tree_nodes': self.tree_nodes, 'dag_nodes': dag,
+                'shared_nodes': sum(1 for c in parents.values() if c > 1),
+                'shared': 1 - dag / self.tree_nodes if self.tree_nodes else 0.0}
+
+    def evaluate(self, trace, i: int = 0) -> List[bool]:
+        """Значения всех корней в позиции i, как eval_formula для каждого."""
+        fns = self.compile(trace)
+        return [fns[id(root)](i) for root in self.roots]
+
+    def timing(self, trace, repeat: int = 3) -> Dict[str, float]:
+        """Замер на трассе: все правила по отдельности (eval_formula) и графом, лучшее из repeat, мс."""
+        def best(fn: Callable[[], Any]) -> float:
+            out = float('inf')
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                fn()
+                out = min(out, time.perf_counter() - t0)
+            return 1000 * out
+        tree = best(lambda: [eval_formula(root, trace, 0) for root in self.roots])
+        dag = best(lambda: self.evaluate(trace, 0))
+        return {'steps': len(trace), 'tree_ms': tree, 'dag_ms': dag}
+
+    def compile(self, trace) -> Dict[int, Callable[[int], bool]]:
+        """Функции pos -> bool для узлов графа над трассой, по id узла.
+
+        Узел превращается в замыкание один раз на трассу, без разбора типа на
+        каждом шаге. Значения узлов с несколькими родителями (кроме
+        предикатов и констант) запоминаются по позициям и общие для всех
+        правил; остальные и так спрашиваются в позиции один раз на корень.
+        """
+        n = len(trace)
+        if hasattr(trace, 'pred_bits'):
+            def pred(name: str) -> Callable[[int], bool]:
+                bit = trace.pred_bits.get(name, 0)
+                return lambda pos: 0 <= pos < n and bool(trace.mask_at(pos) & bit)
+        else:
+            def pred(name: str) -> Callable[[int], bool]:
+                return lambda pos: 0 <= pos < n and bool(trace[pos].get(name, False))
+        parents = self._parents()
+        fns: Dict[int, Callable[[int], bool]] = {}
+
+        def build(node: Node) -> Callable[[int], bool]:
+            f = fns.get(id(node))
+            if f is not None:
+                return f
+            if isinstance(node, Bool):
+                val = node.val
+                f = lambda pos: val
+            elif isinstance(node, Pred):
+                f = pred(node.name)
+            else:
+                f = _closure(node, n, build)
+                if parents.get(id(node), 0) > 1:
+                    f = _memoized(f)
+            fns[id(node)] = f
+            return f
+
+        for root in self.roots:
+            build(root)
+        return fns
+
+
+def _memoized(f: Callable[[int], bool]) -> Callable[[int], bool]:
+    seen: Dict[int, bool] = {}
+
+    def g(pos: int) -> bool:
+        v = seen.get(pos)
+        if v is None:
+            v = seen[pos] = f(pos)
+        return v
+    return g
+
+
+def _closure(node: Node, n: int, build: Callable[[Node], Callable[[int], bool]]) -> Callable[[int], bool]:
+    # семантика та же, что у ev в eval_formula
+    if isinstance(node, Not):
+        c = build(node.child)
+        return lambda pos: not c(pos)
+    if isinstance(node, And):
+        a, b = build(node.left), build(node.right)
+        return lambda pos: a(pos) and b(pos)
+    if isinstance(node, Or):
+        a, b = build(node.left), build(node.right)
+        return lambda pos: a(pos) or b(pos)
+    if isinstance(node, Implies):
+        a, b = build(node.left), build(node.right)
+        return lambda pos: (not a(pos)) or b(pos)
+    if isinstance(node, Next):
+        c, k = build(node.child), node.k
+        return lambda pos: pos + k < n and c(pos + k)
+    if isinstance(node, Within):
+        c, k = build(node.child), node.k
+        table: List[Optional[List[int]]] = []
+
+        def within(pos: int) -> bool:
+            if not table:
+                # первый запрос — просмотр окна, дальше таблица ближайших позиций
+                table.append(None)
+                for j in range(pos + 1, min(pos + k, n - 1) + 1):
+                    if c(j): return True
+                return False
+            near = table[0]
+            if near is None:
+                near = table[0] = [n] * (n + 1)
+                for j in range(n - 1, -1, -1):
+                    near[j] = j if c(j) else near[j + 1]
+            j = near[pos + 1] if pos < n else n
+            return j < n and j <= pos + k
+        return within
+    if isinstance(node, Finally):
+        c = build(node.child)
+
+        def finally_(pos: int) -> bool:
+            for j in range(pos, n):
+                if c(j): return True
+            return False
+        return finally_
+    if isinstance(node, Globally):
+        c = build(node.child)
+
+        def globally(pos: int) -> bool:
+            for j in range(pos, n):
+                if not c(j): return False
+            return True
+        return globally
+    if isinstance(node, Until):
+        a, b = build(node.left), build(node.right)
+
+        def until(pos: int) -> bool:
+            for j in range(pos, n):
+                if b(j):
+                    for k in range(pos, j):
+                        if not a(k): return False
+                    return True
+            return False
+        return until
+    raise TypeError('Неизвестный узел')
+
+
+# ---------------- Batch evaluation (NumPy) ----------------
+#
+# Для переоценки архивных чатов: трасса превращается в матрицу bool
+# (предикаты × позиции), каждый узел считается один раз по всей трассе
+# сразу. Значение в позиции i совпадает с eval_formula(node, trace, i).
+
+def _need_numpy() -> None:
+    if np is None:
+        raise ImportError("Для пакетной оценки LTLf нужен numpy: pip install -r requirements-offline.txt")
+
+
+def trace_matrix(trace, preds: List[str]) -> 'np.ndarray':
+    """Матрица len(preds) × len(trace): выполнен ли предикат в позиции.
+
+    trace — список словарей (build_trace_from_steps) или StepHistory.
+    """
+    _need_numpy()
+    if hasattr(trace, 'pred_bits'):
+        masks = np.fromiter((m for m, _ in trace), dtype=np.uint64, count=len(trace))
+        return np.array([(masks & np.uint64(trace.pred_bits.get(p, 0))) != 0 for p in preds],
+                        dtype=bool).reshape(len(preds), len(trace))
+    n = len(trace)
+    return np.array([np.fromiter((bool(st.get(p, False)) for st in trace), dtype=bool, count=n)
+                     for p in preds], dtype=bool).reshape(len(preds), n)
+
+
+def _nearest(a: 'np.ndarray') -> 'np.ndarray':
+    # nearest[i] — первая позиция j >= i, где a[j]; len(a), если таких нет.
+    # На элемент длиннее a, чтобы nearest[i + 1] было определено и для последней позиции
+    n = len(a)
+    idx = np.where(a, np.arange(n), n)
+    return np.append(np.minimum.accumulate(idx[::-1])[::-1], n)
+
+
+def eval_batch(nodes: List[Node], trace) -> 'np.ndarray':
+    """Значения формул во всех позициях трассы: матрица bool (формулы × позиции).
+
+    Общие подформулы разных правил считаются один раз. F и G — обратные
+    накопленные OR/AND, X^k — сдвиг, Within_k и U — через ближайшую
+    позицию, где выполнен аргумент.
+    """
+    _need_numpy()
+    preds = sorted(set().union(*(formula_preds(n) for n in nodes))) if nodes else []
+    m = trace_matrix(trace, preds)
+    rows = {p: m[i] for i, p in enumerate(preds)}
+    n = m.shape[1]
+    memo: Dict[tuple, 'np.ndarray'] = {}
+
+    def ev(node: Node) -> 'np.ndarray':
+        key = _key(node)
+        out = memo.get(key)
+        if out is not None:
+            return out
+        if isinstance(node, Bool):
+            out = np.full(n, node.val, dtype=bool)
+        elif isinstance(node, Pred):
+            out = rows[node.name]
+        elif isinstance(node, Not):
+            out = ~ev(node.child)
+        elif isinstance(node, And):
+            out = ev(node.left) & ev(node.right)
+        elif isinstance(node, Or):
+            out = ev(node.left) | ev(node.right)
+        elif isinstance(node, Implies):
+            out = ~ev(node.left) | ev(node.right)
+        elif isinstance(node, Next):
+            a = ev(node.child)
+            out = np.zeros(n, dtype=bool)
+            if node.k < n:
+                out[:n - node.k] = a[node.k:]
+        elif isinstance(node, Within):
+            near = _nearest(ev(node.child))[1:]
+            out = (near < n) & (near <= np.arange(n) + node.k)
+        elif isinstance(node, Finally):
+            out = np.logical_or.accumulate(ev(node.child)[::-1])[::-1]
+        elif isinstance(node, Globally):
+            out = np.logical_and.accumulate(ev(node.child)[::-1])[::-1]
+        elif isinstance(node, Until):
+            # первая позиция с right не позже первого нарушения left
+            near_b = _nearest(ev(node.right))[:n]
+            near_fail = _nearest(~ev(node.left))[:n]
+            out = (near_b < n) & (near_fail >= near_b)
+        else:
+            raise TypeError('Неизвестный узел')
+        memo[key] = out
+        return out
+
+    if not nodes:
+        return np.zeros((0, n), dtype=bool)
+    return np.stack([ev(node) for node in nodes])
+
+
+# ---------------- Online monitoring (formula progression) ----------------
+#
+# Прогрессия переписывает формулу после прочтения очередного шага трассы так,
+# что остаток (residual) описывает обязательства на оставшийся суффикс:
+#   eval(φ, a·u, 0) == eval(prog(φ, a), u, 0)
+# Вердикт по уже прочитанному префиксу — значение остатка на пустом суффиксе.
+# Next(φ, k=0) внутри остатка означает «φ в текущей позиции, и она существует»
+# (сильный X из eval_formula).
+#
+# Остаток хранится в ДНФ над темпоральными литералами (X/F/G/U-подформулы и их
+# отрицания) с поглощением, поэтому множество возможных остатков конечно и
+# шаг не зависит от длины истории.
+
+_Lit = Tuple[tuple, bool]
+_DNF = FrozenSet[FrozenSet[_Lit]]
+_TRUE: _DNF = frozenset([frozenset()])
+_FALSE: _DNF = frozenset()
+_ATOMS: Dict[tuple, Node] = {}
+_ATOM_EMPTY: Dict[tuple, bool] = {}
+
+
+def _key(node: Node) -> tuple:
+    if isinstance(node, Bool): return ('B', node.val)
+    if isinstance(node, Pred): return ('P', node.name)
+    if isinstance(node, Not): return ('!', _key(node.child))
+    if isinstance(node, (And, Or)):
+        return ('&' if isinstance(node, And) else '|',) + tuple(sorted(_key(x) for x in _flatten(node, type(node))))
+    if isinstance(node, Implies): return ('->', _key(node.left), _key(node.right))
+    if isinstance(node, Next): return ('X', node.k, _key(node.child))
+    if isinstance(node, Within): return ('W', node.k, _key(node.child))
+    if isinstance(node, Until): return ('U', _key(node.left), _key(node.right))
+    if isinstance(node, Globally): return ('G', _key(node.child))
+    if isinstance(node, Finally): return ('F', _key(node.child))
+    raise TypeError('Неизвестный узел')
+
+
+def _flatten(node: Node, typ: type) -> List[Node]:
+    if isinstance(node, typ):
+        return _flatten(node.left, typ) + _flatten(node.right, typ)
+    return [node]
+
+
+# Within(φ, a) влечёт Within(φ, b) при a ≤ b, поэтому в конъюнкции из
+# Within с одним φ остаётся наименьшее k (из их отрицаний — наибольшее), а
+# в дизъюнкции поглощается меньшее. Без этого остатки правил вида
+# G(p → Within(q, k)) копили бы по окну на каждое срабатывание p.
+
+def _w_implies(a: _Lit, b: _Lit) -> bool:
+    (ka, pa), (kb, pb) = a, b
+    if a == b: return True
+    if pa != pb or ka[0] != 'W' or kb[0] != 'W' or ka[2] != kb[2]: return False
+    return ka[1] <= kb[1] if pa else ka[1] >= kb[1]
+
+
+def _w_norm(c: FrozenSet[_Lit]) -> Optional[FrozenSet[_Lit]]:
+    # None — клауза противоречива
+    best: Dict[Tuple[tuple, bool], int] = {}
+    for key, pos in c:
+        if key[0] == 'W':
+            k = best.get((key[2], pos))
+            if k is None or (key[1] < k if pos else key[1] > k):
+                best[(key[2], pos)] = key[1]
+    if not best:
+        return c
+    for (child, pos), k in best.items():
+        if pos and (child, False) in best and k <= best[(child, False)]:
+            return None
+    return frozenset((key, pos) for key, pos in c if key[0] != 'W' or best[(key[2], pos)] == key[1])
+
+
+def _absorb(clauses) -> _DNF:
+    kept: List[FrozenSet[_Lit]] = []
+    clauses = sorted(set(clauses), key=len)
+    if not any(key[0] == 'W' for c in clauses for key, _ in c):
+        for c in clauses:
+            if not any(k <= c for k in kept):
+                kept.append(c)
+        return frozenset(kept)
+    # c лишняя, если из неё следует другая клауза d (из равносильных
+    # остаётся первая)
+    implies = lambda c, d: all(any(_w_implies(x, y) for x in c) for y in d)
+    for i, c in enumerate(clauses):
+        if any(implies(c, d) for d in kept):
+            continue
+        if any(implies(c, d) and not implies(d, c) for d in clauses[i + 1:]):
+            continue
+        kept.append(c)
+    return frozenset(kept)
+
+
+def _or(a: _DNF, b: _DNF) -> _DNF:
+    return _absorb(a | b)
+
+
+def _and(a: _DNF, b: _DNF) -> _DNF:
+    res = []
+    for x in a:
+        for y in b:
+            c = x | y
+            if not any((k, not p) in c for k, p in c):
+                c = _w_norm(c)
+                if c is not None:
+                    res.append(c)
+    return _absorb(res)
+
+
+def _neg(d: _DNF) -> _DNF:
+    res = _TRUE
+    for c in d:
+        res = _and(res, frozenset(frozenset([(k, not p)]) for k, p in c))
+        if not res:
+            break
+    return res
+
+
+def _atom(node: Node) -> _DNF:
+    k = _key(node)
+    _ATOMS.setdefault(k, node)
+    return frozenset([frozenset([(k, True)])])
+
+
+def _dnf(node: Node) -> _DNF:
+    if isinstance(node, Bool): return _TRUE if node.val else _FALSE
+    if isinstance(node, Not): return _neg(_dnf(node.child))
+    if isinstance(node, And): return _and(_dnf(node.left), _dnf(node.right))
+    if isinstance(node, Or): return _or(_dnf(node.left), _dnf(node.right))
+    if isinstance(node, Implies): return _or(_neg(_dnf(node.left)), _dnf(node.right))
+    return _atom(node)
+
+
+def _prog_atom(node: Node, preds: Dict[str, bool]) -> _DNF:
+    if isinstance(node, Pred):
+        return _TRUE if preds.get(node.name, False) else _FALSE
+    if isinstance(node, Next):
+        if node.k == 0: return _prog(_dnf(node.child), preds)
+        return _atom(Next(node.child, node.k - 1))
+    if isinstance(node, Finally):
+        return _or(_prog(_dnf(node.child), preds), _atom(node))
+    if isinstance(node, Within):
+        # окно сдвигается: φ на новом шаге либо в оставшихся k-1
+        res = _atom(Next(node.child, 0))
+        return _or(res, _atom(Within(node.child, node.k - 1))) if node.k > 1 else res
+    if isinstance(node, Globally):
+        return _and(_prog(_dnf(node.child), preds), _atom(node))
+    if isinstance(node, Until):
+        return _or(_prog(_dnf(node.right), preds),
+                   _and(_prog(_dnf(node.left), preds), _atom(node)))
+    raise TypeError('Неизвестный узел')
+
+
+def _prog(d: _DNF, preds: Dict[str, bool]) -> _DNF:
+    res = _FALSE
+    for clause in d:
+        c = _TRUE
+        for k, pos in clause:
+            x = _prog_atom(_ATOMS[k], preds)
+            c = _and(c, x if pos else _neg(x))
+            if not c:
+                break
+        res = _or(res, c)
+    return res
+
+
+def _accepts(d: _DNF) -> bool:
+    for clause in d:
+        ok = True
+        for k, pos in clause:
+            v = _ATOM_EMPTY.get(k)
+            if v is None:
+                v = _ATOM_EMPTY[k] = eval_formula(_ATOMS[k], [], 0)
+            if v != pos:
+                ok = False
+                break
+        if ok:
+            return True
+    return False
+
+
+def _to_node(d: _DNF) -> Node:
+    if not d:
+        return Bool(False)
+    disj = []
+    for c in sorted(d, key=sorted):
+        lits = [_ATOMS[k] if pos else Not(_ATOMS[k]) for k, pos in sorted(c)]
+        node = lits[0] if lits else Bool(True)
+        for x in lits[1:]:
+            node = And(node, x)
+        disj.append(node)
+    node = disj[0]
+    for x in disj[1:]:
+        node = Or(node, x)
+    return node
+
+
+def progress(node: Node, preds: Dict[str, bool]) -> Node:
+    return _to_node(_prog(_dnf(node), preds))
+
+
+def accepts_empty(node: Node) -> bool:
+    return eval_formula(node, [], 0)
+
+
+class LTLfMonitor:
+    def __init__(self, node: Node):
+        self.formula = node
+        self._res = _dnf(node)
+        self.verdict = _accepts(self._res)
+
+    @property
+    def residual(self) -> Node:
+        return _to_node(self._res)
+
+    def step(self, preds: Dict[str, bool]) -> bool:
+        self._res = _prog(self._res, preds)
+        self.verdict = _accepts(self._res)
+        return self.verdict
+
+    # ключи литералов ссылаются на общую таблицу атомов процесса, поэтому
+    # сериализуется сам остаток, а ДНФ пересобирается при загрузке
+    def __getstate__(self):
+        return {'formula': self.formula, 'residual': self.residual}
+
+    def __setstate__(self, state):
+        self.formula = state['formula']
+        self._res = _dnf(state['residual'])
+        self.verdict = _accepts(self._res)
+
+
+# ---------------- Compilation to minimal DFA ----------------
+#
+# Состояния автомата — классы остатков прогрессии (с точностью до
+# нормализации _mk_assoc), алфавит — все наборы значений предикатов правила.
+# Переходы хранятся строками {маска предикатов правила: следующее состояние},
+# где маска берётся в глобальной нумерации битов предикатов, так что шаг
+# чата — одно AND и один поиск в словаре.
+
+def formula_preds(node: Node) -> Set[str]:
+    if isinstance(node, Pred): return {node.name}
+    if isinstance(node, Bool): return set()
+    if isinstance(node, (Not, Next, Within, Globally, Finally)): return formula_preds(node.child)
+    return formula_preds(node.left) | formula_preds(node.right)
+
+
+def prop_cubes(node: Node, bits: Dict[str, int], positive: bool = True) -> List[Tuple[int, int]]:
+    """ДНФ формулы без темпоральных операторов над битами маски шага.
+
+    Кубы — пары (обязательные биты, запрещённые биты): формула выполнена на
+    маске m, если для какого-то куба m & p == p и m & q == 0. Предикат без
+    бита всегда ложен, как в MaskPreds.
+    """
+    if isinstance(node, Bool):
+        return [(0, 0)] if node.val == positive else []
+    if isinstance(node, Pred):
+        bit = bits.get(node.name, 0)
+        if not bit:
+            return [] if positive else [(0, 0)]
+        return [(bit, 0)] if positive else [(0, bit)]
+    if isinstance(node, Not):
+        return prop_cubes(node.child, bits, not positive)
+    if isinstance(node, Implies):
+        return prop_cubes(Or(Not(node.left), node.right), bits, positive)
+    if isinstance(node, (And, Or)):
+        left, right = prop_cubes(node.left, bits, positive), prop_cubes(node.right, bits, positive)
+        if isinstance(node, Or) == positive:
+            out = left + right
+        else:
+            out = [(p1 | p2, q1 | q2) for p1, q1 in left for p2, q2 in right if not (p1 | p2) & (q1 | q2)]
+        return list(dict.fromkeys(out))
+    raise ValueError('Временные операторы в формуле предиката шага не допускаются')
+
+
+class LTLfDFA:
+    def __init__(self, preds: List[str], mask: int, start: int, accepting: List[bool],
+                 table: List[Dict[int, int]], compile_time: float = 0.0):
+        self.preds = preds
+        self.mask = mask
+        self.start = start
+        self.accepting = accepting
+        self.table = table
+        self.compile_time = compile_time
+
+    @property
+    def num_states(self) -> int:
+        return len(self.table)
+
+    @property
+    def num_letters(self) -> int:
+        return 1 << len(self.preds)
+
+    def step(self, q: int, pmask: int) -> int:
+        return self.table[q][pmask & self.mask]
+
+    def __repr__(self):
+        return (f"LTLfDFA(states={self.num_states}, letters={self.num_letters}, "
+                f"compile_time={self.compile_time * 1000:.1f}ms)")
+
+
+def compile_dfa(node: Node, pred_bits: Dict[str, int], max_states: int = 4096,
+                max_preds: int = 12) -> Optional[LTLfDFA]:
+    import time
+    t0 = time.perf_counter()
+    preds = sorted(p for p in formula_preds(node) if p in pred_bits)
+    if len(preds) > max_preds:
+        return None
+    letters = []
+    for bits in range(1 << len(preds)):
+        assign = {p: bool(bits >> j & 1) for j, p in enumerate(preds)}
+        gmask = sum(pred_bits[p] for p, v in assign.items() if v)
+        letters.append((gmask, assign))
+
+    start = _dnf(node)
+    ids: Dict[_DNF, int] = {start: 0}
+    residuals = [start]
+    trans: List[List[int]] = []
+    while len(trans) < len(residuals):
+        cur = residuals[len(trans)]
+        row = []
+        for _, assign in letters:
+            nxt = _prog(cur, assign)
+            if nxt not in ids:
+                if len(residuals) >= max_states:
+                    return None
+                ids[nxt] = len(residuals)
+                residuals.append(nxt)
+            row.append(ids[nxt])
+        trans.append(row)
+    accepting = [_accepts(r) for r in residuals]
+
+    # Минимизация разбиением Мура
+    block = [int(a) for a in accepting]
+    while True:
+        sigs: Dict[tuple, int] = {}
+        new_block = []
+        for q, row in enumerate(trans):
+            sig = (block[q],) + tuple(block[r] for r in row)
+            new_block.append(sigs.setdefault(sig, len(sigs)))
+        if len(sigs) == len(set(block)):
+            break
+        block = new_block
+
+    # Перенумерация: стартовое состояние получает номер 0
+    order: Dict[int, int] = {block[0]: 0}
+    for b in block:
+        order.setdefault(b, len(order))
+    table: List[Dict[int, int]] = [{} for _ in order]
+    acc = [False] * len(order)
+    for q, row in enumerate(trans):
+        m = order[block[q]]
+        acc[m] = accepting[q]
+        if not table[m]:
+            table[m] = {gmask: order[block[r]] for (gmask, _), r in zip(letters, row)}
+    mask = sum(pred_bits[p] for p in preds)
+    return LTLfDFA(preds, mask, 0, acc, table, time.perf_counter() - t0)
@@ -0,0 +1,208 @@
+from __future__ import annotations
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+log = logging.getLogger(__name__)
+
+# этапы RulesEngine.process_message в порядке выполнения; cooling считается
+# внутри dfa — переходы и остывание сведены в одну таблицу (TransitionTable)
+STAGES = ('triggers', 'lock', 'dfa', 'risk', 'history', 'ltlf', 'hints', 'persist', 'total')
+
+# верхние границы корзин гистограмм, секунды
+BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+           1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _hist() -> Dict[str, Any]:
+    return {'buckets': [0] * (len(BUCKETS) + 1), 'count': 0, 'sum': 0.0}
+
+
+_bisect = bisect.bisect_left
+
+
+class Metrics:
+    """Задержки по этапам, стоимость триггеров и правил LTLf.
+
+    Движок копит замеры одного сообщения в локальных переменных и отдаёт их
+    одним вызовом record_message (одна блокировка на сообщение). Разбивка
+    по триггерам и правилам дороже, поэтому снимается на каждом
+    detail_every-м сообщении. Без Metrics у движка (metrics=None) замеров нет.
+
+    snapshot() — сырые счётчики в виде словаря; снимки разных процессов
+    складываются merge() и отдаются как текст Prometheus (render).
+    """
+
+    def __init__(self, detail_every: int = 64):
+        self.detail_every = max(1, detail_every)
+        self._lock = threading.Lock()
+        self._n = 0
+        # этап -> [счётчики по корзинам, сумма]; count выводится при snapshot
+        self.stages: Dict[str, List[Any]] = {}
+        self._stage_hists = [self._hist_for(name) for name in STAGES]
+        self.triggers: Dict[str, List[float]] = {}  # событие -> [вызовы, совпадения, секунды]
+        self.rules: Dict[str, List[float]] = {}     # правило -> [шаги, секунды]
+
+    def __getstate__(self):
+        st = self.__dict__.copy()
+        del st['_lock']
+        return st
+
+    def __setstate__(self, st):
+        self.__dict__.update(st)
+        self._lock = threading.Lock()
+
+    def detail(self) -> bool:
+        """Снимать ли с этого сообщения разбивку по триггерам и правилам."""
+        self._n += 1
+        return self._n % self.detail_every == 0
+
+    def _hist_for(self, name: str) -> List[Any]:
+        h = self.stages.get(name)
+        if h is None:
+            h = self.stages[name] = [[0] * (len(BUCKETS) + 1), 0.0]
+        return h
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            h = self._hist_for(name)
+            h[0][_bisect(BUCKETS, seconds)] += 1
+            h[1] += seconds
+
+    def record_message(self, stages: Sequence[float],
+                       triggers: Optional[Iterable[Tuple[str, int, bool, float]]] = None,
+                       rules: Optional[Iterable[Tuple[str, float]]] = None) -> None:
+        """stages — длительности в порядке STAGES; triggers — (событие, вызовы
+        шаблона, сработал ли, секунды); rules — (id правила, секунды)."""
+        with self._lock:
+            for h, sec in zip(self._stage_hists, stages):
+                h[0][_bisect(BUCKETS, sec)] += 1
+                h[1] += sec
+            if triggers is not None:
+                for ev, calls, hit, sec in triggers:
+                    c = self.triggers.get(ev)
+                    if c is None:
+                        c = self.triggers[ev] = [0, 0, 0.0]
+                    c[0] += calls
+                    c[1] += hit
+                    c[2] += sec
+            if rules is not None:
+                for rid, sec in rules:
+                    c = self.rules.get(rid)
+                    if c is None:
+                        c = self.rules[rid] = [0, 0.0]
+                    c[0] += 1
+                    c[1] += sec
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'stages': {k: {'buckets': list(h[0]), 'count': sum(h[0]), 'sum': h[1]}
+                           for k, h in self.stages.items() if any(h[0])},
+                'triggers': {k: list(v) for k, v in self.triggers.items()},
+                'rules': {k: list(v) for k, v in self.rules.items()},
+            }
+
+    def quantile(self, stage: str, q: float) -> Optional[float]:
+        """Оценка квантиля по гистограмме: верхняя граница корзины."""
+        return snapshot_quantile(self.snapshot(), stage, q)
+
+    def render(self) -> str:
+        return render(self.snapshot())
+
+
+def merge(snaps: Iterable[Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {'stages': {}, 'triggers': {}, 'rules': {}}
+    for s in snaps:
+        if not s:
+            continue
+        for k, h in s['stages'].items():
+            o = out['stages'].setdefault(k, _hist())
+            o['buckets'] = [a + b for a, b in zip(o['buckets'], h['buckets'])]
+            o['count'] += h['count']
+            o['sum'] += h['sum']
+        for part in ('triggers', 'rules'):
+            for k, v in s[part].items():
+                o = out[part].get(k)
+                out[part][k] = [a + b for a, b in zip(o, v)] if o else list(v)
+    return out
+
+
+def snapshot_quantile(snap: Dict[str, Any], stage: str, q: float) -> Optional[float]:
+    h = snap['stages'].get(stage)
+    if not h or not h['count']:
+        return None
+    rank = q * h['count']
+    acc = 0
+    for bound, n in zip(BUCKETS + (float('inf'),), h['buckets']):
+        acc += n
+        if acc >= rank:
+            return bound
+    return float('inf')
+
+
+def render(snap: Dict[str, Any]) -> str:
+    """Текстовый формат Prometheus (exposition format 0.0.4)."""
+    lines = ['# HELP radar_stage_seconds Длительность этапов обработки сообщения',
+             '# TYPE radar_stage_seconds histogram']
+    for stage, h in sorted(snap['stages'].items()):
+        acc = 0
+        for bound, n in zip(BUCKETS, h['buckets']):
+            acc += n
+            lines.append(f'radar_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {acc}')
+        lines.append(f'radar_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h["count"]}')
+        lines.append(f'radar_stage_seconds_sum{{stage="{stage}"}} {h["sum"]:.9f}')
+        lines.append(f'radar_stage_seconds_count{{stage="{stage}"}} {h["count"]}')
+    lines += ['# HELP radar_trigger_calls_total Применения шаблона триггера (выборочно)',
+              '# TYPE radar_trigger_calls_total counter']
+    lines += [f'radar_trigger_calls_total{{event="{ev}"}} {int(v[0])}' for ev, v in sorted(snap['triggers'].items())]
+    lines += ['# HELP radar_trigger_hits_total Сообщения, где триггер сработал (выборочно)',
+              '# TYPE radar_trigger_hits_total counter']
+    lines += [f'radar_trigger_hits_total{{event="{ev}"}} {int(v[1])}' for ev, v in sorted(snap['triggers'].items())]
+    lines += ['# HELP radar_trigger_seconds_total Время в шаблоне триггера (выборочно)',
+              '# TYPE radar_trigger_seconds_total counter']
+    lines += [f'radar_trigger_seconds_total{{event="{ev}"}} {v[2]:.9f}' for ev, v in sorted(snap['triggers'].items())]
+    lines += ['# HELP radar_rule_steps_total Шаги правила LTLf (выборочно)',
+              '# TYPE radar_rule_steps_total counter']
+    lines += [f'radar_rule_steps_total{{rule="{r}"}} {int(v[0])}' for r, v in sorted(snap['rules'].items())]
+    lines += ['# HELP radar_rule_seconds_total Время шага правила LTLf (выборочно)',
+              '# TYPE radar_rule_seconds_total counter']
+    lines += [f'radar_rule_seconds_total{{rule="{r}"}} {v[1]:.9f}' for r, v in sorted(snap['rules'].items())]
+    return "\n".join(lines) + "\n"
+
+
+def serve(collect: Callable[[], Iterable[Optional[Dict[str, Any]]]], port: int,
+          host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """Отдаёт /metrics на host:port в фоновом потоке.
+
+    collect возвращает снимки (Metrics.snapshot()) — например, свой и по
+    одному от каждого шарда; они складываются при каждом запросе.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            try:
+                body = render(merge(collect())).encode('utf-8')
+            except Exception:
+                log.exception("Не удалось собрать метрики")
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    log.info("Метрики: http://%s:%d/metrics", host, server.server_address[1])
+    return server
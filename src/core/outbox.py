@@ -0,0 +1,183 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .metrics import Metrics
+
+log = logging.getLogger(__name__)
+
+TG_LIMIT = 4096
+_SEP = "\n\n———\n\n"
+
+
+def summary_signature(res: Dict[str, Any], risk_bucket: int) -> Tuple[Any, ...]:
+    """Что должно измениться, чтобы новая сводка имела смысл."""
+    bad = frozenset(r.get("id") for r in res.get("ltlf", []) if not r.get("ok"))
+    return res.get("state"), res.get("risk", 0) // max(1, risk_bucket), bad
+
+
+def make_digest(texts: List[str], limit: int = TG_LIMIT) -> str:
+    if len(texts) == 1:
+        return texts[0][:limit]
+    head = f"Сводка по чату: {len(texts)} сообщ."
+    parts: List[str] = []
+    size = len(head)
+    for t in reversed(texts):
+        if size + len(_SEP) + len(t) > limit - 40:
+            break
+        parts.append(t)
+        size += len(_SEP) + len(t)
+    skipped = len(texts) - len(parts)
+    if skipped:
+        head += f" (ещё {skipped} ранее не показаны)"
+    if not parts:
+        return (head + _SEP + texts[-1])[:limit]
+    return head + _SEP + _SEP.join(reversed(parts))
+
+
+class _Pending:
+    __slots__ = ('since', 'texts', 'target', 'fallback_texts', 'fallback_target')
+
+    def __init__(self, since: float):
+        self.since = since
+        self.texts: List[str] = []
+        self.target: Dict[str, Any] = {}
+        self.fallback_texts: List[str] = []
+        self.fallback_target: Optional[Dict[str, Any]] = None
+
+
+class SummaryOutbox:
+    """Очередь исходящих сводок с укрупнением и ограничением скорости.
+
+    offer() ничего не отправляет: сводка ложится в очередь своего чата. Сводки
+    одного чата, пришедшие в течение window секунд, уходят одним сообщением;
+    сводка с той же сигнатурой (состояние, корзина риска, набор нарушений),
+    что и предыдущая по этому чату, отбрасывается. Сигнатуры помнятся для
+    max_sigs последних чатов (LRU) и не дольше sig_ttl секунд с последней
+    сводки чата (None — без срока). Фоновая задача шлёт не
+    чаще rate сообщений в секунду. send(text=..., **target) — обычно
+    bot.send_message; при ошибке отправляется fallback, если он задан.
+    """
+
+    def __init__(self, send: Callable[..., Awaitable[Any]], rate: float = 1.0, window: float = 3.0,
+                 clock: Callable[[], float] = time.monotonic, metrics: Optional[Metrics] = None,
+                 max_sigs: int = 10000, sig_ttl: Optional[float] = None):
+        self.send = send
+        # outbox_wait — сколько сводка пролежала в очереди, send — вызов send
+        self.metrics = metrics
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.window = window
+        self.clock = clock
+        self.pending: Dict[Hashable, _Pending] = {}
+        # ключ -> (сигнатура, время); порядок словаря — от давно не виденных к свежим
+        self.last_sig: Dict[Hashable, Tuple[Tuple[Any, ...], float]] = {}
+        self.max_sigs = max_sigs
+        self.sig_ttl = sig_ttl
+        self.offered = 0
+        self.suppressed = 0
+        self.merged = 0
+        self.sent = 0
+        self.failed = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def offer(self, key: Hashable, sig: Optional[Tuple[Any, ...]], text: str, target: Dict[str, Any],
+              fallback: Optional[Tuple[str, Dict[str, Any]]] = None) -> bool:
+        self.offered += 1
+        if sig is not None:
+            now = self.clock()
+            self._forget_sigs(now)
+            last = self.last_sig.pop(key, None)
+            self.last_sig[key] = (sig, now)
+            if last is not None and last[0] == sig:
+                self.suppressed += 1
+                return False
+            if len(self.last_sig) > self.max_sigs:
+                del self.last_sig[next(iter(self.last_sig))]
+        p = self.pending.get(key)
+        if p is None:
+            p = self.pending[key] = _Pending(self.clock())
+            self._wake.set()
+        else:
+            self.merged += 1
+        p.texts.append(text)
+        p.target = target
+        if fallback is not None:
+            p.fallback_texts.append(fallback[0])
+            p.fallback_target = fallback[1]
+        return True
+
+    def _forget_sigs(self, now: float) -> None:
+        if self.sig_ttl is None:
+            return
+        while self.last_sig:
+            key = next(iter(self.last_sig))
+            if now - self.last_sig[key][1] < self.sig_ttl:
+                break
+            del self.last_sig[key]
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, drain: bool = True) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if drain:
+            for key in list(self.pending):
+                await self._deliver(self.pending.pop(key))
+
+    def _next_due(self) -> Optional[Tuple[float, Hashable]]:
+        if not self.pending:
+            return None
+        key, p = min(self.pending.items(), key=lambda kv: kv[1].since)
+        return p.since + self.window, key
+
+    async def _run(self) -> None:
+        while True:
+            due = self._next_due()
+            if due is None:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            delay = due[0] - self.clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            p = self.pending.pop(due[1])
+            await self._deliver(p)
+            if self.interval:
+                await asyncio.sleep(self.interval)
+
+    async def _deliver(self, p: _Pending) -> None:
+        if self.metrics is not None:
+            self.metrics.observe('outbox_wait', self.clock() - p.since)
+            t0 = time.perf_counter()
+        try:
+            await self.send(text=make_digest(p.texts), **p.target)
+            self.sent += 1
+            if self.metrics is not None:
+                self.metrics.observe('send', time.perf_counter() - t0)
+            return
+        except Exception:
+            self.failed += 1
+            log.exception("Не удалось отправить сводку (%s)", p.target)
+        if p.fallback_target is None:
+            return
+        try:
+            await self.send(text=make_digest(p.fallback_texts), **p.fallback_target)
+            self.sent += 1
+        except Exception:
+            self.failed += 1
+            log.exception("Не удалось отправить запасную сводку (%s)", p.fallback_target)
+
+    def stats(self) -> Dict[str, int]:
+        return {'queued': len(self.pending), 'sigs': len(self.last_sig), 'offered': self.offered, 'suppressed': self.suppressed,
+                'merged': self.merged, 'sent': self.sent, 'failed': self.failed}
@@ -0,0 +1,175 @@
+from __future__ import annotations
+import logging
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+Snapshot = Dict[str, Any]
+
+
+class SQLiteBackend:
+    """Снимки чатов в SQLite (WAL): одна строка на чат, значение — pickle.
+
+    У каждого потока своё соединение: в WAL чтение из обработчика не ждёт
+    фоновую запись.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        con = self._con()
+        con.execute("CREATE TABLE IF NOT EXISTS chats ("
+                    "chat_id TEXT PRIMARY KEY, data BLOB NOT NULL, updated REAL NOT NULL)")
+        con.commit()
+
+    def _con(self) -> sqlite3.Connection:
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=30)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.con = con
+        return con
+
+    def load(self, chat_id: str) -> Optional[bytes]:
+        row = self._con().execute("SELECT data FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def load_recent(self, limit: Optional[int] = None) -> Iterator[Tuple[str, bytes]]:
+        sql = "SELECT chat_id, data FROM chats ORDER BY updated DESC"
+        if limit is not None:
+            sql += " LIMIT %d" % int(limit)
+        yield from self._con().execute(sql)
+
+    def save_many(self, rows: Iterable[Tuple[str, bytes]]) -> None:
+        now = time.time()
+        con = self._con()
+        with con:
+            con.executemany("INSERT OR REPLACE INTO chats (chat_id, data, updated) VALUES (?, ?, ?)",
+                            ((cid, data, now) for cid, data in rows))
+
+    def close(self) -> None:
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            con.close()
+            self._local.con = None
+
+
+class WriteBehind:
+    """Отложенная запись снимков в фоновом потоке.
+
+    put() только кладёт снимок в очередь; поток-писатель забирает всё, что
+    накопилось, и пишет одной транзакцией. Пока снимок не записан, get()
+    отдаёт его из памяти, так что чат, вытесненный и сразу вернувшийся,
+    не теряет шаги. flush_every / flush_interval — когда движку пора
+    сбрасывать грязные чаты (по числу обновлений или по времени). sync()
+    ждёт, пока всё отданное до неё окажется на диске.
+    """
+
+    def __init__(self, backend: SQLiteBackend, flush_every: int = 256, flush_interval: float = 5.0):
+        self.backend = backend
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.pending: Dict[str, Snapshot] = {}
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='state-writer', daemon=True)
+        self._thread.start()
+
+    def put(self, chat_id: str, snap: Snapshot) -> None:
+        self.put_many([(chat_id, snap)])
+
+    def put_many(self, items: List[Tuple[str, Snapshot]]) -> None:
+        if not items:
+            return
+        with self._lock:
+            for cid, snap in items:
+                self.pending[cid] = snap
+        self._queue.put(items)
+
+    def get(self, chat_id: str) -> Optional[Snapshot]:
+        with self._lock:
+            snap = self.pending.get(chat_id)
+        if snap is not None:
+            return snap
+        data = self.backend.load(chat_id)
+        return pickle.loads(data) if data is not None else None
+
+    def load_recent(self, limit: Optional[int] = None,
+                    accept: Optional[Callable[[str], bool]] = None) -> Iterator[Tuple[str, Snapshot]]:
+        if accept is None:
+            for cid, data in self.backend.load_recent(limit):
+                yield cid, pickle.loads(data)
+            return
+        n = 0
+        for cid, data in self.backend.load_recent():
+            if limit is not None and n >= limit:
+                return
+            if accept(cid):
+                n += 1
+                yield cid, pickle.loads(data)
+
+    def sync(self) -> bool:
+        """Ждёт записи всего, что отдано put раньше; False — если запись не удалась."""
+        errors = self.errors
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        return self.errors == errors
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            # в очереди — пачки снимков, события sync() и None (остановка)
+            batch: List[Tuple[str, Snapshot]] = []
+            waiters: List[threading.Event] = []
+            item = self._queue.get()
+            while True:
+                if item is None:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.extend(item)
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for done in waiters:
+                done.set()
+        self.backend.close()
+
+    def _write(self, batch: List[Tuple[str, Snapshot]]) -> None:
+        latest: Dict[str, Snapshot] = dict(batch)
+        try:
+            self.backend.save_many((cid, pickle.dumps(snap, pickle.HIGHEST_PROTOCOL))
+                                   for cid, snap in latest.items())
+        except Exception:
+            log.exception("Не удалось записать %d снимков чатов", len(latest))
+            self.errors += 1
+            return
+        self.written += len(latest)
+        self.batches += 1
+        with self._lock:
+            for cid, snap in latest.items():
+                if self.pending.get(cid) is snap:
+                    del self.pending[cid]
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        self.backend.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {'pending': len(self.pending), 'written': self.written, 'batches': self.batches}
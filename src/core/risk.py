@@ -5,6 +5,8 @@ from .triggers import TriggerMatcher
 
 
 class RiskMeter:
+    __slots__ = ('cfg', 'triggers', 'value')
+
     def __init__(self, cfg: Config, triggers: TriggerMatcher):
         self.cfg = cfg
         self.triggers = triggers
@@ -0,0 +1,328 @@
+from __future__ import annotations
+import logging
+import multiprocessing as mp
+import os
+import tempfile
+import threading
+import zlib
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .bundle import RulesBundle, load_bundle, load_saved_bundle, save_bundle
+from .triggers import MessageAnalysis
+
+log = logging.getLogger(__name__)
+
+
+def shard_of(chat_id: str, n: int) -> int:
+    """Стабильный номер шарда: не зависит от PYTHONHASHSEED и перезапусков."""
+    return zlib.crc32(str(chat_id).encode('utf-8')) % n
+
+
+# ---------------- Протокол ----------------
+#
+# Запросы: ('m', rid, chat_id, text, user, hints, msg_id) — сообщение; ('c', rid, method, args) —
+# вызов метода движка; ('c', rid, 'swap_saved', (путь, digest, версия)) — перейти на бандл,
+# сохранённый фронтендом (при несовпадении digest воркер отказывается и остаётся на
+# прежних правилах); ('stop',) — закончить после всего, что
+# уже в канале. Запросы идут в канал пачками (списками): всё, что накопилось,
+# пока отправлялась предыдущая пачка. Воркер отвечает на пачку одним списком
+# [(rid, ok, payload), ...]. Результат сообщения передаётся кортежем
+# (версия правил, номер состояния, риск, маска выполненных правил, подсказки,
+# совпадения, позиции, номер шага) — без повторения описаний правил и имён
+# состояний; по версии фронтенд выбирает, в чьих терминах их расшифровать.
+# Маска None — вердикт LTLf отложен; он придёт отдельным ответом
+# (None, True, ('v', chat_id, шаг, результаты правил)) вне очереди запросов.
+
+def _encode(engine, res: Dict[str, Any]) -> Tuple[Any, ...]:
+    ok_mask = None
+    if not res.get('ltlf_deferred'):
+        ok_mask = 0
+        for i, r in enumerate(res['ltlf']):
+            if r['ok']:
+                ok_mask |= 1 << i
+    a = res['analysis']
+    return (engine.generation, engine.table.state_id[res['state']], res['risk'], ok_mask, res['hints'],
+            a.matches, a.spans, res['step'])
+
+
+def _shard_main(conn, bundle: RulesBundle, engine_kwargs: Dict[str, Any], state_db: Optional[str],
+                persist_kwargs: Dict[str, Any], shard: int, shards: int) -> None:
+    from .engine import RulesEngine
+    from .persistence import SQLiteBackend, WriteBehind
+    persistence = WriteBehind(SQLiteBackend(state_db), **persist_kwargs) if state_db else None
+    engine = RulesEngine(bundle, persistence=persistence, **engine_kwargs)
+    mine = lambda cid: shard_of(cid, shards) == shard
+    # отложенные вердикты отправляет фоновый поток движка
+    send_lock = threading.Lock()
+
+    def send(out):
+        with send_lock:
+            conn.send(out)
+
+    engine.on_verdict = lambda cid, step, results: send([(None, True, ('v', cid, step, results))])
+    while True:
+        try:
+            batch = conn.recv()
+            while conn.poll():
+                batch.extend(conn.recv())
+        except EOFError:
+            break
+        out = []
+        stop = False
+        for req in batch:
+            if req[0] == 'stop':
+                stop = True
+                break
+            rid = req[1]
+            try:
+                if req[0] == 'm':
+                    res = engine.process_message(req[2], req[3], user=req[4], hints=req[5], msg_id=req[6])
+                    out.append((rid, True, _encode(engine, res)))
+                elif req[2] == 'warm_up':
+                    out.append((rid, True, engine.warm_up(accept=mine)))
+                elif req[2] == 'swap_saved':
+                    path, digest, generation = req[3]
+                    engine.swap_bundle(load_saved_bundle(path, digest), generation)
+                    out.append((rid, True, digest))
+                else:
+                    out.append((rid, True, getattr(engine, req[2])(*req[3])))
+            except Exception as e:
+                log.exception("Шард %d: ошибка обработки запроса", shard)
+                out.append((rid, False, repr(e)))
+        if out:
+            send(out)
+        if stop:
+            break
+    engine.close()
+    conn.close()
+
+
+class _Shard:
+    def __init__(self, idx: int, proc, conn, max_inflight: int):
+        self.idx = idx
+        self.proc = proc
+        self.conn = conn
+        self.cond = threading.Condition()
+        self.queue: List[Tuple[Any, ...]] = []
+        self.stopped = False
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.futures: Dict[int, Tuple[Future, Any]] = {}
+        self.next_id = 0
+        self.reader: Optional[threading.Thread] = None
+        self.writer: Optional[threading.Thread] = None
+
+
+class ShardedEngine:
+    """Движок на N процессах: чат закреплён за процессом по crc32(chat_id).
+
+    У каждого процесса свой RulesEngine и TriggerMatcher. Канал к процессу —
+    Pipe; порядок сообщений одного чата сохраняется, потому что они идут
+    через один канал и обрабатываются одним процессом по очереди. Если у
+    шарда max_inflight неотвеченных запросов, submit() ждёт (backpressure).
+    shutdown() дожидается ответов на всё отправленное и останавливает процессы.
+    Отложенные вердикты LTLf (см. RulesEngine.ltlf_budget) приходят в
+    on_verdict(chat_id, step, results) из потока чтения шарда.
+    """
+
+    def __init__(self, cfg_path: str, workers: int, engine_kwargs: Optional[Dict[str, Any]] = None,
+                 state_db: Optional[str] = None, persist_kwargs: Optional[Dict[str, Any]] = None,
+                 max_inflight: int = 1024, bundle: Optional[RulesBundle] = None,
+                 on_verdict: Optional[Callable[[str, int, List[Dict[str, Any]]], None]] = None):
+        self.bundle = bundle or load_bundle(cfg_path)
+        self.on_verdict = on_verdict
+        self.generation = 0
+        # версия правил -> (имена состояний, (id, описание) правил) для расшифровки
+        self.decoders: Dict[int, Tuple[List[str], List[Tuple[str, str]]]] = {0: self._decoder(self.bundle)}
+        self.closing = False
+        # fork: дочерний процесс не переимпортирует главный модуль бота
+        ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        self.shards: List[_Shard] = []
+        for i in range(workers):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_shard_main, name=f'engine-shard-{i}', daemon=True,
+                               args=(child, self.bundle, engine_kwargs or {}, state_db, persist_kwargs or {},
+                                     i, workers))
+            proc.start()
+            child.close()
+            self.shards.append(_Shard(i, proc, parent, max_inflight))
+        for sh in self.shards:
+            sh.reader = threading.Thread(target=self._read, args=(sh,), name=f'shard-reader-{sh.idx}',
+                                         daemon=True)
+            sh.writer = threading.Thread(target=self._write, args=(sh,), name=f'shard-writer-{sh.idx}',
+                                         daemon=True)
+            sh.reader.start()
+            sh.writer.start()
+        # потоки, в которых ChatDispatcher ждёт ответов шардов
+        self.pool = ThreadPoolExecutor(max(4, 4 * workers), thread_name_prefix='shard-wait')
+
+    @staticmethod
+    def _decoder(bundle: RulesBundle) -> Tuple[List[str], List[Tuple[str, str]]]:
+        return list(bundle.table.states), [(r['id'], r['description']) for r in bundle.cfg.ltlf_rules]
+
+    def _decode(self, text: str, payload: Tuple[Any, ...]) -> Dict[str, Any]:
+        gen, sid, risk, ok_mask, hints, matches, spans, step = payload
+        states, rules = self.decoders[gen]
+        events = set(matches)
+        res = {
+            'state': states[sid],
+            'risk': risk,
+            'events': sorted(events),
+            'ltlf': [{'id': rid, 'ok': bool(ok_mask >> i & 1), 'description': desc}
+                     for i, (rid, desc) in enumerate(rules)] if ok_mask is not None else [],
+            'hints': hints,
+            'analysis': MessageAnalysis(text=text or "", events=events, matches=matches, spans=spans),
+            'step': step,
+        }
+        if ok_mask is None:
+            res['ltlf_deferred'] = True
+        return res
+
+    def _read(self, sh: _Shard) -> None:
+        while True:
+            try:
+                replies = sh.conn.recv()
+            except (EOFError, OSError):
+                break
+            for rid, ok, payload in replies:
+                if rid is None:
+                    self._verdict(payload)
+                    continue
+                fut, text = sh.futures.pop(rid)
+                sh.slots.release()
+                if not ok:
+                    fut.set_exception(RuntimeError(f"shard {sh.idx}: {payload}"))
+                elif text is None:
+                    fut.set_result(payload)
+                else:
+                    fut.set_result(self._decode(text, payload))
+        err = RuntimeError(f"shard {sh.idx} завершился")
+        for rid in list(sh.futures):
+            fut, _ = sh.futures.pop(rid)
+            if not fut.done():
+                fut.set_exception(err)
+
+    def _verdict(self, payload: Tuple[Any, ...]) -> None:
+        _, chat_id, step, results = payload
+        if self.on_verdict is None:
+            return
+        try:
+            self.on_verdict(chat_id, step, results)
+        except Exception:
+            log.exception("on_verdict упал (чат %s, шаг %d)", chat_id, step)
+
+    def _write(self, sh: _Shard) -> None:
+        while True:
+            with sh.cond:
+                while not sh.queue and not sh.stopped:
+                    sh.cond.wait()
+                batch, sh.queue = sh.queue, []
+                stopped = sh.stopped
+            if stopped:
+                batch.append(('stop',))
+            try:
+                sh.conn.send(batch)
+            except (OSError, ValueError):
+                log.exception("Шард %d: канал закрыт", sh.idx)
+                return
+            if stopped:
+                return
+
+    def _send(self, sh: _Shard, req_head: str, text: Optional[str], *args: Any) -> Future:
+        if self.closing:
+            raise RuntimeError("ShardedEngine остановлен")
+        sh.slots.acquire()
+        fut: Future = Future()
+        with sh.cond:
+            rid = sh.next_id
+            sh.next_id += 1
+            sh.futures[rid] = (fut, text)
+            sh.queue.append((req_head, rid) + args)
+            if len(sh.queue) == 1:
+                sh.cond.notify()
+        return fut
+
+    def submit(self, chat_id: str, text: str, user: Optional[str] = None, hints: bool = True,
+               msg_id: Optional[int] = None) -> Future:
+        sh = self.shards[shard_of(chat_id, len(self.shards))]
+        return self._send(sh, 'm', text or "", chat_id, text, user, hints, msg_id)
+
+    def process_message(self, chat_id: str, text: str, user: Optional[str] = None,
+                        hints: bool = True, msg_id: Optional[int] = None) -> Dict[str, Any]:
+        return self.submit(chat_id, text, user, hints, msg_id).result()
+
+    # интерфейс, общий с ThreadedEngine, для ChatDispatcher и бота
+    def run(self, chat_id: str, text: str, user: Optional[str] = None,
+            msg_id: Optional[int] = None) -> Dict[str, Any]:
+        return self.submit(chat_id, text, user, True, msg_id).result()
+
+    def call(self, chat_id: str, method: str, *args: Any) -> Any:
+        """Метод движка в шарде, которому принадлежит чат."""
+        sh = self.shards[shard_of(chat_id, len(self.shards))]
+        return self._send(sh, 'c', None, method, (chat_id,) + args).result()
+
+    def edit_message(self, chat_id: str, msg_id: int, text: str) -> Optional[Dict[str, Any]]:
+        return self.call(chat_id, 'edit_message', msg_id, text)
+
+    def delete_messages(self, chat_id: str, msg_ids: List[int]) -> Optional[Dict[str, Any]]:
+        return self.call(chat_id, 'delete_messages', msg_ids)
+
+    def executor_for(self, chat_id: str) -> Executor:
+        return self.pool
+
+    def call_all(self, method: str, *args: Any) -> List[Any]:
+        futures = [self._send(sh, 'c', None, method, args) for sh in self.shards]
+        return [f.result() for f in futures]
+
+    def reload(self, path: str, cache_dir: Optional[str] = None) -> str:
+        """Горячая перезагрузка правил во всех шардах.
+
+        Бандл собирается (или берётся из кэша) здесь же и сохраняется во
+        временный файл; воркеры читают именно его и сверяют digest, а не
+        перечитывают rules.yaml. Расшифровка новой версии регистрируется до
+        рассылки, так что ответы любой из версий разбираются верно. Если
+        какой-то шард отказался, он остаётся на прежних правилах, а reload
+        поднимает RuntimeError.
+        """
+        bundle = load_bundle(path, cache_dir)
+        if bundle.digest == self.bundle.digest:
+            return bundle.digest
+        generation = self.generation + 1
+        self.decoders[generation] = self._decoder(bundle)
+        self.generation = generation
+        fd, saved = tempfile.mkstemp(prefix='rules-', suffix='.bundle')
+        os.close(fd)
+        try:
+            save_bundle(bundle, saved)
+            futures = [self._send(sh, 'c', None, 'swap_saved', (saved, bundle.digest, generation))
+                       for sh in self.shards]
+            failed = []
+            for sh, fut in zip(self.shards, futures):
+                try:
+                    fut.result()
+                except Exception as e:
+                    failed.append(str(e))
+        finally:
+            os.unlink(saved)
+        if failed:
+            raise RuntimeError("Шарды остались на прежних правилах — " + "; ".join(failed))
+        self.bundle = bundle
+        return bundle.digest
+
+    def inflight(self) -> List[int]:
+        return [len(sh.futures) for sh in self.shards]
+
+    def shutdown(self) -> None:
+        if self.closing:
+            return
+        self.closing = True
+        self.pool.shutdown()
+        for sh in self.shards:
+            with sh.cond:
+                sh.stopped = True
+                sh.cond.notify()
+        for sh in self.shards:
+            sh.writer.join()
+            sh.proc.join()
+            sh.reader.join()
+            sh.conn.close()
@@ -0,0 +1,90 @@
+from __future__ import annotations
+import heapq
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+
+
+class ChatStore:
+    """Хранилище живых чатов с вытеснением по LRU и по простою (TTL).
+
+    Попадание — только чтение словаря и запись времени доступа. Когда чатов
+    становится больше max_chats, за раз вытесняется пачка самых давно
+    использованных (~5%), так что сортировка амортизируется по вставкам.
+    on_evict(chat_id, value) вызывается для каждого вытесненного чата.
+
+    get() можно звать из нескольких потоков сразу; put/sweep/evict меняют
+    структуру и должны вызываться по одному (RulesEngine делает это под
+    блокировкой создания чатов).
+    """
+
+    def __init__(self, max_chats: Optional[int] = None, idle_ttl: Optional[float] = None,
+                 on_evict: Optional[Callable[[str, Any], None]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_chats = max_chats
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self.clock = clock
+        self.items: Dict[str, Any] = {}
+        self.last_seen: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._last_sweep = clock()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, chat_id: str) -> bool:
+        return chat_id in self.items
+
+    def __getitem__(self, chat_id: str) -> Any:
+        return self.items[chat_id]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.items))
+
+    def get(self, chat_id: str) -> Optional[Any]:
+        value = self.items.get(chat_id)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.last_seen[chat_id] = self.clock()
+        return value
+
+    def put(self, chat_id: str, value: Any) -> None:
+        now = self.clock()
+        self.items[chat_id] = value
+        self.last_seen[chat_id] = now
+        if self.idle_ttl is not None and now - self._last_sweep >= self.idle_ttl / 4:
+            self.sweep(now)
+        if self.max_chats is not None and len(self.items) > self.max_chats:
+            batch = max(1, self.max_chats // 20)
+            n = len(self.items) - self.max_chats + batch - 1
+            oldest = heapq.nsmallest(n, self.last_seen.items(), key=lambda kv: kv[1])
+            for cid, _ in oldest:
+                if cid != chat_id:
+                    self.evict(cid)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        if self.idle_ttl is None:
+            return 0
+        now = self.clock() if now is None else now
+        self._last_sweep = now
+        stale = [cid for cid, ts in list(self.last_seen.items()) if now - ts > self.idle_ttl]
+        for cid in stale:
+            self.evict(cid)
+        return len(stale)
+
+    def evict(self, chat_id: str) -> None:
+        value = self.items.pop(chat_id, None)
+        self.last_seen.pop(chat_id, None)
+        if value is None:
+            return
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(chat_id, value)
+
+    def stats(self) -> Dict[str, int]:
+        return {'live': len(self.items), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
@@ -1,8 +1,126 @@
 from __future__ import annotations
 import re
-from typing import Dict, List, Set, Tuple
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
 from .config import Config, Trigger
 
+try:
+    from re import _parser as sre_parse, _constants as sre_c
+except ImportError:  # Python < 3.11
+    import sre_parse, sre_constants as sre_c
+
+Span = Tuple[int, int]
+
+_WORD = re.compile(r'\w+')
+_GRAM = 3
+_NONE: List[int] = []
+
+
+class _Unknown(Exception):
+    pass
+
+
+def _literal_chars(op, av) -> Set[str]:
+    if op is sre_c.LITERAL:
+        return {chr(av)}
+    if op is sre_c.IN:
+        chs = set()
+        for o, a in av:
+            if o is sre_c.LITERAL:
+                chs.add(chr(a))
+            elif o is sre_c.RANGE and a[1] - a[0] <= 64:
+                chs |= {chr(c) for c in range(a[0], a[1] + 1)}
+            else:
+                raise _Unknown
+        return chs
+    raise _Unknown
+
+
+def _extend(items, prefixes: Set[Tuple[str, bool]]) -> Set[Tuple[str, bool]]:
+    # prefixes — множество (строка, закрыта ли она); закрытая строка дальше не
+    # наращивается, но остаётся верным префиксом любого совпадения.
+    for op, av in items:
+        if all(closed or len(s) >= _GRAM for s, closed in prefixes):
+            break
+        if op is sre_c.AT:
+            continue
+        if op is sre_c.SUBPATTERN:
+            if av[1] or av[2]:  # локальные флаги вида (?i:...)
+                raise _Unknown
+            prefixes = _extend(av[-1], prefixes)
+            continue
+        if op is sre_c.BRANCH:
+            acc = set()
+            for br in av[1]:
+                acc |= _extend(br, prefixes)
+            prefixes = acc
+            continue
+        if op in (sre_c.MAX_REPEAT, sre_c.MIN_REPEAT):
+            lo, hi, sub = av
+            acc = set(prefixes) if lo == 0 else set()
+            cur = prefixes
+            for rep in range(1, min(hi, _GRAM) + 1):
+                cur = _extend(list(sub), cur)
+                if rep >= lo:
+                    acc |= cur
+            if lo > min(hi, _GRAM):
+                acc |= cur
+            if hi > _GRAM:
+                acc = {(s, True) for s, _ in acc}
+            prefixes = acc
+            continue
+        try:
+            chs = _literal_chars(op, av)
+        except _Unknown:
+            return {(s, True) for s, _ in prefixes}
+        prefixes = {(s + ch, False) if not closed and len(s) < _GRAM else (s, closed)
+                    for s, closed in prefixes for ch in chs}
+        if len(prefixes) > 4096:
+            raise _Unknown
+    return prefixes
+
+
+def word_prefixes(pattern: str, flags: int) -> Optional[Set[str]]:
+    """Начала слов, с которых может начинаться совпадение шаблона вида \\b...
+
+    None — если шаблон не начинается с \\b или префиксы вывести не удалось;
+    такой триггер проверяется обычным search по всему тексту.
+    """
+    ic = bool(flags & re.IGNORECASE)
+    try:
+        items = list(sre_parse.parse(pattern, flags))
+        if not items or items[0] != (sre_c.AT, sre_c.AT_BOUNDARY):
+            return None
+        raw = {s for s, _ in _extend(items, {('', False)})}
+    except Exception:
+        return None
+    out: Set[str] = set()
+    for s in raw:
+        w = _WORD.match(s)
+        if not w:
+            return None
+        out.add(w.group(0).casefold() if ic else w.group(0))
+    return {s for s in out if not any(s != o and s.startswith(o) for o in out)}
+
+
+def _timed(match, cost: List[float]):
+    def timed(text: str, pos: int):
+        t0 = time.perf_counter()
+        m = match(text, pos)
+        cost[0] += 1
+        cost[1] += time.perf_counter() - t0
+        return m
+    return timed
+
+
+@dataclass
+class MessageAnalysis:
+    text: str
+    events: Set[str] = field(default_factory=set)
+    matches: Dict[str, List[str]] = field(default_factory=dict)
+    spans: Dict[str, List[Span]] = field(default_factory=dict)
+
 
 class TriggerMatcher:
     def __init__(self, cfg: Config):
@@ -17,22 +135,79 @@ class TriggerMatcher:
             pat = re.compile(tr.pattern, flags)
             self.compiled.append((tr, pat))
 
+        # Префильтр: для триггеров вида \b... совпадение может начаться только
+        # в начале слова, причём слово должно начинаться с одного из выведенных
+        # из регулярки префиксов. Один проход по словам текста даёт пары
+        # (позиция, триггер), и полный шаблон примеряется только в них (match).
+        self._prefix_ci: Dict[str, List[int]] = {}
+        self._prefix_cs: Dict[str, List[int]] = {}
+        self._unfiltered: List[int] = []
+        self._match = [pat.match for _, pat in self.compiled]
+        for i, (tr, pat) in enumerate(self.compiled):
+            pfx = word_prefixes(tr.pattern, pat.flags)
+            if pfx is None:
+                self._unfiltered.append(i)
+                continue
+            index = self._prefix_ci if pat.flags & re.IGNORECASE else self._prefix_cs
+            for s in pfx:
+                index.setdefault(s, []).append(i)
+
+    def _scan(self, text: str, first_only: bool, costs: Optional[List[List[float]]] = None) -> List[List[re.Match]]:
+        # costs — по паре [вызовы, секунды] на триггер; None — не замерять
+        found: List[List[re.Match]] = [[] for _ in self.compiled]
+        for i in self._unfiltered:
+            pat = self.compiled[i][1]
+            if costs is not None:
+                t0 = time.perf_counter()
+            if first_only:
+                m = pat.search(text)
+                found[i] = [m] if m else []
+            else:
+                found[i] = list(pat.finditer(text))
+            if costs is not None:
+                costs[i][0] += 1
+                costs[i][1] += time.perf_counter() - t0
+        match = self._match if costs is None else [_timed(f, c) for f, c in zip(self._match, costs)]
+        if not (self._prefix_ci or self._prefix_cs):
+            return found
+
+        cursor = [0] * len(self.compiled)
+        for wm in _WORD.finditer(text):
+            p = wm.start()
+            w = wm.group(0)[:_GRAM]
+            wf = w.casefold()
+            for ln in range(1, _GRAM + 1):
+                for i in self._prefix_ci.get(wf[:ln], _NONE) + self._prefix_cs.get(w[:ln], _NONE):
+                    if p < cursor[i] or (first_only and found[i]):
+                        continue
+                    m = match[i](text, p)
+                    if m:
+                        found[i].append(m)
+                        cursor[i] = m.end()
+        return found
+
+    def analyze(self, text: str, costs: Optional[List[List[float]]] = None) -> MessageAnalysis:
+        res = MessageAnalysis(text=text or "")
+        for (tr, _), ms in zip(self.compiled, self._scan(res.text, first_only=False, costs=costs)):
+            if ms:
+                res.matches[tr.event] = [m.group(0) for m in ms]
+                res.spans[tr.event] = [m.span() for m in ms]
+        res.events = set(res.matches)
+        return res
+
+    def scan(self, text: str) -> Tuple[Set[str], Dict[str, List[Span]]]:
+        res = self.analyze(text)
+        return res.events, res.spans
+
     def extract(self, text: str) -> Set[str]:
         events: Set[str] = set()
-        for tr, pat in self.compiled:
-            if pat.search(text or ""):
+        for (tr, _), ms in zip(self.compiled, self._scan(text or "", first_only=True)):
+            if ms:
                 events.add(tr.event)
         return events
 
     def get_matches(self, text: str) -> Dict[str, List[str]]:
-        events_matches = {}
-        for tr, pat in self.compiled:
-            matches = []
-            for match in pat.finditer(text or ""):
-                matches.append(match.group(0))
-            if matches:
-                events_matches[tr.event] = matches
-        return events_matches
+        return self.analyze(text).matches
 
     def weight_of(self, event: str) -> int:
         return next((t.weight for t, _ in self.compiled if t.event == event), 0)
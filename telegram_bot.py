@@ -1,5 +1,5 @@
-import os, sys, pathlib, logging
-from typing import Dict, Any, Optional
+import os, sys, time, pathlib, logging, asyncio
+from typing import Dict, Any, List, Optional
 from dotenv import load_dotenv
 
 ROOT = pathlib.Path(__file__).resolve().parent
@@ -58,17 +58,13 @@ if not HAVE_NATIVE_BIZ:
         async def handle_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> object:
             return await self.callback(update, context)
 
-from src.core.config import Config
+from src.core.bundle import load_bundle
 from src.core.engine import RulesEngine
-from src.core.hints import pick_hints
-
-try:
-    from src.core.triggers import TriggerMatcher
-
-    HAVE_TRIGGER_MATCHER = True
-except Exception:
-    TriggerMatcher = None
-    HAVE_TRIGGER_MATCHER = False
+from src.core.persistence import SQLiteBackend, WriteBehind
+from src.core.dispatch import ChatDispatcher, ThreadedEngine
+from src.core.shards import ShardedEngine
+from src.core.outbox import SummaryOutbox, summary_signature
+from src.core.metrics import Metrics, serve as serve_metrics
 
 load_dotenv()
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN") or os.getenv("BOT_TOKEN")
@@ -76,18 +72,61 @@ CFG_PATH = os.getenv("CFG_PATH", "config/rules.yaml")
 MODE = os.getenv("MODE", "pilot")
 
 USER_CHAT_ID = os.getenv("USER_CHAT_ID")
+MAX_CHATS = int(os.getenv("MAX_CHATS", "0")) or None
+CHAT_IDLE_TTL = float(os.getenv("CHAT_IDLE_TTL", "0")) or None
+STATE_DB = os.getenv("STATE_DB", "")  # пусто — состояние чатов не сохраняется
+STATE_FLUSH_EVERY = int(os.getenv("STATE_FLUSH_EVERY", "256"))
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5"))
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "5"))  # 0 — не следить за rules.yaml
+ENGINE_POOL = os.getenv("ENGINE_POOL", "thread").lower()  # thread | process
+ENGINE_WORKERS = int(os.getenv("ENGINE_WORKERS", "4"))
+ENGINE_MAX_INFLIGHT = int(os.getenv("ENGINE_MAX_INFLIGHT", "1024"))  # на процесс
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "1"))  # сообщений в секунду
+OUTBOX_WINDOW = float(os.getenv("OUTBOX_WINDOW", "3"))  # секунд на склейку сводок чата
+OUTBOX_RISK_BUCKET = int(os.getenv("OUTBOX_RISK_BUCKET", "5"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — без замеров
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+LTLF_BUDGET_MS = float(os.getenv("LTLF_BUDGET_MS", "0"))  # 0 — правила LTLf всегда синхронно
+LTLF_MAX_BACKLOG = int(os.getenv("LTLF_MAX_BACKLOG", "0")) or None
+LTLF_SHED_BELOW = os.getenv("LTLF_SHED_BELOW", "medium")  # low | medium | high
+EDIT_WINDOW = int(os.getenv("EDIT_WINDOW", "0"))  # 0 — правки и удаления не учитываются
+EDIT_CHECKPOINT_EVERY = int(os.getenv("EDIT_CHECKPOINT_EVERY", "64"))
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 log = logging.getLogger("bizbot")
-log.info("python-telegram-bot version: %s (native business handlers: %s) (trigger_matcher: %s)",
-         TG_VER, HAVE_NATIVE_BIZ, HAVE_TRIGGER_MATCHER)
-
-cfg = Config.from_yaml(CFG_PATH)
-engine = RulesEngine(cfg)
-
-trigger_matcher = TriggerMatcher(cfg) if HAVE_TRIGGER_MATCHER else None
+log.info("python-telegram-bot version: %s (native business handlers: %s)", TG_VER, HAVE_NATIVE_BIZ)
+
+bundle = load_bundle(CFG_PATH)
+# без METRICS_PORT замеров нет вовсе; у каждого процесса-шарда своя копия Metrics
+metrics = Metrics() if METRICS_PORT else None
+engine_kwargs = dict(max_chats=MAX_CHATS, idle_ttl=CHAT_IDLE_TTL, metrics=metrics,
+                     ltlf_budget=LTLF_BUDGET_MS / 1000 if LTLF_BUDGET_MS > 0 else None,
+                     max_backlog=LTLF_MAX_BACKLOG, shed_below=LTLF_SHED_BELOW,
+                     edit_window=EDIT_WINDOW or None, checkpoint_every=EDIT_CHECKPOINT_EVERY)
+persist_kwargs = dict(flush_every=STATE_FLUSH_EVERY, flush_interval=STATE_FLUSH_INTERVAL)
+main_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def on_late_verdict(chat_id: str, step: int, results: List[Dict[str, Any]]) -> None:
+    # зовётся из фонового потока движка; сводка ставится в очередь из цикла бота
+    bad = [r["id"] for r in results if not r["ok"]]
+    if bad and main_loop is not None:
+        main_loop.call_soon_threadsafe(_offer_late, chat_id, step, bad)
+
+
+if ENGINE_POOL == "process":
+    # у каждого процесса свой движок, чат закреплён за процессом
+    backend = ShardedEngine(CFG_PATH, ENGINE_WORKERS, engine_kwargs, STATE_DB or None, persist_kwargs,
+                            max_inflight=ENGINE_MAX_INFLIGHT, bundle=bundle, on_verdict=on_late_verdict)
+else:
+    persistence = WriteBehind(SQLiteBackend(STATE_DB), **persist_kwargs) if STATE_DB else None
+    backend = ThreadedEngine(RulesEngine(bundle, persistence=persistence, on_verdict=on_late_verdict,
+                                         **engine_kwargs), ENGINE_WORKERS)
+dispatcher = ChatDispatcher(backend.run, backend.executor_for)
+log.info("Движок: пул %s, воркеров %d", ENGINE_POOL, ENGINE_WORKERS)
 
 business_user_chat_id: Optional[str] = USER_CHAT_ID if USER_CHAT_ID else None
+outbox: Optional[SummaryOutbox] = None
 
 
 def _short_snippet(text: Optional[str], length: int = 200) -> str:
@@ -167,38 +206,6 @@ def _chat_repr_from_msg(msg) -> str:
             return "Чат: неизвестен"
 
 
-def _get_matches(text: str, res_events: Optional[set] = None) -> Dict[str, list]:
-    if not text:
-        return {}
-    if trigger_matcher:
-        try:
-            return trigger_matcher.get_matches(text)
-        except Exception:
-            log.exception("trigger_matcher.get_matches failed, falling back to simple matcher")
-    matches = {}
-    try:
-        keywords = set()
-        if hasattr(cfg, "rules") and isinstance(cfg.rules, dict):
-            for ev, node in cfg.rules.items():
-                keywords.add(ev)
-        if res_events:
-            keywords |= set(res_events)
-        tlow = text.lower()
-        for kw in sorted(keywords, key=lambda x: -len(x)):
-            if not kw:
-                continue
-            k = str(kw).lower()
-            if k in tlow:
-                idx = tlow.find(k)
-                start = max(0, idx - 15)
-                end = min(len(text), idx + len(k) + 15)
-                snippet = text[start:end].strip()
-                matches.setdefault(str(kw), []).append(snippet)
-    except Exception:
-        log.exception("Simple matcher failed")
-    return matches
-
-
 def make_summary(res: Dict[str, Any], text: Optional[str] = None, matches: Optional[Dict[str, list]] = None,
                  sender: Optional[str] = None, chat_repr: Optional[str] = None) -> str:
     header_lines = []
@@ -218,23 +225,10 @@ def make_summary(res: Dict[str, Any], text: Optional[str] = None, matches: Optio
 
     ev = ", ".join(res.get("events", [])) if res.get("events") else "—"
     bad = [r.get("id") for r in res.get("ltlf", []) if not r.get("ok")]
-    viol = ", ".join(filter(None, bad)) or "—"
+    viol = ", ".join(filter(None, bad)) or ("проверяются" if res.get("ltlf_deferred") else "—")
     body = (f"События: {ev}\nСостояние: {res.get('state')}\nРиск: {res.get('risk')}\nНарушения: {viol}")
 
-    hints = []
-    try:
-        if trigger_matcher:
-            hints = pick_hints(cfg, trigger_matcher, text or "", res.get("state"), set(res.get("events", [])), count=2,
-                               user=sender, message=text)
-        else:
-            hints = pick_hints(cfg, res.get("state"), set(res.get("events", [])), count=2)
-    except TypeError:
-        try:
-            hints = pick_hints(cfg, res.get("state"), set(res.get("events", [])), count=2)
-        except Exception:
-            hints = []
-    except Exception:
-        hints = []
+    hints = res.get("hints") or []
 
     if hints:
         body += "\n\nПодсказки:\n- " + "\n- ".join(hints)
@@ -242,15 +236,23 @@ def make_summary(res: Dict[str, Any], text: Optional[str] = None, matches: Optio
     return header + "\n\n" + body
 
 
-async def send_to_business_user(context: ContextTypes.DEFAULT_TYPE, text: str):
-    global business_user_chat_id
-    if not business_user_chat_id:
-        log.warning("send_to_business_user: business_user_chat_id не задан — пропускаем отправку")
+def send_to_business_user(chat_id: str, res: Dict[str, Any], text: str,
+                          fallback: Optional[tuple] = None) -> bool:
+    """Ставит сводку в очередь отправки владельцу; сама отправка идёт в фоне."""
+    sig = summary_signature(res, OUTBOX_RISK_BUCKET)
+    if business_user_chat_id:
+        return outbox.offer(chat_id, sig, text, {"chat_id": business_user_chat_id}, fallback)
+    if fallback is not None:
+        return outbox.offer(chat_id, sig, fallback[0], fallback[1])
+    log.warning("send_to_business_user: business_user_chat_id не задан — пропускаем отправку")
+    return False
+
+
+def _offer_late(chat_id: str, step: int, bad: List[str]) -> None:
+    if outbox is None or not business_user_chat_id:
         return
-    try:
-        await context.bot.send_message(chat_id=business_user_chat_id, text=text)
-    except Exception as e:
-        log.error("Не удалось отправить сообщение владельцу (chat_id=%s): %s", business_user_chat_id, e)
+    text = f"Чат: [{chat_id}]\nНарушения (проверено с задержкой, сообщение №{step + 1}): {', '.join(bad)}"
+    outbox.offer(chat_id, None, text, {"chat_id": business_user_chat_id})
 
 
 async def on_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -264,14 +266,16 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = msg.text or ""
     chat_id = str(msg.chat_id)
 
-    res = engine.process_message(chat_id, text)
-
+    t0 = time.perf_counter()
     sender = _extract_sender_repr(getattr(msg, "from_user", None))
-    matches = _get_matches(text, set(res.get("events", [])))
+    res = await dispatcher.submit(chat_id, text, sender, msg.message_id)
+    matches = res["analysis"].matches
 
-    await send_to_business_user(context, make_summary(res, text=text, matches=matches, sender=sender,
-                                                      chat_repr=_chat_repr_from_msg(msg)))
-    log.info("Processed non-business message from %s — summary sent to owner (if known).", chat_id)
+    queued = send_to_business_user(chat_id, res, make_summary(res, text=text, matches=matches, sender=sender,
+                                                              chat_repr=_chat_repr_from_msg(msg)))
+    if metrics is not None:
+        metrics.observe('handle', time.perf_counter() - t0)
+    log.info("Processed non-business message from %s — summary queued=%s.", chat_id, queued)
 
 
 async def on_business_connection(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -303,47 +307,133 @@ async def on_business_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     bc_id = getattr(msg, "business_connection_id", None)
     log.info("business_message chat=%s bc_id=%s text=%r", chat_id, bc_id, text)
 
-    res = engine.process_message(str(chat_id), text)
-
+    t0 = time.perf_counter()
     sender = _extract_sender_repr(getattr(msg, "from_user", None))
-    matches = _get_matches(text, set(res.get("events", [])))
+    res = await dispatcher.submit(str(chat_id), text, sender, msg.message_id)
+    matches = res["analysis"].matches
 
     detailed = make_summary(res, text=text, matches=matches, sender=sender, chat_repr=_chat_repr_from_msg(msg))
+    # если владельцу отправить не удастся, сводка без его данных уйдёт в сам бизнес-чат
+    anon_summary = make_summary(res, text=_short_snippet(text, 120), matches=matches, sender=None,
+                                chat_repr=_chat_repr_from_msg(msg))
+    fallback = (anon_summary, {"chat_id": chat_id, "business_connection_id": bc_id})
+    queued = send_to_business_user(str(chat_id), res, detailed, fallback)
+    if metrics is not None:
+        metrics.observe('handle', time.perf_counter() - t0)
+    log.info("Summary for business_message from %s queued=%s", chat_id, queued)
+
+
+async def on_business_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.edited_business_message
+    if not msg:
+        return
+    text = msg.text or msg.caption or ""
+    chat_id = str(msg.chat_id)
+    # правка встаёт в очередь чата: состояние пересчитывается с контрольной точки
+    res = await dispatcher.call(backend.edit_message, chat_id, msg.message_id, text)
+    if res is None:
+        log.info("edited_business_message chat=%s id=%s: сообщения нет в журнале правок", chat_id,
+                 msg.message_id)
+        return
+    summary = make_summary(res, text=text, chat_repr=_chat_repr_from_msg(msg))
+    queued = send_to_business_user(chat_id, res, "✏️ Сообщение изменено\n" + summary)
+    log.info("edited_business_message chat=%s id=%s: пересчитано шагов %d, сводка queued=%s", chat_id,
+             msg.message_id, res["replayed"], queued)
 
-    if business_user_chat_id:
+
+async def on_business_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    dm = update.deleted_business_messages
+    if not dm:
+        return
+    chat_id = str(dm.chat.id)
+    ids = list(dm.message_ids)
+    res = await dispatcher.call(backend.delete_messages, chat_id, ids)
+    if res is None:
+        log.info("deleted_business_messages chat=%s: удалённых сообщений нет в журнале правок", chat_id)
+        return
+    summary = make_summary(res, chat_repr=f"[{chat_id}]")
+    queued = send_to_business_user(chat_id, res, f"🗑 Удалено сообщений: {len(ids)}\n" + summary)
+    log.info("deleted_business_messages chat=%s: пересчитано шагов %d, сводка queued=%s", chat_id,
+             res["replayed"], queued)
+
+
+async def _flush_loop():
+    # сброс по таймеру, когда сообщений мало; сама запись идёт в фоновом потоке
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        await loop.run_in_executor(None, backend.call_all, "flush")
+
+
+async def _reload_loop():
+    # правила подменяются целиком; состояние чатов переводится на них лениво
+    loop = asyncio.get_running_loop()
+    seen = os.stat(CFG_PATH).st_mtime_ns
+    while True:
+        await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
         try:
-            await context.bot.send_message(chat_id=business_user_chat_id, text=detailed)
-            log.info("Detailed summary for business_message from %s sent to owner %s", chat_id, business_user_chat_id)
-            return
+            mtime = os.stat(CFG_PATH).st_mtime_ns
+            if mtime == seen:
+                continue
+            seen = mtime
+            digest = await loop.run_in_executor(None, backend.reload, CFG_PATH)
+            log.info("Правила перечитаны из %s (%s)", CFG_PATH, digest[:12])
         except Exception:
-            log.exception(
-                "Failed to send detailed summary to owner; will fallback to replying in business chat without owner info")
+            log.exception("Не удалось перечитать %s — продолжаю со старыми правилами", CFG_PATH)
+
+
+def _collect_metrics():
+    # замеры этого процесса (бот, очередь сводок) и движка; шарды отвечают своими
+    snaps = [metrics.snapshot()]
+    if ENGINE_POOL == "process":
+        snaps += backend.call_all("metrics_snapshot")
+    return snaps
+
+
+async def on_post_init(app):
+    global outbox, main_loop
+    main_loop = asyncio.get_running_loop()
+    outbox = SummaryOutbox(app.bot.send_message, rate=OUTBOX_RATE, window=OUTBOX_WINDOW, metrics=metrics,
+                           max_sigs=MAX_CHATS or 10000, sig_ttl=CHAT_IDLE_TTL)
+    outbox.start()
+    if metrics is not None:
+        serve_metrics(_collect_metrics, METRICS_PORT, METRICS_HOST)
+    if CONFIG_RELOAD_INTERVAL > 0:
+        app.create_task(_reload_loop())
+    if not STATE_DB:
+        return
+    loop = asyncio.get_running_loop()
+    restored = await loop.run_in_executor(None, backend.call_all, "warm_up")
+    log.info("Восстановлено чатов из %s: %d", STATE_DB, sum(restored))
+    app.create_task(_flush_loop())
 
-    try:
-        anon_summary = make_summary(res, text=_short_snippet(text, 120), matches=matches, sender=None,
-                                    chat_repr=_chat_repr_from_msg(msg))
-        await context.bot.send_message(chat_id=chat_id, text=anon_summary, business_connection_id=bc_id)
-        log.info("Fallback reply sent into business chat for chat=%s", chat_id)
-    except Exception:
-        log.exception("Failed to send fallback reply into business chat")
+
+async def on_post_stop(app):
+    # бот ещё может отправлять: досылаем накопленные сводки
+    await outbox.stop(drain=True)
+    log.info("Очередь сводок: %s", outbox.stats())
 
 
-async def ignore(*_):
-    return
+async def on_post_shutdown(app):
+    backend.shutdown()
+    log.info("Состояние чатов сохранено")
 
 
 def main():
     if not BOT_TOKEN:
         raise RuntimeError("Укажи TELEGRAM_BOT_TOKEN (или BOT_TOKEN) в .env")
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # обновления обрабатываются параллельно; порядок внутри чата держит dispatcher
+    app = (ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(True)
+           .post_init(on_post_init).post_stop(on_post_stop)
+           .post_shutdown(on_post_shutdown).build())
     app.add_handler(CommandHandler("start", on_start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
 
     app.add_handler(BusinessConnectionHandler(on_business_connection))
     app.add_handler(BusinessMessageHandler(on_business_text))
-    app.add_handler(EditedBusinessMessageHandler(ignore))
-    app.add_handler(DeletedBusinessMessagesHandler(ignore))
+    app.add_handler(EditedBusinessMessageHandler(on_business_edit))
+    app.add_handler(DeletedBusinessMessagesHandler(on_business_delete))
 
     allowed = [
         "message",